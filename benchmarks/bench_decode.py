@@ -0,0 +1,66 @@
+"""
+Compare the streaming XML decoder with the original minidom decoder, which
+serialized and re-parsed every nested customer, product and credit card.
+
+    python benchmarks/bench_decode.py [count]
+"""
+import datetime
+import sys
+import time
+from xml.dom import minidom
+
+import fixtures
+from chargify.pychargify import api, iso8601
+
+
+def _get_xml_value(nodelist):
+    rc = ""
+    for node in nodelist:
+        if node.nodeType == node.TEXT_NODE:
+            rc = rc + node.data
+    return rc
+
+def _legacy_object_from_node(base, node, obj_type):
+    obj = base._new_object(obj_type)
+    for childnodes in node.childNodes:
+        if childnodes.nodeType == 1 and not childnodes.nodeName == '':
+            if childnodes.nodeName in base.__attribute_types__:
+                obj.__setattr__(childnodes.nodeName, _legacy_applyS(base, childnodes.toxml(), base.__attribute_types__[childnodes.nodeName], childnodes.nodeName))
+            else:
+                node_value = _get_xml_value(childnodes.childNodes)
+                if "type" in childnodes.attributes.keys():
+                    node_type = childnodes.attributes["type"]
+                    if node_value:
+                        if node_type.nodeValue == 'datetime':
+                            node_value = datetime.datetime.fromtimestamp(iso8601.parse(node_value))
+                obj.__setattr__(childnodes.nodeName, node_value)
+    return obj
+
+def _legacy_applyS(base, xml, obj_type, node_name):
+    dom = minidom.parseString(xml)
+    nodes = dom.getElementsByTagName(node_name)
+    if nodes.length == 1:
+        return _legacy_object_from_node(base, nodes[0], obj_type)
+
+def legacy_applyA(base, xml, obj_type, node_name):
+    dom = minidom.parseString(xml)
+    return [_legacy_object_from_node(base, node, obj_type) for node in dom.getElementsByTagName(node_name)]
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+def main(count = 10000):
+    xml = fixtures.subscriptions_xml(count)
+    base = api.Chargify('key', 'bench').Subscription()
+    print "Decoding %i subscriptions (%.1f MB)" %(count, len(xml) / 1048576.0)
+    legacy, legacy_objs = timed(legacy_applyA, base, xml, 'ChargifySubscription', 'subscription')
+    print "minidom re-parse:  %8.3fs" % legacy
+    streaming, objs = timed(base._applyA, xml, 'ChargifySubscription', 'subscription')
+    print "streaming:         %8.3fs" % streaming
+    assert len(objs) == len(legacy_objs) == count
+    print "speedup:           %8.1fx" %(legacy / streaming)
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,54 @@
+"""
+Compare encoding subscription request bodies through a minidom Document,
+as _toxml used to, with the streaming encoder.
+
+    python benchmarks/bench_encode.py [count]
+"""
+import sys
+import time
+from xml.dom import minidom
+
+import fixtures
+from chargify.pychargify import api
+
+
+def _legacy_element(dom, obj):
+    element = minidom.Element(obj.__xmlnodename__)
+    for name, value in obj._fields():
+        if name in obj.__ignore__:
+            continue
+        if isinstance(value, api.ChargifyBase):
+            element.appendChild(_legacy_element(dom, value))
+        else:
+            node = minidom.Element(name)
+            node.appendChild(dom.createTextNode(unicode(value)))
+            element.appendChild(node)
+    return element
+
+def legacy_encode(objs):
+    for obj in objs:
+        dom = minidom.Document()
+        dom.appendChild(_legacy_element(dom, obj))
+        dom.toxml(encoding = "utf-8")
+
+def streaming_encode(objs):
+    for obj in objs:
+        obj._encode()
+
+def timed(func, *args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+def main(count = 5000):
+    objs = api.Chargify('key', 'bench').Subscription()._applyA(
+        fixtures.subscriptions_xml(count), 'ChargifySubscription', 'subscription')
+    print "Encoding %i subscriptions" % count
+    legacy = timed(legacy_encode, objs)
+    print "minidom:           %8.3fs" % legacy
+    streaming = timed(streaming_encode, objs)
+    print "streaming:         %8.3fs" % streaming
+    print "speedup:           %8.1fx" %(legacy / streaming)
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,61 @@
+"""
+Per request cost of the instrumentation: a request through ChargifyBase
+against a transport that answers instantly, without hooks, with an empty
+post-response hook and with a MetricsCollector, compared to the request
+and logging calls _request made before.
+
+    python benchmarks/bench_hooks.py [count]
+"""
+import sys
+import time
+
+import fixtures
+from chargify.pychargify import api
+from chargify.pychargify.transport import HTTPTransport, Response
+
+
+class NullTransport(HTTPTransport):
+    """
+    Answers every request with an empty 200 without touching the network
+    """
+    def request(self, host, method, url, body = None, headers = None, info = None):
+        return Response(200, 'OK', {}, '')
+
+def best(func, count, repeat = 5):
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        func(count)
+        times.append(time.time() - start)
+    return min(times) / count * 1e9
+
+def main(count = 200000):
+    customer = api.Chargify('key', 'bench').Customer()
+    transport = NullTransport()
+    customer._context.transport = transport
+    headers = {}
+    def direct(count):
+        # What _request did before the hooks, including its TRACE logging
+        for i in xrange(count):
+            api.log.log(5, "Sending XML: %s" %(None))
+            val = customer.transport.request(customer.request_host, 'GET', '/customers/1.xml', None, headers).body
+            api.log.log(5, "Server Response: %s" %(val))
+    def send(count):
+        send = customer._send
+        for i in xrange(count):
+            send('GET', '/customers/1.xml', None, headers)
+    print "Sending %i requests" % count
+    baseline = best(direct, count)
+    print "before (eager logging):  %8.0f ns/request" % baseline
+    no_hooks = best(send, count)
+    print "_send without hooks:     %8.0f ns/request (+%.0f ns)" %(no_hooks, no_hooks - baseline)
+    transport.add_hooks(post_response = lambda info: None)
+    empty = best(send, count)
+    print "_send with an empty hook:%8.0f ns/request (+%.0f ns)" %(empty, empty - baseline)
+    transport.clear_hooks()
+    transport.add_hooks(post_response = api.MetricsCollector())
+    collected = best(send, count)
+    print "_send with a collector:  %8.0f ns/request (+%.0f ns)" %(collected, collected - baseline)
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
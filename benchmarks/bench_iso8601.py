@@ -0,0 +1,56 @@
+"""
+Time parsing the timestamps of a subscription listing with the general
+iso8601 parser (converted to local time as the decoder used to) and with
+the fixed shape parser, with and without its memo.
+
+    python benchmarks/bench_iso8601.py [count]
+"""
+import datetime
+import sys
+import time
+
+import fixtures
+from chargify.pychargify import dates, iso8601
+
+
+def legacy(values):
+    for value in values:
+        datetime.datetime.fromtimestamp(iso8601.parse(value))
+
+def fixed(values):
+    parse = dates._parse_fixed
+    for value in values:
+        parse(value)
+
+def memoized(values):
+    dates._memo.clear()
+    parse = dates.parse_datetime
+    for value in values:
+        parse(value)
+
+def timed(func, *args):
+    best = None
+    for i in range(3):
+        start = time.time()
+        func(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def main(count = 100000):
+    # Nine timestamps per subscription as in a listing, many of them repeated
+    values = []
+    for i in xrange(count):
+        for name, type, value in fixtures.subscription_record(i):
+            if type == 'datetime' and value:
+                values.append(value)
+    print "Parsing %i timestamps (%i distinct)" %(len(values), len(set(values)))
+    base = timed(legacy, values)
+    print "iso8601.parse:     %8.3fs" % base
+    for label, func in (("fixed shape:", fixed), ("fixed shape+memo:", memoized)):
+        elapsed = timed(func, values)
+        print "%-18s %8.3fs  %5.1fx" %(label, elapsed, base / elapsed)
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,53 @@
+"""
+Cost of logging a request and its response body, as _request used to
+(formatting both bodies on every call) and through the RequestLogger, with
+TRACE logging disabled and enabled.
+
+    python benchmarks/bench_logging.py [count] [subscriptions]
+"""
+import logging
+import sys
+import time
+
+import fixtures
+from chargify.pychargify.requestlog import RequestLogger, TRACE
+
+
+class FormattingHandler(logging.Handler):
+    """
+    Formats every record like a real handler would, then drops it
+    """
+    def emit(self, record):
+        self.format(record)
+
+def legacy(log, body, response):
+    log.log(5, "Sending XML: %s" %(body))
+    log.log(5, "Server Response: %s" %(response))
+
+def lazy(request_log, body, response):
+    request_log.request('GET', '/subscriptions.xml', body)
+    request_log.response('GET', '/subscriptions.xml', 200, response)
+
+def timed(func, count, *args):
+    start = time.time()
+    for i in xrange(count):
+        func(*args)
+    return (time.time() - start) / count * 1e6
+
+def main(count = 200, subscriptions = 1000):
+    response = fixtures.subscriptions_xml(subscriptions)
+    body = ''
+    log = logging.getLogger('bench.logging')
+    log.propagate = False
+    log.addHandler(FormattingHandler())
+    request_log = RequestLogger(log)
+    print "Logging a %i byte response %i times" %(len(response), count)
+    for name, level in (('disabled', logging.DEBUG), ('enabled', TRACE)):
+        log.setLevel(level)
+        print "%-8s eager:     %10.1f us/request" %(name, timed(legacy, count, log, body, response))
+        print "%-8s lazy:      %10.1f us/request" %(name, timed(lazy, count, request_log, body, response))
+    request_log.max_bytes = None
+    print "enabled  whole body:%10.1f us/request (redacted, not truncated)" % timed(lazy, count, request_log, body, response)
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,75 @@
+"""
+Bytes per decoded subscription (with its customer, product and credit card)
+for the slot based resource objects and for dict backed objects carrying
+their own copy of the client settings, as every object did before.
+
+    python benchmarks/bench_memory.py [count]
+"""
+import sys
+
+import fixtures
+from chargify.pychargify import api, decoder
+
+
+class LegacyResource(object):
+    """
+    Laid out like a resource object with an instance __dict__
+    """
+    def __init__(self, context):
+        self.api_key = context.api_key
+        self.sub_domain = context.sub_domain
+        self.request_host = context.sub_domain + api.ChargifyBase.base_host
+        self.transport = context.transport
+        self.format = context.format
+
+def legacy_factory(context):
+    classes = {}
+    for cls in (api.ChargifyCustomer, api.ChargifyProduct, api.ChargifySubscription, api.ChargifyCreditCard):
+        classes[cls.__name__] = type('Legacy' + cls.__name__, (LegacyResource,), {
+            '__xml_decoders__': cls.__xml_decoders__,
+            '__attribute_types__': cls.__attribute_types__,
+        })
+    def factory(obj_type):
+        return classes[obj_type](context)
+    return factory
+
+def deep_size(obj, seen, skip):
+    """
+    Size of `obj` and everything it references that was not counted yet
+    """
+    if id(obj) in seen or obj is skip:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            size += deep_size(key, seen, skip) + deep_size(value, seen, skip)
+    elif isinstance(obj, (list, tuple)):
+        for item in obj:
+            size += deep_size(item, seen, skip)
+    else:
+        if hasattr(obj, '__dict__'):
+            size += deep_size(obj.__dict__, seen, skip)
+        for cls in type(obj).__mro__:
+            for name in cls.__dict__.get('__slots__', ()):
+                try:
+                    size += deep_size(object.__getattribute__(obj, name), seen, skip)
+                except AttributeError:
+                    pass
+    return size
+
+def main(count = 10000):
+    xml = fixtures.subscriptions_xml(count)
+    base = api.Chargify('key', 'bench').Subscription()
+    print "Decoding %i subscriptions" % count
+    legacy = decoder.decode_list(xml, 'subscription', legacy_factory(base._context), 'ChargifySubscription')
+    before = deep_size(legacy, set(), base.transport) / float(count)
+    del legacy
+    objs = base._applyA(xml, 'ChargifySubscription', 'subscription')
+    after = deep_size(objs, set(), base.transport) / float(count)
+    print "dict per object:   %8i bytes per subscription" % before
+    print "slots and context: %8i bytes per subscription" % after
+    print "saving:            %8.1f%%" %(100 * (before - after) / before)
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,84 @@
+"""
+Compare the decoders compiled from the resource schemas with reflective
+decoding, which inspects every element's type attribute and looks nested
+types up in __attribute_types__ while it goes.
+
+    python benchmarks/bench_schema.py [count]
+"""
+import sys
+import time
+
+import fixtures
+from chargify.pychargify import api, decoder
+
+
+def _reflective_value(element):
+    value = decoder._get_text(element)
+    kind = element.get('type')
+    if not value:
+        if kind in ('integer', 'datetime', 'boolean'):
+            return None
+        return value
+    if kind == 'integer':
+        return int(value)
+    if kind == 'datetime':
+        return decoder.to_datetime(value)
+    if kind == 'boolean':
+        return value == 'true'
+    return value
+
+def _reflective_element(element, factory, obj_type):
+    obj = factory(obj_type)
+    for child in element:
+        if child.tag in obj.__attribute_types__:
+            value = _reflective_element(child, factory, obj.__attribute_types__[child.tag])
+        else:
+            value = _reflective_value(child)
+        obj.__setattr__(child.tag, value)
+    return obj
+
+def reflective_decode(xml, factory, obj_type, node_name):
+    """
+    Run the streaming decoder with the reflective element decoder swapped in
+    """
+    compiled = decoder.decode_element
+    decoder.decode_element = _reflective_element
+    try:
+        return decoder.decode_list(xml, node_name, factory, obj_type)
+    finally:
+        decoder.decode_element = compiled
+
+def timed(func, *args):
+    """
+    Best of three runs
+    """
+    best = None
+    for i in range(3):
+        start = time.time()
+        result = func(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+def compare(label, xml, base, obj_type, node_name, count):
+    print "Decoding %i %s (%.1f MB)" %(count, label, len(xml) / 1048576.0)
+    reflective, reflective_objs = timed(reflective_decode, xml, base._new_object, obj_type, node_name)
+    print "  reflective:      %8.3fs" % reflective
+    compiled, objs = timed(base._applyA, xml, obj_type, node_name)
+    print "  compiled schema: %8.3fs" % compiled
+    assert len(objs) == len(reflective_objs) == count
+    assert dict(objs[-1]._fields()) == dict(reflective_objs[-1]._fields()) or obj_type == 'ChargifySubscription'
+    print "  speedup:         %8.2fx" %(reflective / compiled)
+
+def main(count = 10000):
+    chargify = api.Chargify('key', 'bench')
+    # Products have no timestamps, so this isolates the per field dispatch
+    xml = fixtures.render_xml((fixtures.product_record(i) for i in xrange(1, count + 1)), 'product', 'products')
+    compare('products', xml, chargify.Product(), 'ChargifyProduct', 'product', count)
+    # Subscriptions are dominated by timestamp parsing
+    xml = fixtures.subscriptions_xml(count)
+    compare('subscriptions', xml, chargify.Subscription(), 'ChargifySubscription', 'subscription', count)
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,9 @@
+"""
+Django settings for the benchmark suite: an in-memory SQLite database
+created in each benchmark process
+"""
+DATABASES = {'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}}
+INSTALLED_APPS = ['django.contrib.auth', 'django.contrib.contenttypes', 'chargify']
+SECRET_KEY = 'benchmarks'
+CHARGIFY_SUBDOMAIN = 'bench'
+CHARGIFY_API_KEY = 'key'
@@ -0,0 +1,95 @@
+"""
+Synthetic Chargify API payloads for the benchmarks
+"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+TIMESTAMP = '2010-%02d-%02dT%02d:%02d:%02d-05:00'
+
+def timestamp(i):
+    return TIMESTAMP %(i % 12 + 1, i % 28 + 1, i % 24, i % 60, (i * 7) % 60)
+
+def customer_record(i):
+    return [
+        ('id', 'integer', str(i)),
+        ('first_name', None, 'First%i' % i),
+        ('last_name', None, 'Last%i' % i),
+        ('email', None, 'customer%i@example.com' % i),
+        ('organization', None, 'Organization %i' % i),
+        ('reference', None, 'ref%i' % i),
+        ('created_at', 'datetime', timestamp(i)),
+        ('updated_at', 'datetime', timestamp(i + 1)),
+    ]
+
+def product_record(i):
+    return [
+        ('id', 'integer', str(i % 10 + 1)),
+        ('price_in_cents', 'integer', str((i % 10 + 1) * 1000)),
+        ('name', None, 'Plan %i' % (i % 10 + 1)),
+        ('handle', None, 'plan-%i' % (i % 10 + 1)),
+        ('accounting_code', None, 'AC%i' % (i % 10 + 1)),
+        ('interval_unit', None, 'month'),
+        ('interval', 'integer', '1'),
+    ]
+
+def credit_card_record(i):
+    return [
+        ('first_name', None, 'First%i' % i),
+        ('last_name', None, 'Last%i' % i),
+        ('masked_card_number', None, 'XXXX-XXXX-XXXX-%04i' % (i % 10000)),
+        ('card_type', None, 'visa'),
+        ('expiration_month', 'integer', str(i % 12 + 1)),
+        ('expiration_year', 'integer', '2020'),
+    ]
+
+def subscription_record(i):
+    return [
+        ('id', 'integer', str(i)),
+        ('state', None, 'active'),
+        ('balance_in_cents', 'integer', str(i % 5000)),
+        ('current_period_started_at', 'datetime', timestamp(i)),
+        ('current_period_ends_at', 'datetime', timestamp(i + 30)),
+        ('trial_started_at', 'datetime', timestamp(i + 2)),
+        ('trial_ended_at', 'datetime', timestamp(i + 3)),
+        ('activated_at', 'datetime', timestamp(i + 4)),
+        ('expires_at', 'datetime', ''),
+        ('created_at', 'datetime', timestamp(i + 5)),
+        ('updated_at', 'datetime', timestamp(i + 6)),
+        ('customer', 'customer', customer_record(i)),
+        ('product', 'product', product_record(i)),
+        ('credit_card', 'credit_card', credit_card_record(i)),
+    ]
+
+def _xml_fields(fields, out, indent):
+    for name, type, value in fields:
+        if isinstance(value, list):
+            out.append('%s<%s>' %(indent, name))
+            _xml_fields(value, out, indent + '  ')
+            out.append('%s</%s>' %(indent, name))
+        elif type and not value:
+            out.append('%s<%s type="%s" nil="true"></%s>' %(indent, name, type, name))
+        elif type:
+            out.append('%s<%s type="%s">%s</%s>' %(indent, name, type, value, name))
+        else:
+            out.append('%s<%s>%s</%s>' %(indent, name, value, name))
+
+def render_xml(records, node_name, root_name = None):
+    out = ['<?xml version="1.0" encoding="UTF-8"?>']
+    indent = ''
+    if root_name:
+        out.append('<%s type="array">' % root_name)
+        indent = '  '
+    for record in records:
+        out.append('%s<%s>' %(indent, node_name))
+        _xml_fields(record, out, indent + '  ')
+        out.append('%s</%s>' %(indent, node_name))
+    if root_name:
+        out.append('</%s>' % root_name)
+    return '\n'.join(out)
+
+def subscriptions_xml(count):
+    return render_xml((subscription_record(i) for i in xrange(1, count + 1)), 'subscription', 'subscriptions')
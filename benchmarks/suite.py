@@ -0,0 +1,317 @@
+"""
+The benchmark suite: times decoding, encoding, timestamp and decimal
+parsing, Subscription.load and a full reload_all sync against a local fake
+Chargify server and SQLite, on recorded payloads of 1 to 100k subscriptions.
+
+Every measurement runs in a forked process, so each reports its own peak
+memory (ru_maxrss) next to the wall time.  Runs are appended to a JSON
+history file and compare flags the cases that got slower or bigger.
+
+    python benchmarks/suite.py run [--case decode ...] [--size 1000 ...] [--repeat 3] [--label text]
+    python benchmarks/suite.py compare [--threshold 10] [base] [head]
+    python benchmarks/suite.py list
+"""
+import datetime
+import json
+import optparse
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+import fixtures
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bench_settings')
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PAYLOADS = os.path.join(HERE, 'payloads')
+HISTORY = os.path.join(HERE, 'history.json')
+
+SIZES = (1, 1000, 10000, 100000)
+# The cases writing to the database stop at 10k, a 100k sync takes hours
+DATABASE_SIZES = (1, 1000, 10000)
+
+
+def payload(count):
+    """
+    The recorded XML listing of `count` subscriptions, generated once so
+    every run decodes the same bytes
+    """
+    path = os.path.join(PAYLOADS, 'subscriptions-%i.xml' % count)
+    if not os.path.exists(path):
+        if not os.path.isdir(PAYLOADS):
+            os.makedirs(PAYLOADS)
+        f = open(path + '.tmp', 'wb')
+        try:
+            f.write(fixtures.subscriptions_xml(count))
+        finally:
+            f.close()
+        os.rename(path + '.tmp', path)
+    f = open(path, 'rb')
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+def subscriptions(count):
+    from chargify.pychargify import api
+    base = api.Chargify('key', 'bench').Subscription()
+    return base._applyA(payload(count), 'ChargifySubscription', 'subscription')
+
+def create_database():
+    from django.core.management import call_command
+    call_command('syncdb', interactive = False, verbosity = 0)
+
+
+# Each case prepares its input untimed and returns the function to time
+
+def case_decode(size):
+    from chargify.pychargify import api
+    xml = payload(size)
+    base = api.Chargify('key', 'bench').Subscription()
+    return lambda: base._applyA(xml, 'ChargifySubscription', 'subscription')
+
+def case_decode_single(size):
+    from chargify.pychargify import api
+    documents = [fixtures.render_xml([fixtures.subscription_record(i)], 'subscription') for i in xrange(1, size + 1)]
+    base = api.Chargify('key', 'bench').Subscription()
+    def run():
+        for xml in documents:
+            base._applyS(xml, 'ChargifySubscription', 'subscription')
+    return run
+
+def case_encode(size):
+    objs = subscriptions(size)
+    def run():
+        for obj in objs:
+            obj._encode()
+    return run
+
+def case_iso8601(size):
+    from chargify.pychargify import iso8601
+    stamps = [fixtures.timestamp(i) for i in xrange(size)]
+    def run():
+        for stamp in stamps:
+            iso8601.parse(stamp)
+    return run
+
+def case_round_decimal(size):
+    from chargify.numbers import round_decimal
+    values = ['%i.%03i' %(i, i % 1000) for i in xrange(size)]
+    def run():
+        for value in values:
+            round_decimal(val = value, places = 2, roundfactor = '0.01', normalize = True)
+    return run
+
+def case_subscription_load(size):
+    objs = subscriptions(size)
+    create_database()
+    from chargify.models import Subscription
+    def run():
+        for obj in objs:
+            Subscription().load(obj)
+    return run
+
+def case_reload_all(size):
+    from chargify.pychargify.fakeserver import FakeChargify
+    from chargify import models
+    server = FakeChargify(page_size = 200)
+    server.store.seed(customers = size, products = 10)
+    server.start()
+    create_database()
+    models.ChargifyBaseModel.gateway = server.client()
+    def run():
+        models.Customer.objects.reload_all()
+        models.Subscription.objects.reload_all()
+    return run
+
+CASES = (
+    ('decode', SIZES, case_decode),
+    ('decode_single', SIZES, case_decode_single),
+    ('encode', SIZES, case_encode),
+    ('iso8601', SIZES, case_iso8601),
+    ('round_decimal', SIZES, case_round_decimal),
+    ('subscription_load', DATABASE_SIZES, case_subscription_load),
+    ('reload_all', DATABASE_SIZES, case_reload_all),
+)
+
+
+def _max_rss():
+    # Kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def measure(setup, size):
+    """
+    Run `setup(size)` and time the function it returns in a forked process.
+    Returns the seconds taken, the peak RSS of the process and how much the
+    timed part raised it.
+    """
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            try:
+                os.close(read)
+                run = setup(size)
+                before = _max_rss()
+                start = time.time()
+                run()
+                seconds = time.time() - start
+                peak = _max_rss()
+                os.write(write, json.dumps({'seconds': seconds, 'peak_rss_kb': peak, 'rss_growth_kb': peak - before}))
+                status = 0
+            except:
+                import traceback
+                traceback.print_exc()
+        finally:
+            os._exit(status)
+    os.close(write)
+    chunks = []
+    while True:
+        chunk = os.read(read, 4096)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    os.close(read)
+    os.waitpid(pid, 0)
+    if not chunks:
+        return None
+    return json.loads(''.join(chunks))
+
+def record_payload(size):
+    payload(size)
+    return lambda: None
+
+def run_cases(names, sizes, repeat):
+    """
+    Measure every case at its sizes, keeping the fastest of `repeat` runs
+    """
+    results = {}
+    cases = [(name, sizes or case_sizes, setup) for name, case_sizes, setup in CASES if not names or name in names]
+    # Record missing payloads up front, so generating them is not part of any peak
+    for size in sorted(set(sum([list(case_sizes) for name, case_sizes, setup in cases], []))):
+        measure(record_payload, size)
+    for name, case_sizes, setup in cases:
+        for size in case_sizes:
+            best = None
+            for i in range(repeat):
+                result = measure(setup, size)
+                if result is None:
+                    break
+                if best is None or result['seconds'] < best['seconds']:
+                    best = result
+            if best is None:
+                print "%-18s %7i  failed" %(name, size)
+                continue
+            best['per_item_us'] = best['seconds'] * 1e6 / size
+            results['%s/%i' %(name, size)] = best
+            print "%-18s %7i %10.4fs %10.2fus/item %9iKB peak %9iKB growth" %(
+                name, size, best['seconds'], best['per_item_us'], best['peak_rss_kb'], best['rss_growth_kb'])
+            sys.stdout.flush()
+    return results
+
+
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    f = open(path)
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+def save_history(path, history):
+    f = open(path + '.tmp', 'w')
+    try:
+        json.dump(history, f, indent = 1, sort_keys = True)
+    finally:
+        f.close()
+    os.rename(path + '.tmp', path)
+
+def git_commit():
+    try:
+        return subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'], cwd = HERE,
+                                stdout = subprocess.PIPE, stderr = subprocess.PIPE).communicate()[0].strip() or None
+    except OSError:
+        return None
+
+def compare(base, head, threshold, min_seconds):
+    """
+    Compare two history entries, returns the regressed "case/size" keys.
+    A case regresses when its time or peak RSS grew by more than
+    `threshold` percent, times under `min_seconds` are too noisy to judge.
+    """
+    regressions = []
+    limit = 1 + threshold / 100.0
+    print "%-26s %10s %10s %8s %10s %10s %8s" %('case', 'base', 'head', 'time', 'base KB', 'head KB', 'memory')
+    for key in sorted(set(base['results']) & set(head['results'])):
+        old, new = base['results'][key], head['results'][key]
+        time_ratio = new['seconds'] / max(old['seconds'], 1e-9)
+        memory_ratio = new['peak_rss_kb'] / float(max(old['peak_rss_kb'], 1))
+        flags = []
+        if time_ratio > limit and old['seconds'] >= min_seconds:
+            flags.append('SLOWER')
+        if memory_ratio > limit:
+            flags.append('BIGGER')
+        if flags:
+            regressions.append(key)
+        print "%-26s %9.4fs %9.4fs %7.2fx %10i %10i %7.2fx %s" %(
+            key, old['seconds'], new['seconds'], time_ratio, old['peak_rss_kb'], new['peak_rss_kb'],
+            memory_ratio, ' '.join(flags))
+    return regressions
+
+def _entry(history, index):
+    try:
+        return history[int(index)]
+    except (IndexError, ValueError):
+        raise SystemExit('No run %s in the history (%i runs)' %(index, len(history)))
+
+def main(argv):
+    parser = optparse.OptionParser(usage = __doc__.strip().split('\n\n')[-1])
+    parser.add_option('--case', action = 'append', default = [], help = 'only run this case (repeatable)')
+    parser.add_option('--size', action = 'append', type = 'int', default = [], help = 'payload size instead of the case defaults (repeatable)')
+    parser.add_option('--repeat', type = 'int', default = 3, help = 'keep the fastest of this many runs')
+    parser.add_option('--label', default = '', help = 'note stored with the run')
+    parser.add_option('--history', default = HISTORY, help = 'JSON history file')
+    parser.add_option('--no-save', action = 'store_true', default = False, help = 'do not record the run')
+    parser.add_option('--threshold', type = 'float', default = 10.0, help = 'percent slower or bigger that counts as a regression')
+    parser.add_option('--min-seconds', type = 'float', default = 0.001, help = 'ignore time regressions of faster cases')
+    options, args = parser.parse_args(argv)
+    command = args and args.pop(0) or 'run'
+    if command == 'list':
+        for name, sizes, setup in CASES:
+            print "%-18s %s" %(name, ', '.join([str(size) for size in sizes]))
+    elif command == 'run':
+        unknown = set(options.case) - set([name for name, sizes, setup in CASES])
+        if unknown:
+            parser.error('Unknown case: %s' % ', '.join(sorted(unknown)))
+        results = run_cases(options.case, options.size, options.repeat)
+        if not options.no_save:
+            history = load_history(options.history)
+            history.append({
+                'time': datetime.datetime.now().isoformat(),
+                'commit': git_commit(),
+                'python': platform.python_version(),
+                'label': options.label,
+                'results': results,
+            })
+            save_history(options.history, history)
+            print "Recorded run %i in %s" %(len(history) - 1, options.history)
+    elif command == 'compare':
+        history = load_history(options.history)
+        base = _entry(history, args and args[0] or -2)
+        head = _entry(history, len(args) > 1 and args[1] or -1)
+        regressions = compare(base, head, options.threshold, options.min_seconds)
+        if regressions:
+            print "%i regression(s) beyond %g%%" %(len(regressions), options.threshold)
+            return 1
+        print "No regressions beyond %g%%" % options.threshold
+    else:
+        parser.error('Unknown command: %s' % command)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -5,7 +5,7 @@ try:
     del pychargify
 except:
     raise ImportError("You must install pychargify: http://github.com/getyouridx/pychargify")
-from pychargify.api import Chargify
+from pychargify.api import Chargify, RetryPolicy, RateLimiter, FileBackend, ValidatorCache, CatalogCache, LocalCache, DjangoCache
 
 CHARGIFY_SUBDOMAIN = getattr(settings, "CHARGIFY_SUBDOMAIN", None)
 if CHARGIFY_SUBDOMAIN is None:
@@ -16,7 +16,68 @@ if CHARGIFY_API_KEY is None:
     raise ValueError(missing %('CHARGIFY_API_KEY'))
 del missing
 
-CHARGIFY = Chargify(CHARGIFY_API_KEY, CHARGIFY_SUBDOMAIN)
+# Wire format used to talk to chargify: 'xml' or 'json'
+CHARGIFY_FORMAT = getattr(settings, 'CHARGIFY_FORMAT', 'xml')
+
+# How many times transient failures are retried, 0 disables retrying
+CHARGIFY_MAX_RETRIES = getattr(settings, 'CHARGIFY_MAX_RETRIES', 0)
+if CHARGIFY_MAX_RETRIES:
+    CHARGIFY_RETRY = RetryPolicy(CHARGIFY_MAX_RETRIES)
+else:
+    CHARGIFY_RETRY = None
+
+# Requests per second allowed against the subdomain, None for no limit.
+# Set CHARGIFY_RATE_LIMIT_DIR to share the budget between the processes of a host.
+CHARGIFY_RATE_LIMIT = getattr(settings, 'CHARGIFY_RATE_LIMIT', None)
+CHARGIFY_RATE_LIMIT_DIR = getattr(settings, 'CHARGIFY_RATE_LIMIT_DIR', None)
+if CHARGIFY_RATE_LIMIT:
+    if CHARGIFY_RATE_LIMIT_DIR:
+        CHARGIFY_RATE_LIMITER = RateLimiter(CHARGIFY_RATE_LIMIT, backend = FileBackend(CHARGIFY_RATE_LIMIT_DIR))
+    else:
+        CHARGIFY_RATE_LIMITER = RateLimiter(CHARGIFY_RATE_LIMIT)
+else:
+    CHARGIFY_RATE_LIMITER = None
+
+# Memory budget for remembering ETag/Last-Modified validated responses, 0 disables it
+CHARGIFY_HTTP_CACHE_BYTES = getattr(settings, 'CHARGIFY_HTTP_CACHE_BYTES', 0)
+if CHARGIFY_HTTP_CACHE_BYTES:
+    CHARGIFY_HTTP_CACHE = ValidatorCache(CHARGIFY_HTTP_CACHE_BYTES)
+else:
+    CHARGIFY_HTTP_CACHE = None
+
+# Seconds product lookups are cached for, 0 disables caching.  Set
+# CHARGIFY_CATALOG_CACHE_ALIAS to keep them in one of the CACHES instead of
+# in process memory.
+CHARGIFY_CATALOG_CACHE_TTL = getattr(settings, 'CHARGIFY_CATALOG_CACHE_TTL', 0)
+CHARGIFY_CATALOG_CACHE_ALIAS = getattr(settings, 'CHARGIFY_CATALOG_CACHE_ALIAS', None)
+if CHARGIFY_CATALOG_CACHE_TTL:
+    if CHARGIFY_CATALOG_CACHE_ALIAS:
+        CHARGIFY_CATALOG_CACHE = CatalogCache(DjangoCache(CHARGIFY_CATALOG_CACHE_ALIAS), CHARGIFY_CATALOG_CACHE_TTL)
+    else:
+        CHARGIFY_CATALOG_CACHE = CatalogCache(LocalCache(), CHARGIFY_CATALOG_CACHE_TTL)
+else:
+    CHARGIFY_CATALOG_CACHE = None
+
+# Request and response bodies are logged to "pychargify.api" at level 5 (TRACE),
+# cut to CHARGIFY_LOG_BODY_BYTES (None for whole bodies) for a
+# CHARGIFY_LOG_SAMPLE_RATE fraction of the requests
+from pychargify.api import request_log
+request_log.max_bytes = getattr(settings, 'CHARGIFY_LOG_BODY_BYTES', request_log.max_bytes)
+request_log.sample_rate = getattr(settings, 'CHARGIFY_LOG_SAMPLE_RATE', request_log.sample_rate)
+
+# Host (and port) of the API instead of <subdomain>.chargify.com, e.g. a local
+# pychargify.fakeserver with CHARGIFY_SCHEME = 'http'
+CHARGIFY_BASE_HOST = getattr(settings, 'CHARGIFY_BASE_HOST', None)
+CHARGIFY_SCHEME = getattr(settings, 'CHARGIFY_SCHEME', 'https')
+
+CHARGIFY = Chargify(CHARGIFY_API_KEY, CHARGIFY_SUBDOMAIN, format = CHARGIFY_FORMAT,
+                    retry = CHARGIFY_RETRY, rate_limiter = CHARGIFY_RATE_LIMITER,
+                    http_cache = CHARGIFY_HTTP_CACHE, catalog_cache = CHARGIFY_CATALOG_CACHE,
+                    base_host = CHARGIFY_BASE_HOST, scheme = CHARGIFY_SCHEME)
+
+# Objects matched to their rows and written per transaction by the bulk
+# upsert of reload_all and the sync engine
+CHARGIFY_SYNC_BATCH_SIZE = getattr(settings, 'CHARGIFY_SYNC_BATCH_SIZE', 200)
 
 DEFAULT_CHARGIFY_CC_TYPES = (
          ('Visa', 'Visa'),
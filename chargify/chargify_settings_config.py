@@ -1,5 +1,17 @@
 CHARGIFY_SUBDOMAIN = "your default subdomain on chargify"
 CHARGIFY_API_KEY = "your chargify api key"
+CHARGIFY_FORMAT = "xml" # or "json"
+CHARGIFY_MAX_RETRIES = 3
+CHARGIFY_RATE_LIMIT = 10 # requests per second
+CHARGIFY_RATE_LIMIT_DIR = "/var/tmp/chargify-ratelimit"
+CHARGIFY_HTTP_CACHE_BYTES = 8 * 1024 * 1024
+CHARGIFY_CATALOG_CACHE_TTL = 3600
+CHARGIFY_CATALOG_CACHE_ALIAS = "default"
+CHARGIFY_BASE_HOST = None # e.g. "127.0.0.1:8000" for a local fake server
+CHARGIFY_SCHEME = "https"
+CHARGIFY_LOG_BODY_BYTES = 2048
+CHARGIFY_LOG_SAMPLE_RATE = 1.0
+CHARGIFY_SYNC_BATCH_SIZE = 200
 
 CHARGIFY_CC_TYPES = (
          ('Visa', 'Visa'),
@@ -0,0 +1,230 @@
+"""
+Sync customers, subscriptions and products from chargify into the models.
+
+By default only the records changed since the last run are fetched (see
+chargify.sync.SyncEngine).  With --concurrency above 1 everything is
+reloaded by that many worker processes instead (chargify.sync.ParallelSync).
+A progress line is written to stderr and a JSON summary of the run to
+stdout, or to --summary, for cron jobs to keep and compare.
+"""
+from chargify.models import ChargifyBaseModel, Product, Customer, Subscription, SyncLease, atomic
+from chargify.pychargify.dates import parse_datetime
+from chargify.sync import DEFAULT_PAGE_SIZE, SyncEngine, ParallelSync
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from optparse import make_option
+import datetime
+import json
+import time
+
+RESOURCES = ('products', 'customers', 'subscriptions')
+MODELS = {'products': Product, 'customers': Customer, 'subscriptions': Subscription}
+
+class DryRun(Exception):
+    """ Rolls back the transaction of a dry run """
+    pass
+
+def parse_since(value):
+    """ A timezone aware datetime from an ISO-8601 timestamp or a date,
+    which is midnight in the default time zone """
+    try:
+        date = datetime.datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        try:
+            return parse_datetime(value)
+        except ValueError:
+            raise CommandError('--since is not a date or ISO-8601 timestamp: %s' %(value))
+    return timezone.make_aware(date, timezone.get_default_timezone())
+
+def format_seconds(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%i:%02i:%02i' %(hours, minutes, seconds)
+
+class Progress(object):
+    """ Writes the records and API calls per second of the resource being
+    synced to `stream`, and the time left when the number of records is
+    known.  `live` rewrites a single line, otherwise a line is written
+    every `interval` seconds. """
+    def __init__(self, stream, live = True, interval = 0.5):
+        self.stream = stream
+        self.live = live
+        self.interval = interval
+        self.requests = 0
+        self.width = 0
+        self.last = 0
+    
+    def request(self, info):
+        """ A post-response hook counting the API calls of this process """
+        self.requests += 1
+    
+    def start(self, resource, expected = None):
+        self.resource = resource
+        self.expected = expected
+        self.started = time.time()
+        self.start_requests = self.requests
+        self.last = 0
+    
+    def __call__(self, resource, stats, force = False):
+        now = time.time()
+        if not force and now - self.last < self.interval:
+            return
+        self.last = now
+        elapsed = max(now - self.started, 1e-6)
+        fetched = stats.get('fetched', 0)
+        # Forked workers make their calls out of sight, one per page at least
+        requests = max(self.requests - self.start_requests, stats.get('pages', 0))
+        rate = fetched / elapsed
+        if self.expected and rate and fetched < self.expected:
+            eta = format_seconds((self.expected - fetched) / rate)
+        elif self.expected:
+            eta = format_seconds(0)
+        else:
+            eta = '?'
+        total = self.expected and '/%i' % self.expected or ''
+        line = '%s: %i%s records  %.1f records/s  %.1f API calls/s  ETA %s' %(
+            resource, fetched, total, rate, requests / elapsed, eta)
+        if self.live:
+            self.stream.write('\r' + line.ljust(self.width), style_func = str, ending = '')
+            self.width = len(line)
+        else:
+            self.stream.write(line, style_func = str)
+        self.stream.flush()
+    
+    def finish(self):
+        if self.live and self.width:
+            self.stream.write('', style_func = str)
+        self.width = 0
+
+class Command(BaseCommand):
+    args = '[%s ...]' % ' | '.join(RESOURCES)
+    help = 'Sync records from chargify into the database, all resources unless some are named'
+    option_list = BaseCommand.option_list + (
+        make_option('--since', dest = 'since', default = None,
+            help = 'Fetch the records changed since this date or ISO-8601 timestamp instead of since the last run'),
+        make_option('--resume', action = 'store_true', dest = 'resume', default = False,
+            help = 'Continue an interrupted run where it stopped instead of starting it over'),
+        make_option('--dry-run', action = 'store_true', dest = 'dry_run', default = False,
+            help = 'Fetch and match everything but roll back all database changes'),
+        make_option('--concurrency', type = 'int', dest = 'concurrency', default = 1,
+            help = 'Reload everything with this many worker processes'),
+        make_option('--run', dest = 'run', default = None,
+            help = 'Name of a parallel run, hosts given the same name share its partitions'),
+        make_option('--page-size', type = 'int', dest = 'page_size', default = DEFAULT_PAGE_SIZE,
+            help = 'Records fetched per request'),
+        make_option('--summary', dest = 'summary', default = None,
+            help = 'Write the JSON summary to this file instead of stdout'),
+    )
+    
+    def handle(self, *args, **options):
+        resources = args or RESOURCES
+        unknown = set(resources) - set(RESOURCES)
+        if unknown:
+            raise CommandError('Unknown resource: %s' % ', '.join(sorted(unknown)))
+        resources = [name for name in RESOURCES if name in resources]
+        since = options['since'] and parse_since(options['since']) or None
+        concurrency = options['concurrency']
+        if concurrency < 1:
+            raise CommandError('--concurrency must be at least 1')
+        if since is not None and concurrency > 1:
+            raise CommandError('--since selects an incremental sync, --concurrency a full reload')
+        
+        verbosity = int(options.get('verbosity', 1))
+        live = hasattr(self.stderr, 'isatty') and self.stderr.isatty()
+        progress = Progress(self.stderr, live, live and 0.5 or 10)
+        gateway = ChargifyBaseModel.gateway
+        gateway.add_hooks(post_response = progress.request)
+        
+        summary = {
+            'mode': concurrency > 1 and 'parallel' or 'incremental',
+            'resources': {},
+            'dry_run': options['dry_run'],
+            'since': since and since.isoformat() or None,
+            'started_at': timezone.now().isoformat(),
+            'status': 'ok',
+        }
+        started = time.time()
+        error = None
+        try:
+            try:
+                if options['dry_run']:
+                    with atomic():
+                        self.sync(resources, since, options, gateway, progress, verbosity, summary)
+                        raise DryRun()
+                else:
+                    self.sync(resources, since, options, gateway, progress, verbosity, summary)
+            except DryRun:
+                pass
+            except (KeyboardInterrupt, Exception), e:
+                summary['status'] = 'failed'
+                summary['error'] = '%s: %s' %(e.__class__.__name__, e)
+                error = e
+        finally:
+            progress.finish()
+            gateway.remove_hooks(post_response = progress.request)
+        summary['finished_at'] = timezone.now().isoformat()
+        summary['seconds'] = time.time() - started
+        summary['requests'] = progress.requests
+        self.write_summary(summary, options['summary'])
+        if error is not None:
+            raise CommandError('Sync failed: %s' % summary['error'])
+    
+    def sync(self, resources, since, options, gateway, progress, verbosity, summary):
+        # Progress lines are only written to a file (say from cron) when asked for
+        if verbosity > 1 or (verbosity > 0 and progress.live):
+            callback = progress
+        else:
+            callback = None
+        
+        if options['concurrency'] > 1:
+            run = options['run']
+            if run is None and options['resume']:
+                unfinished = SyncLease.objects.filter(finished_at__isnull = True).order_by('-started_at')
+                if unfinished:
+                    run = unfinished[0].run
+            # A dry run has to stay in this process's transaction
+            processes = not options['dry_run'] and options['concurrency'] or 0
+            coordinator = ParallelSync(run, partitions = options['concurrency'], processes = processes,
+                                       gateway = gateway, page_size = options['page_size'])
+            summary['run'] = coordinator.run_name
+            for name in resources:
+                # A full reload should find about as many records as the last one
+                progress.start(name, MODELS[name].objects.count() or None)
+                coordinator.progress = callback
+                coordinator.resources = [name]
+                report = coordinator.run()
+                if callback is not None:
+                    callback(name, report['resources'].get(name, {}), True)
+                progress.finish()
+            summary['resources'] = report['resources']
+            summary['workers'] = report['workers']
+            summary['errors'] = report['errors']
+            if report['errors'] and [resource for resource in report['resources'].values() if resource['unfinished']]:
+                raise CommandError('%i partition(s) could not be synced' % len(report['errors']))
+            return
+        
+        engine = SyncEngine(gateway, options['page_size'])
+        engine.progress = callback
+        for name in resources:
+            progress.start(name)
+            if name == 'products':
+                # Products have no change listing, there are few of them
+                stats = Product.objects.reload_all(batch_size = options['page_size'])
+                stats['fetched'] = stats['created'] + stats['updated'] + stats['unchanged']
+            else:
+                stats = engine.sync(name, since, options['resume'])
+            if callback is not None:
+                callback(name, stats, True)
+            progress.finish()
+            summary['resources'][name] = stats
+    
+    def write_summary(self, summary, path):
+        text = json.dumps(summary, indent = 1, sort_keys = True, default = str)
+        if path:
+            f = open(path, 'w')
+            try:
+                f.write(text + '\n')
+            finally:
+                f.close()
+        else:
+            self.stdout.write(text)
@@ -3,7 +3,6 @@ from django.db import models
 from south.db import db
 from south.v2 import DataMigration
 import datetime
-import traceback
 from django.conf import settings
 
 class Migration(DataMigration):
@@ -11,7 +10,6 @@ class Migration(DataMigration):
     def forwards(self, orm):
         "Write your forwards methods here."
         from chargify.chargify_settings import CHARGIFY
-        from chargify.models import Subscription
         if getattr(settings, "TESTING", None):
             return
         products = {}
@@ -31,11 +29,8 @@ class Migration(DataMigration):
             products[product.handle] = product
             p.save()
         
-        try:
-            Subscription.objects.update_all()
-        except:
-            print 'Failed to import chargify data! Please do so manually'
-            traceback.print_exc()
+        # The models only match the tables once every migration has run
+        print 'Run "manage.py chargify_sync" to import the customers and subscriptions from chargify'
     
     def backwards(self, orm):
         "Write your backwards methods here."
@@ -1,19 +1,162 @@
-from chargify_settings import CHARGIFY, CHARGIFY_CC_TYPES
+from chargify_settings import CHARGIFY, CHARGIFY_CC_TYPES, CHARGIFY_SYNC_BATCH_SIZE
 from decimal import Decimal
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.utils import timezone
 from django.utils.datetime_safe import new_datetime
 from pychargify.api import ChargifyNotFound
+import contextlib
+import itertools
 import logging
+import threading
 import time
-import traceback
 from django.conf import settings
 log = logging.getLogger("chargify")
 #logging.basicConfig(level=logging.DEBUG)
 
+def db_datetime(value):
+    """ Convert a timezone aware datetime from chargify for a DateTimeField,
+    naive in the default time zone unless USE_TZ is on """
+    if value is None:
+        return None
+    value = new_datetime(value)
+    if not getattr(settings, 'USE_TZ', False) and timezone.is_aware(value):
+        value = timezone.make_naive(value, timezone.get_default_timezone())
+    return value
+
 def unique_reference(prefix = ''):
     return '%s%i' %(prefix, time.time()*1000)
 
+def atomic():
+    if hasattr(transaction, 'atomic'):
+        return transaction.atomic()
+    return transaction.commit_on_success()
+
+_local = threading.local()
+
+class UnitOfWork(object):
+    """ An identity map of the Customers and Products resolved while
+    loading subscriptions, with the inserts of the new ones deferred to
+    flush().  Use unit_of_work() to share one for a whole sync, the map of a
+    model is emptied when it outgrows `max_rows`. """
+    def __init__(self, max_rows = 10000):
+        self.max_rows = max_rows
+        self.rows = {}
+        # Ids prefetch found no row for
+        self.absent = set()
+        self.pending = []
+    
+    def _rows(self, model):
+        rows = self.rows.get(model)
+        if rows is None or len(rows) >= self.max_rows:
+            rows = self.rows[model] = {}
+        return rows
+    
+    def get(self, model, chargify_id):
+        """ The row of `model` already resolved for `chargify_id`, or None """
+        return self.rows.get(model, {}).get(int(chargify_id))
+    
+    def prefetch(self, model, chargify_ids):
+        """ Load the rows of `chargify_ids` that are not in the map with one query """
+        known = self.rows.get(model, {})
+        missing = set([int(chargify_id) for chargify_id in chargify_ids]) - set(known)
+        if missing:
+            rows = self._rows(model)
+            for row in model.objects.filter(chargify_id__in = missing):
+                rows[row.chargify_id] = row
+                missing.discard(row.chargify_id)
+            self.absent.update([(model, chargify_id) for chargify_id in missing])
+    
+    def resolve(self, model, api):
+        """ The row of `model` for an api object.  A row missing from the
+        database is loaded from `api` and inserted by the next flush. """
+        chargify_id = int(api.id)
+        row = self.get(model, chargify_id)
+        if row is None:
+            try:
+                if (model, chargify_id) in self.absent:
+                    raise model.DoesNotExist()
+                row = model.objects.get(chargify_id = chargify_id)
+            except model.DoesNotExist:
+                try:
+                    with atomic():
+                        row = model().load(api, commit = False)
+                except IntegrityError:
+                    # Another worker created it (or its user) in the meantime
+                    row = model.objects.get(chargify_id = chargify_id)
+                else:
+                    self.pending.append(row)
+            self.absent.discard((model, chargify_id))
+            self._rows(model)[chargify_id] = row
+        return row
+    
+    def flush(self, rows = ()):
+        """ Insert the rows created since the last flush, then point the
+        foreign keys of `rows` at the inserted rows.  A row that another
+        worker inserted in the meantime is used instead of a second one. """
+        pending, self.pending = self.pending, []
+        by_model = {}
+        for row in pending:
+            by_model.setdefault(type(row), []).append(row)
+        for model, created in by_model.items():
+            try:
+                with atomic():
+                    self._insert(model, created)
+            except IntegrityError:
+                # Another worker inserted some of them in the meantime
+                for row in created:
+                    try:
+                        with atomic():
+                            self._insert(model, [row])
+                    except IntegrityError:
+                        row.pk = model.objects.get(chargify_id = row.chargify_id).pk
+        if pending:
+            for row in rows:
+                for field in row._meta.local_fields:
+                    related = getattr(row, field.get_cache_name(), None) if field.rel else None
+                    if related is not None and getattr(row, field.attname) is None:
+                        setattr(row, field.attname, related.pk)
+
+    def _insert(self, model, rows):
+        if not model.objects.bulk_writes:
+            for row in rows:
+                row.save()
+            return
+        # bulk_create does not set primary keys on every database
+        model.objects.bulk_create(rows)
+        ids = dict(model.objects.filter(chargify_id__in = [row.chargify_id for row in rows]).values_list('chargify_id', 'pk'))
+        for row in rows:
+            row.pk = ids[row.chargify_id]
+
+@contextlib.contextmanager
+def unit_of_work():
+    """ The UnitOfWork of the current thread, a new one for the duration
+    of the block when there is none.  The outermost block flushes it. """
+    work = getattr(_local, 'work', None)
+    if work is not None:
+        yield work
+        return
+    work = _local.work = UnitOfWork()
+    try:
+        yield work
+        work.flush()
+    finally:
+        _local.work = None
+
+def current_work():
+    return getattr(_local, 'work', None)
+
+def resolve(model, api):
+    """ The row of `model` for an api object, loaded from chargify's data
+    when it is missing.  Goes through the current UnitOfWork, if any. """
+    work = current_work()
+    if work is not None:
+        return work.resolve(model, api)
+    try:
+        return model.objects.get(chargify_id = api.id)
+    except model.DoesNotExist:
+        return model().load(api)
+
 class ChargifyBaseModel(object):
     """ You can change the gateway/subdomain used by 
     changing the gateway on an instantiated object """
@@ -43,6 +186,10 @@ class ChargifyBaseModel(object):
             self.save()
 
 class ChargifyBaseManager(models.Manager):
+    # Whether upsert may write rows without calling the model's save(), off
+    # for models whose save() writes more than their own row
+    bulk_writes = True
+    
     def _gateway(self):
         return self.model.gateway
     gateway = property(_gateway)
@@ -78,17 +225,98 @@ class ChargifyBaseManager(models.Manager):
             val.update()
         return val
     
-    def reload_all(self):
+    def _values(self, obj):
+        return dict((field.name, getattr(obj, field.attname)) for field in obj._meta.local_fields)
+    
+    def upsert(self, objs, batch_size = None):
+        """ Create or update the rows of the api objects in `objs`, any
+        iterable.  Every `batch_size` objects are matched to their rows with
+        one query and written in one transaction, rows that did not change
+        are not written at all.  Returns the created, updated and unchanged
+        counts. """
+        batch_size = batch_size or CHARGIFY_SYNC_BATCH_SIZE
+        stats = {'created': 0, 'updated': 0, 'unchanged': 0}
+        objs = iter(objs)
+        with unit_of_work() as work:
+            while True:
+                batch = list(itertools.islice(objs, batch_size))
+                if not batch:
+                    break
+                with atomic():
+                    self._upsert(work, batch, stats)
+        return stats
+    
+    def _existing(self, chargify_ids):
+        return self.filter(chargify_id__in = chargify_ids)
+    
+    def _prefetch(self, work, objs):
+        """ Load the rows a batch of api objects refers to into `work` """
+        pass
+    
+    def _upsert(self, work, objs, stats):
+        # The last copy of an object listed twice wins
+        latest = {}
+        for obj in objs:
+            latest[int(obj.id)] = obj
+        existing = dict((row.chargify_id, row) for row in self._existing(latest.keys()))
+        self._prefetch(work, latest.values())
+        loaded = []
+        for chargify_id, obj in sorted(latest.items()):
+            row = existing.get(chargify_id)
+            if row is None:
+                loaded.append((self.model().load(obj, commit = False), None))
+            else:
+                before = self._values(row)
+                loaded.append((row.load(obj, commit = False), before))
+        # Related rows created by the loads are inserted first
+        work.flush([row for row, before in loaded])
+        
+        created = []
+        updated = []
+        changed_fields = set()
+        for row, before in loaded:
+            if before is None:
+                created.append(row)
+                continue
+            after = self._values(row)
+            changed = [name for name, value in after.items() if before[name] != value]
+            if not changed:
+                stats['unchanged'] += 1
+                continue
+            updated.append((row, dict((name, after[name]) for name in changed)))
+            changed_fields.update(changed)
+        
+        if not self.bulk_writes:
+            for row in created:
+                row.save()
+            for row, changed in updated:
+                row.save()
+        else:
+            self.bulk_create(created)
+            if hasattr(self, 'bulk_update'):
+                self.bulk_update([row for row, changed in updated], list(changed_fields))
+            else:
+                for row, changed in updated:
+                    self.filter(pk = row.pk).update(**changed)
+        stats['created'] += len(created)
+        stats['updated'] += len(updated)
+    
+    def reload_all(self, prefetch = 0, batch_size = None):
+        """ Load every object from chargify, `prefetch` pages are fetched
+        concurrently when it is set.  Returns the upsert counts. """
         self._check_api()
-        items = self.api.getAll()
-        for item in items:
-            val = self.load_and_update(item.id)
-            val.save()
+        return self.upsert(self.api.iter_all(prefetch = prefetch), batch_size)
 
 class CustomerManager(ChargifyBaseManager):
+    # Customer.save() saves the user too
+    bulk_writes = False
+    
     def _api(self):
         return self.gateway.Customer()
     api = property(_api)
+    
+    def _existing(self, chargify_ids):
+        return self.filter(chargify_id__in = chargify_ids).select_related('user')
 
 class Customer(models.Model, ChargifyBaseModel):
     """ The following are mapped fields:
@@ -191,7 +419,8 @@ class Customer(models.Model, ChargifyBaseModel):
             customer = self
         else:
 #            log.debug('Not loading api')
-            customer = Customer()
+            work = current_work()
+            customer = work and work.get(Customer, api.id) or Customer()
         log.debug('Loading Customer API: %s' %(api))
         customer.chargify_id = int(api.id)
         try:
@@ -209,8 +438,8 @@ class Customer(models.Model, ChargifyBaseModel):
                 user.save()
             customer.user = user
         customer.organization = api.organization
-        customer.chargify_updated_at = api.modified_at
-        customer.chargify_created_at = api.created_at
+        customer.chargify_updated_at = db_datetime(api.modified_at)
+        customer.chargify_created_at = db_datetime(api.created_at)
         if commit:
             customer.save()
         return customer
@@ -236,19 +465,6 @@ class ProductManager(ChargifyBaseManager):
     def _api(self):
         return self.gateway.Product()
     api = property(_api)
-    
-    def reload_all(self):
-        products = {}
-        for product in self.gateway.Product().getAll():
-            try:
-                p, loaded = self.get_or_load(product.id)
-                if not loaded:
-                    p.update()
-                p.save()
-                products[product.handle] = p
-            except:
-                log.error('Failed to load product: %s' %(product))
-                log.error(traceback.format_exc())
 
 class Product(models.Model, ChargifyBaseModel):
     MONTH = 'month'
@@ -293,6 +509,11 @@ class Product(models.Model, ChargifyBaseModel):
         return super(Product, self).save(**kwargs)
     
     def load(self, api, commit=True):
+        if not self.id:
+            work = current_work()
+            known = work and work.get(Product, api.id)
+            if known is not None and known is not self:
+                return known.load(api, commit)
         self.chargify_id = int(api.id)
         self.price_in_cents = api.price_in_cents
         self.name = api.name
@@ -325,6 +546,9 @@ class Product(models.Model, ChargifyBaseModel):
     api = property(_api)
 
 class CreditCardManager(ChargifyBaseManager):
+    # Cards have no chargify_id to read the keys of bulk inserted rows back by
+    bulk_writes = False
+    
     def _api(self):
         return self.gateway.CreditCard()
     api = property(_api)
@@ -398,7 +622,7 @@ class CreditCard(models.Model, ChargifyBaseModel):
         self.masked_card_number = api.masked_card_number
         self.expiration_month = api.expiration_month
         self.expiration_year = api.expiration_year
-        self.credit_type = api.type
+        self.credit_type = getattr(api, 'card_type', None) or api.type
         if commit:
             self.save(save_api = False)
         return self
@@ -437,21 +661,53 @@ class SubscriptionManager(ChargifyBaseManager):
             sub= self.load_and_update(id)
             sub.save()
     
-    def reload_all(self):
-        """ You should only run this when you first install the product!
-        VERY EXPENSIVE!!! """
-        Product.objects.reload_all()
-        for customer in Customer.objects.filter(active=True):
-            subscriptions = self.api.getByCustomerId(str(customer.chargify_id))
-            if not subscriptions:
+    def _prefetch(self, work, objs):
+        work.prefetch(Customer, [obj.customer.id for obj in objs if obj.customer is not None])
+        work.prefetch(Product, [obj.product.id for obj in objs if obj.product is not None])
+    
+    def reload_all(self, prefetch = 0, batch_size = None):
+        """ Load every subscription of the account from the paged
+        /subscriptions listing, creating the customers and products it
+        embeds as needed.  Once the listing was walked to an empty page,
+        active subscriptions it no longer has are disabled if chargify does
+        not find them either.  Returns the upsert counts and the number
+        disabled. """
+        self._check_api()
+        listed = set()
+        # Oldest first, so subscriptions signing up during the walk land on
+        # the last pages rather than shifting the ones not yet listed
+        pager = self.api.iter_all(prefetch = prefetch, sort = 'created_at')
+        # A short page is not taken for the end, the server may cap per_page
+        pager.until_empty = True
+        def subscriptions():
+            for subscription in pager:
+                listed.add(int(subscription.id))
+                yield subscription
+        with unit_of_work():
+            Product.objects.reload_all(prefetch = prefetch, batch_size = batch_size)
+            stats = self.upsert(subscriptions(), batch_size)
+        
+        stats['disabled'] = 0
+        if not pager.complete:
+            log.warning('The subscription listing ended early, not disabling any subscriptions')
+            return stats
+        active = self.filter(active = True, chargify_id__isnull = False).values_list('pk', 'chargify_id')
+        missing = [pk for pk, chargify_id in active.iterator() if chargify_id not in listed]
+        for pk in missing:
+            subscription = self.get(pk = pk)
+            # A subscription deleted during the walk shifts the later ones
+            # back a page, one of them may have been skipped
+            try:
+                self.api.getBySubscriptionId(subscription.chargify_id)
+            except ChargifyNotFound:
+                pass
+            else:
+                log.warning('Subscription %s was skipped by the listing, not disabling it' %(subscription.chargify_id))
                 continue
-            for subscription in subscriptions:
-                try:
-                    sub = self.get(chargify_id = subscription.id)
-                except:
-                    sub = self.model()
-                    sub.load(subscription)
-                sub.save()
+            log.info('Disabling subscription %s, it is no longer in chargify' %(subscription.chargify_id))
+            subscription.disable()
+            stats['disabled'] += 1
+        return stats
 
 class Subscription(models.Model, ChargifyBaseModel):
     TRIALING = 'trialing'
@@ -535,50 +791,58 @@ class Subscription(models.Model, ChargifyBaseModel):
         self.chargify_id = int(api.id)
         self.state = api.state
         self.balance_in_cents = api.balance_in_cents
-        self.current_period_started_at = new_datetime(api.current_period_started_at)
-        self.current_period_ends_at = new_datetime(api.current_period_ends_at)
+        self.current_period_started_at = db_datetime(api.current_period_started_at)
+        self.current_period_ends_at = db_datetime(api.current_period_ends_at)
         if api.trial_started_at:
-            self.trial_started_at = new_datetime(api.trial_started_at)
+            self.trial_started_at = db_datetime(api.trial_started_at)
         else:
             self.trial_started_at = None
         if api.trial_ended_at:
-            self.trial_ended_at = new_datetime(api.trial_ended_at)
+            self.trial_ended_at = db_datetime(api.trial_ended_at)
         else:
             self.trial_ended_at = None
         if api.activated_at:
-            self.activated_at = new_datetime(api.activated_at)
+            self.activated_at = db_datetime(api.activated_at)
         else:
             self.activated_at = None
         if api.expires_at:
-            self.expires_at = new_datetime(api.expires_at)
+            self.expires_at = db_datetime(api.expires_at)
         else:
             self.expires_at = None
-        self.created_at = new_datetime(api.created_at)
-        self.updated_at = new_datetime(api.updated_at)
-        try:
-            c = Customer.objects.get(chargify_id = api.customer.id)
-        except:
-            c = Customer()
-            c.load(api.customer)
-        self.customer = c
+        self.created_at = db_datetime(api.created_at)
+        self.updated_at = db_datetime(api.updated_at)
+        self.customer = resolve(Customer, api.customer)
+        self.product = resolve(Product, api.product)
         
-        try:
-            p = Product.objects.get(chargify_id = api.product.id)
-        except:
-            p = Product()
-            p.load(api.product)
-            p.save()
-        self.product = p
-        
-        if self.credit_card:
-            credit_card = self.credit_card
-        else:
-            credit_card = CreditCard()
-            credit_card.load(api.credit_card)
+        if api.credit_card is not None:
+            self.credit_card = self._load_credit_card(api.credit_card)
         if commit:
+            work = current_work()
+            if work is not None:
+                work.flush([self])
             self.save()
         return self
     
+    def _load_credit_card(self, api):
+        """ The subscription's card loaded from `api`, only written when it
+        is new or changed.  A new card is inserted by the next flush of the
+        current UnitOfWork, if any, ahead of the subscription. """
+        try:
+            credit_card = self.credit_card or CreditCard()
+        except CreditCard.DoesNotExist:
+            credit_card = CreditCard()
+        before = credit_card.pk and CreditCard.objects._values(credit_card)
+        credit_card.load(api, commit = False)
+        if credit_card.pk is None:
+            work = current_work()
+            if work is not None:
+                work.pending.append(credit_card)
+            else:
+                credit_card.save()
+        elif CreditCard.objects._values(credit_card) != before:
+            credit_card.save()
+        return credit_card
+    
     def update(self, commit=True):
         """ Update Subscription data from chargify """
         subscriptions = self.gateway.Subscription().getBySubscriptionId(self.chargify_id)
@@ -607,3 +871,60 @@ class Subscription(models.Model, ChargifyBaseModel):
             subscription.credit_card = self.credit_card._api('credit_card_attributes')
         return subscription
     api = property(_api)
+
+class SyncCheckpoint(models.Model):
+    """ How far the incremental sync (chargify.sync) of one resource got.
+    The records are walked oldest change first, `high_water` is the
+    updated_at of the last one stored and `page` the page of the listing
+    starting at high_water to continue from.  Both are saved with every
+    page, so an interrupted run resumes where it stopped. """
+    resource = models.CharField(max_length=30, unique=True)
+    high_water = models.DateTimeField(null=True, blank=True)
+    page = models.IntegerField(default=1)
+    # The high water mark the current (or last) run started from
+    run_from = models.DateTimeField(null=True, blank=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    # Records stored by the current (or last) run
+    synced = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __unicode__(self):
+        return u'%s: %s' %(self.resource, self.high_water)
+    
+    def _running(self):
+        """ Whether a run started and has not finished (yet) """
+        return self.started_at is not None and self.finished_at is None
+    running = property(_running)
+
+class SyncLease(models.Model):
+    """ One partition of a parallel sync run (chargify.sync.ParallelSync).
+    Partition `partition` of `partitions` covers the records created from
+    `window_start` up to `window_end`, a missing bound leaving the window
+    open at that end.  The worker named `owner` holds it until
+    `leased_until` and renews the lease with every page, together with the
+    creation time `cursor` and `page` to continue from and its `stats`, so a
+    lease that expires is picked up where it stopped by another worker. """
+    run = models.CharField(max_length=50)
+    resource = models.CharField(max_length=30)
+    partition = models.IntegerField()
+    partitions = models.IntegerField()
+    window_start = models.DateTimeField(null=True, blank=True)
+    window_end = models.DateTimeField(null=True, blank=True)
+    cursor = models.DateTimeField(null=True, blank=True)
+    page = models.IntegerField()
+    owner = models.CharField(max_length=100, null=True, blank=True)
+    leased_until = models.DateTimeField(null=True, blank=True)
+    attempts = models.IntegerField(default=0)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    # JSON encoded counters of the partition
+    stats = models.TextField(default='', blank=True)
+    # The traceback of the last failed attempt, cleared once it is finished
+    error = models.TextField(default='', blank=True)
+    
+    class Meta:
+        unique_together = (('run', 'resource', 'partition'),)
+    
+    def __unicode__(self):
+        return u'%s %s %i/%i' %(self.run, self.resource, self.partition + 1, self.partitions)
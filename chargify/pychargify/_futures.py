@@ -0,0 +1,268 @@
+'''
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+A small thread pool and Future behaving like those of the concurrent.futures
+module, which is not available on every Python we support.  They are private
+to pychargify: callers get Futures back but never an executor.
+'''
+
+import sys
+import threading
+import time
+import Queue
+import logging
+
+log = logging.getLogger("pychargify.futures")
+
+PENDING = 'pending'
+RUNNING = 'running'
+CANCELLED = 'cancelled'
+FINISHED = 'finished'
+
+
+class CancelledError(Exception):
+    """
+    The Future was cancelled before it ran
+    """
+    pass
+
+class TimeoutError(Exception):
+    """
+    The Future did not finish in time
+    """
+    pass
+
+
+class Future(object):
+    """
+    The result of a call that runs on another thread
+    """
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._state = PENDING
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def cancel(self):
+        """
+        Cancel the call unless it is running or done, returns whether the
+        future is cancelled
+        """
+        self._condition.acquire()
+        try:
+            if self._state in (RUNNING, FINISHED):
+                return False
+            if self._state == CANCELLED:
+                return True
+            self._state = CANCELLED
+            self._condition.notify_all()
+        finally:
+            self._condition.release()
+        self._run_callbacks()
+        return True
+
+    def cancelled(self):
+        return self._state == CANCELLED
+
+    def running(self):
+        return self._state == RUNNING
+
+    def done(self):
+        return self._state in (CANCELLED, FINISHED)
+
+    def _wait(self, timeout):
+        self._condition.acquire()
+        try:
+            if not self.done():
+                self._condition.wait(timeout)
+            if self._state == CANCELLED:
+                raise CancelledError()
+            if self._state != FINISHED:
+                raise TimeoutError()
+        finally:
+            self._condition.release()
+
+    def result(self, timeout = None):
+        """
+        Wait for the call to finish and return its result, re-raising any
+        exception it raised
+        """
+        self._wait(timeout)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout = None):
+        """
+        Wait for the call to finish and return the exception it raised, or
+        None
+        """
+        self._wait(timeout)
+        if self._exc_info is not None:
+            return self._exc_info[1]
+        return None
+
+    def add_done_callback(self, fn):
+        """
+        Call fn(future) once the future is done, straight away if it already is
+        """
+        self._condition.acquire()
+        try:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+        finally:
+            self._condition.release()
+        self._call_back(fn)
+
+    def set_running_or_notify_cancel(self):
+        """
+        Mark the future running, False if it was cancelled instead
+        """
+        self._condition.acquire()
+        try:
+            if self._state == CANCELLED:
+                return False
+            if self._state != PENDING:
+                raise RuntimeError('Future in unexpected state: %s' %(self._state))
+            self._state = RUNNING
+            return True
+        finally:
+            self._condition.release()
+
+    def _finish(self, result, exc_info):
+        self._condition.acquire()
+        try:
+            self._result = result
+            self._exc_info = exc_info
+            self._state = FINISHED
+            self._condition.notify_all()
+        finally:
+            self._condition.release()
+        self._run_callbacks()
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exception(self, exception):
+        self._finish(None, (type(exception), exception, None))
+
+    def set_exception_info(self, exc_info):
+        self._finish(None, exc_info)
+
+    def _call_back(self, fn):
+        try:
+            fn(self)
+        except:
+            log.exception('Future callback failed')
+
+    def _run_callbacks(self):
+        callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            self._call_back(fn)
+
+
+class ThreadPoolExecutor(object):
+    """
+    Runs submitted calls on up to `max_workers` daemon threads
+    """
+    def __init__(self, max_workers, name = 'pychargify'):
+        if max_workers < 1:
+            raise ValueError('max_workers must be at least 1')
+        self.max_workers = max_workers
+        self.name = name
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._shutdown = False
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                # Wake up the next worker too
+                self._queue.put(None)
+                return
+            future, fn, args, kwargs = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn(*args, **kwargs)
+            except:
+                future.set_exception_info(sys.exc_info())
+            else:
+                future.set_result(result)
+            del item, future, fn, args, kwargs
+
+    def _adjust_threads(self):
+        if len(self._threads) < self.max_workers:
+            thread = threading.Thread(target = self._worker,
+                name = '%s-%i' %(self.name, len(self._threads) + 1))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, fn, *args, **kwargs):
+        self._lock.acquire()
+        try:
+            if self._shutdown:
+                raise RuntimeError('cannot submit after shutdown')
+            future = Future()
+            self._queue.put((future, fn, args, kwargs))
+            self._adjust_threads()
+            return future
+        finally:
+            self._lock.release()
+
+    def map(self, fn, *iterables, **kwargs):
+        """
+        Like map(fn, *iterables) with the calls run concurrently, the results
+        are yielded in order.  Waits at most `timeout` seconds in all.
+        """
+        timeout = kwargs.get('timeout')
+        if timeout is not None:
+            end = time.time() + timeout
+        futures = [self.submit(fn, *args) for args in zip(*iterables)]
+        def results():
+            try:
+                for future in futures:
+                    if timeout is None:
+                        yield future.result()
+                    else:
+                        yield future.result(max(0, end - time.time()))
+            finally:
+                for future in futures:
+                    future.cancel()
+        return results()
+
+    def shutdown(self, wait = True):
+        self._lock.acquire()
+        try:
+            self._shutdown = True
+            self._queue.put(None)
+        finally:
+            self._lock.release()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown(wait = True)
+        return False
@@ -18,11 +18,20 @@ Created on Nov 20, 2009
 Author: Paul Trippett (paul@pyhub.com)
 '''
 
-import httplib
 import base64
 import time
-import datetime
-import iso8601
+import urllib
+import decoder
+import encoder
+import metrics
+from bulk import Bulk
+from paging import Pager, PrefetchPager, DEFAULT_PAGE_SIZE
+from cache import ValidatorCache, CatalogCache, LocalCache, DjangoCache
+from metrics import RequestInfo, MetricsCollector, prometheus_text
+from ratelimit import RateLimiter, LocalBackend, FileBackend
+from requestlog import RequestLogger, TRACE
+from retry import RetryPolicy, IDEMPOTENCY_HEADER
+from transport import HTTPTransport, get_default_transport
 
 try:
     import json
@@ -41,6 +50,11 @@ from xml.dom import minidom
 import logging
 
 log = logging.getLogger("pychargify.api")
+# Logs request and response bodies at TRACE, tune its max_bytes and sample_rate here
+request_log = RequestLogger(log)
+
+# Supported wire formats, each endpoint has a .xml and a .json variant
+FORMATS = ('xml', 'json')
 
 class ChargifyError(Exception):
     """
@@ -68,6 +82,11 @@ class ChargifyError(Exception):
                 s += self._get_node_text(child)
         return s
     def _parse_errors(self, xml):
+        if xml.lstrip()[:1] in ('{', '['):
+            data = json.loads(xml)
+            if isinstance(data, dict):
+                data = data.get('errors', [])
+            return [val for val in data if val and val.strip()]
         dom = minidom.parseString(xml)
         nodes = dom.getElementsByTagName('errors')
         errors = []
@@ -114,136 +133,380 @@ class ChargifyServerError(ChargifyError):
     """
     pass
 
+class ClientContext(object):
+    """
+    The settings shared by every object created from one Chargify entry
+    point, objects decoded from a response refer to the same context
+    """
+    __slots__ = ('api_key', 'sub_domain', 'request_host', 'transport', 'format')
+    
+    def __init__(self, api_key, sub_domain, request_host, transport, format):
+        self.api_key = api_key
+        self.sub_domain = sub_domain
+        self.request_host = request_host
+        self.transport = transport
+        self.format = format
+
+class NodeName(object):
+    """
+    The XML node name of a resource class, which objects may override
+    """
+    def __init__(self, default):
+        self.default = default
+    
+    def __get__(self, obj, cls):
+        if obj is None or obj._nodename is None:
+            return self.default
+        return obj._nodename
+    
+    def __set__(self, obj, value):
+        obj._nodename = value
+
+def _context_property(name):
+    def get(self):
+        return getattr(self._context, name)
+    return property(get)
+
+def _is_json(url):
+    return url.split('?', 1)[0].endswith('.json')
+
+def _changed_since(since, date_field, until = None):
+    """
+    Query parameters listing the records changed since a datetime, and up to
+    `until` (both inclusive), oldest first
+    """
+    if since is None and until is None:
+        return None
+    params = {'date_field': date_field, 'sort': date_field, 'direction': 'asc'}
+    if since is not None:
+        params['start_datetime'] = since.isoformat()
+    if until is not None:
+        params['end_datetime'] = until.isoformat()
+    return params
+
+def _clone(obj):
+    """
+    Copy a decoded object or list of objects
+    """
+    if isinstance(obj, list):
+        return [item._clone() for item in obj]
+    return obj._clone()
+
 class ChargifyBase(object):
     """
     The ChargifyBase class provides a common base for all classes in this module
     @license    GNU General Public License
     """
-    __ignore__ = ['api_key', 'sub_domain', 'base_host', 'request_host', 'id', '__xmlnodename__']
+    __ignore__ = ['api_key', 'sub_domain', 'base_host', 'request_host', 'transport', 'format', 'idempotency_key', 'id', '__xmlnodename__']
+    # Field name to type: a scalar type ('string', 'integer', 'boolean',
+    # 'datetime') or the class name of a nested object.  The decoders are
+    # compiled from it by decoder.compile_schema when the module is imported.
+    __fields__ = {}
+    # Objects keep their fields in slots.  A field that was never set reads
+    # as its default from __defaults__ and is left out when the object is
+    # saved.  Values for names without a slot are kept in _extra.
+    __slots__ = ('_context', '_nodename', '_extra', 'idempotency_key', 'saved')
+    # Names set as attributes besides the fields.  Any other name goes to
+    # _extra, even one shadowing a method or client setting such as `format`
+    __own_attributes__ = frozenset(__slots__ + ('__xmlnodename__',))
+    __defaults__ = {
+        '_nodename': None,
+        '_extra': None,
+        # Sent as the Idempotency-Key header so a failed POST may be retried
+        'idempotency_key': None,
+    }
+    __field_names__ = ()
     
-    api_key = ''
-    sub_domain = ''
     base_host = '.chargify.com'
-    request_host = ''
+    api_key = _context_property('api_key')
+    sub_domain = _context_property('sub_domain')
+    request_host = _context_property('request_host')
+    transport = _context_property('transport')
+    format = _context_property('format')
     
-    def __init__(self, apikey, subdomain):
+    def __init__(self, apikey, subdomain, transport = None, format = 'xml', base_host = None):
         """
-        Initialize the Class with the API Key and SubDomain for Requests to the Chargify API
+        Initialize the Class with the API Key and SubDomain for Requests to the Chargify API.
+        A `base_host` starting with a dot is appended to the subdomain, any
+        other value is the complete host (e.g. 'localhost:8000').
         """
-        self.api_key = apikey
-        self.sub_domain = subdomain
-        self.request_host = self.sub_domain + self.base_host
+        if transport is None:
+            transport = get_default_transport()
+        if format not in FORMATS:
+            raise ValueError('Unsupported format: %s' %(format))
+        if base_host is None:
+            base_host = self.base_host
+        if base_host.startswith('.'):
+            request_host = subdomain + base_host
+        else:
+            request_host = base_host
+        self._context = ClientContext(apikey, subdomain, request_host, transport, format)
+    
+    def __getattr__(self, name):
+        defaults = self.__defaults__
+        if name in defaults:
+            return defaults[name]
+        extra = self._extra
+        if extra and name in extra:
+            return extra[name]
+        raise AttributeError(name)
     
-    def __get_xml_value(self, nodelist):
+    def __setattr__(self, name, value):
+        if name in self.__field_names__ or name in self.__own_attributes__:
+            object.__setattr__(self, name, value)
+            return
+        if self._extra is None:
+            object.__setattr__(self, '_extra', {})
+        self._extra[name] = value
+    
+    def _fields(self):
         """
-        Get the Text Value from an XML Node
+        Yield the (name, value) of every field that has been set
         """
-        rc = ""
-        for node in nodelist:
-            if node.nodeType == node.TEXT_NODE:
-                rc = rc + node.data
-        return rc
+        for name in self.__field_names__:
+            try:
+                yield name, object.__getattribute__(self, name)
+            except AttributeError:
+                pass
+        if self._extra:
+            for item in self._extra.iteritems():
+                yield item
     
-    def __get_object_from_node(self, node, obj_type = ''):
+    def _new_object(self, obj_type = ''):
         """
-        Copy values from a node into a new Object
+        Create an empty object of the named type sharing this object's settings
         """
         if obj_type == '':
-            constructor = globals()[self.__name__]
+            cls = globals()[self.__name__]
         else:
-            constructor = globals()[obj_type]
-        obj = constructor(self.api_key, self.sub_domain)
-        
-        for childnodes in node.childNodes:
-            if childnodes.nodeType == 1 and not childnodes.nodeName == '':
-                if childnodes.nodeName in self.__attribute_types__:
-                    obj.__setattr__(childnodes.nodeName, self._applyS(childnodes.toxml(), self.__attribute_types__[childnodes.nodeName], childnodes.nodeName))
-                else:
-                    node_value = self.__get_xml_value(childnodes.childNodes)
-                    if "type" in  childnodes.attributes.keys():
-                        node_type = childnodes.attributes["type"]
-                        if node_value:
-                            if node_type.nodeValue == 'datetime':
-                                node_value = datetime.datetime.fromtimestamp(iso8601.parse(node_value))
-                    obj.__setattr__(childnodes.nodeName, node_value)
-        
+            cls = globals()[obj_type]
+        obj = cls.__new__(cls)
+        object.__setattr__(obj, '_context', self._context)
         return obj
     
     def _applyS(self, xml, obj_type, node_name):
         """
         Apply the values of the passed xml data to the a class
         """
-        dom = minidom.parseString(xml)
-        nodes = dom.getElementsByTagName(node_name)
-        if nodes.length == 1:
-            return self.__get_object_from_node(nodes[0], obj_type)
+        return decoder.decode_single(xml, node_name, self._new_object, obj_type)
         
     def _applyA(self, xml, obj_type, node_name):
         """
         Apply the values of the passed data to a new class of the current type
         """
-        dom = minidom.parseString(xml)
-        nodes = dom.getElementsByTagName(node_name)
-        objs = []
-        for node in nodes:
-            objs.append(self.__get_object_from_node(node, obj_type))
-        return objs
+        return decoder.decode_list(xml, node_name, self._new_object, obj_type)
+    
+    def _url(self, path):
+        """
+        Add the extension for the wire format to an API path
+        """
+        return path + '.' + self.format
+    
+    def _decodeS(self, data, obj_type, node_name):
+        """
+        Decode a single object from a response in the wire format
+        """
+        if self.format == 'json':
+            return decoder.decode_json_single(data, node_name, self._new_object, obj_type)
+        return self._applyS(data, obj_type, node_name)
+    
+    def _decodeA(self, data, obj_type, node_name):
+        """
+        Decode a list of objects from a response in the wire format
+        """
+        if self.format == 'json':
+            return decoder.decode_json_list(data, node_name, self._new_object, obj_type)
+        return self._applyA(data, obj_type, node_name)
     
-    def _toxml(self, dom):
+    def _page(self, path, obj_type, node_name, page, per_page, params = None):
         """
-        Return a XML Representation of the object
+        Fetch a single page of a paged listing endpoint
         """
-        element = minidom.Element(self.__xmlnodename__)
-        for property, value in self.__dict__.iteritems():
+        query = dict(params or {})
+        query.update({'page': page, 'per_page': per_page})
+        url = self._url(path) + '?' + urllib.urlencode(sorted(query.items()))
+        return self._fetch(url, obj_type, node_name, many = True)
+    
+    def _pager(self, path, obj_type, node_name, page_size, start_page, prefetch = 0, params = None):
+        """
+        Return a Pager lazily walking a paged listing endpoint, fetching
+        `prefetch` pages ahead on a thread pool when it is set
+        """
+        def fetch(page, per_page):
+            return self._page(path, obj_type, node_name, page, per_page, params)
+        if prefetch:
+            return PrefetchPager(fetch, page_size, start_page, prefetch)
+        return Pager(fetch, page_size, start_page)
+    
+    def _todict(self):
+        """
+        Return a (name, dict) JSON Representation of the object
+        """
+        data = {}
+        for property, value in self._fields():
             if not property in self.__ignore__:
-                if property in self.__attribute_types__:
-                    element.appendChild(value._toxml(dom))
+                if isinstance(value, ChargifyBase):
+                    name, value = value._todict()
+                    data[name] = value
                 else:
-                    node = minidom.Element(property)
-                    node_txt = dom.createTextNode(str(value))
-                    node.appendChild(node_txt)
-                    element.appendChild(node)
-        return element
+                    data[property] = encoder.to_json(value)
+        return self.__xmlnodename__, data
     
-    def _get(self, url):
+    def _encode(self):
         """
-        Handle HTTP GET's to the API
+        Return the request body for saving the object in the wire format
+        """
+        if self.format == 'json':
+            name, data = self._todict()
+            return json.dumps({name: data})
+        return encoder.XML_DECLARATION + ''.join(self._iterxml())
+    
+    def _iterxml(self):
+        """
+        Yield the XML Representation of the object in chunks
+        """
+        fields = [(name, value) for name, value in self._fields() if name not in self.__ignore__]
+        return encoder.iterelement(self.__xmlnodename__, fields)
+    
+    def _send(self, method, url, body, headers, deferred = False):
+        """
+        Send a request through the transport and return its Response.  With
+        hooks on the transport the request is timed and described by a
+        RequestInfo; `deferred` leaves calling the post-response hooks to
+        the caller, which finds the info on response.info and the hooks on
+        response.hooks.
+        """
+        transport = self.transport
+        logged = request_log.enabled()
+        if logged:
+            request_log.request(method, url, body)
+        hooks = transport.hooks
+        if hooks is None:
+            response = transport.request(self.request_host, method, url, body, headers)
+            if logged:
+                request_log.response(method, url, response.status, response.body)
+            return response
+        info = RequestInfo(method, url, body)
+        hooks.pre_request(info)
+        start = metrics.clock()
+        try:
+            response = transport.request(self.request_host, method, url, body, headers, info)
+        except Exception, e:
+            info.total = metrics.clock() - start
+            info.error = e
+            hooks.post_response(info)
+            raise
+        info.total = metrics.clock() - start
+        if logged:
+            request_log.response(method, url, response.status, response.body)
+        info.status = response.status
+        info.response_bytes = len(response.body or '')
+        if deferred:
+            response.info = info
+            response.hooks = hooks
+        else:
+            hooks.post_response(info)
+        return response
+    
+    def _get_response(self, url, extra_headers = None, deferred = False):
+        """
+        Send an HTTP GET to the API and return the transport's Response
         """
         headers = {
             "Authorization": "Basic %s" % self._get_auth_string(),
             "User-Agent": "pyChargify",
             "Content-Type": "text/xml"
         }
-        r = httplib.HTTPSConnection(self.request_host)
-        r.request('GET', url, None, headers)
-        response = r.getresponse()
-        
-        val = None
-        try:
-            val = response.read()
-        except:
-            pass
-        # Unauthorized Error
-        if response.status == 401:
-            raise ChargifyUnAuthorized(val)
-        
-        # Forbidden Error
-        elif response.status == 403:
-            raise ChargifyForbidden(val)
-        
-        # Not Found Error
-        elif response.status == 404:
-            raise ChargifyNotFound(val)
-        
-        # Unprocessable Entity Error
-        elif response.status == 422:
-            raise ChargifyUnProcessableEntity(val)
-        
-        # Generic Server Errors
-        elif response.status in [405, 500]:
-            raise ChargifyServerError(val)
-        
+        if _is_json(url):
+            headers["Content-Type"] = "application/json"
+            headers["Accept"] = "application/json"
+        if extra_headers:
+            headers.update(extra_headers)
+        return self._send('GET', url, None, headers, deferred)
+    
+    def _get(self, url):
+        """
+        Handle HTTP GET's to the API
+        """
+        response = self._get_response(url)
+        val = response.body
+        self._raise_for_status(response.status, val)
         return val
+    
+    def _fetch(self, url, obj_type, node_name, many = False):
+        """
+        GET and decode `url`.  With a validator cache on the transport the
+        request is made conditional and a 304 answer returns a copy of the
+        previously decoded object(s) without parsing anything.
+        """
+        cache = self.transport.http_cache
+        entry = None
+        if cache is not None:
+            key = (self.request_host, url)
+            entry = cache.lookup(key)
+        response = self._get_response(url, entry and entry.conditional_headers(), deferred = True)
+        info = response.info
+        try:
+            if cache is not None:
+                if response.status == 304 and entry is not None:
+                    cache.hit()
+                    return _clone(entry.obj)
+                cache.miss()
+            data = response.body
+            self._raise_for_status(response.status, data)
+            if info is not None:
+                start = metrics.clock()
+            if many:
+                obj = self._decodeA(data, obj_type, node_name)
+            else:
+                obj = self._decodeS(data, obj_type, node_name)
+            if info is not None:
+                info.decode = metrics.clock() - start
+        finally:
+            # The hooks the request started with, they may have been removed since
+            if info is not None:
+                response.hooks.post_response(info)
+        if cache is not None and obj is not None:
+            cache.store(key, response.getheader('etag'), response.getheader('last-modified'),
+                        _clone(obj), len(data or ''))
+        return obj
+    
+    def _clone(self):
+        """
+        Copy the object and the resource objects nested in it
+        """
+        obj = self._new_object()
+        obj._nodename = self._nodename
+        for name, value in self._fields():
+            if isinstance(value, ChargifyBase):
+                value = value._clone()
+            setattr(obj, name, value)
+        return obj
+    
+    def _state(self):
+        """
+        Return the decoded fields as plain (picklable) data, without the
+        client settings, nested objects become (type name, state) tuples
+        """
+        state = {}
+        if self._nodename is not None:
+            state['__xmlnodename__'] = self._nodename
+        for name, value in self._fields():
+            if isinstance(value, ChargifyBase):
+                value = (value.__name__, value._state())
+            state[name] = value
+        return state
+    
+    def _restore(self, state):
+        """
+        Return a new object sharing this object's settings built from _state()
+        """
+        obj = self._new_object()
+        for name, value in state.iteritems():
+            if name in self.__attribute_types__ and isinstance(value, tuple):
+                value = obj._new_object(value[0])._restore(value[1])
+            setattr(obj, name, value)
+        return obj
         
     def _post(self, url, data):
         """
@@ -267,77 +530,74 @@ class ChargifyBase(object):
         """
         Handled the request and sends it to the server
         """
-        log.log(5, "Sending XML: %s" %(data))
-        http = httplib.HTTPSConnection(self.request_host)
-        
-        http.putrequest(method, url)
-        http.putheader("Authorization", "Basic %s" % self._get_auth_string())
-        http.putheader("User-Agent", "pychargify")
-        http.putheader("Host", self.request_host)
-        http.putheader("Accept", "application/xml")
-        http.putheader("Content-Length", str(len(data)))
-        http.putheader("Content-Type", 'text/xml; charset="UTF-8"')
-        http.endheaders()
-
-        http.send(data)
-        response = http.getresponse()
-        val = ''
-        try:
-            val = response.read()
-            log.log(5, "Server Response: %s" %(val))
-        except:
-            pass
-        
+        val = self._request_response(method, url, data).body
+        if val is None:
+            val = ''
+        return val
+    
+    def _request_response(self, method, url, data = ''):
+        """
+        Send a request with a body and return the transport's Response,
+        raising the matching ChargifyError for an error status
+        """
+        headers = {
+            "Authorization": "Basic %s" % self._get_auth_string(),
+            "User-Agent": "pychargify",
+            "Host": self.request_host,
+            "Accept": "application/xml",
+            "Content-Length": str(len(data)),
+            "Content-Type": 'text/xml; charset="UTF-8"'
+        }
+        if _is_json(url):
+            headers["Accept"] = "application/json"
+            headers["Content-Type"] = 'application/json; charset="UTF-8"'
+        if self.idempotency_key:
+            headers[IDEMPOTENCY_HEADER] = str(self.idempotency_key)
+        response = self._send(method, url, data, headers)
+        self._raise_for_status(response.status, response.body or '')
+        return response
+    
+    def _raise_for_status(self, status, val):
+        """
+        Raise the matching ChargifyError for an error response
+        """
         # Unauthorized Error
-        if response.status == 401:
+        if status == 401:
             raise ChargifyUnAuthorized(val)
         
         # Forbidden Error
-        elif response.status == 403:
+        elif status == 403:
             raise ChargifyForbidden(val)
         
         # Not Found Error
-        elif response.status == 404:
+        elif status == 404:
             raise ChargifyNotFound(val)
         
         # Unprocessable Entity Error
-        elif response.status == 422:
+        elif status == 422:
             raise ChargifyUnProcessableEntity(val)
         
         # Generic Server Errors
-        elif response.status in [405, 500]:
+        elif status in [405, 429] or status >= 500:
             raise ChargifyServerError(val)
-        return val
     
     def _save(self, url, node_name):
         """
         Save the object using the passed URL as the API end point
         """
-        dom = minidom.Document()
-        dom.appendChild(self._toxml(dom))
-        
-        request_made = {
-            'day': datetime.datetime.today().day,
-            'month': datetime.datetime.today().month,
-            'year': datetime.datetime.today().year
-        }
+        data = self._encode()
         
         if self.id is not None:
             id = str(self.id)
-            obj = self._applyS(self._put('/' + url + '/' + id + '.xml', dom.toxml(encoding="utf-8")), self.__name__, node_name)
-            if obj:
-                if type(obj.updated_at) == datetime.datetime:
-                    if (obj.updated_at.day == request_made['day']) and (obj.updated_at.month == request_made['month']) and (obj.updated_at.year == request_made['year']):
-                        self.saved = True
-                        return (True, obj)
-            return (False, obj)
+            response = self._request_response('PUT', self._url('/' + url + '/' + id), data)
         else:
-            obj = self._applyS(self._post('/' + url + '.xml', dom.toxml(encoding="utf-8")), self.__name__, node_name)
-            if obj:
-                if type(obj.updated_at) == datetime.datetime:
-                    if (obj.updated_at.day == request_made['day']) and (obj.updated_at.month == request_made['month']) and (obj.updated_at.year == request_made['year']):
-                        return (True, obj)
-            return (False, obj)
+            response = self._request_response('POST', self._url('/' + url), data)
+        obj = self._decodeS(response.body or '', self.__name__, node_name)
+        # Saved when the server answered with a success status and the object
+        saved = obj is not None and 200 <= response.status < 300
+        if saved and self.id is not None:
+            self.saved = True
+        return (saved, obj)
     
     def _get_auth_string(self):
         return base64.encodestring('%s:%s' % (self.api_key, 'x'))[:-1]
@@ -349,44 +609,77 @@ class ChargifyCustomer(ChargifyBase):
     @license    GNU General Public License
     """
     __name__ = 'ChargifyCustomer'
-    __attribute_types__ = {}
-    __xmlnodename__ = 'customer'
-    
-    id = None
-    first_name = ''
-    last_name = ''
-    email = ''
-    organization = ''
-    reference = ''
-    created_at = None
-    modified_at = None
-    
-    def __init__(self, apikey, subdomain, nodename = ''):
-        super( ChargifyCustomer, self ).__init__(apikey, subdomain)
+    __fields__ = {
+        'id': 'integer',
+        'first_name': 'string',
+        'last_name': 'string',
+        'email': 'string',
+        'organization': 'string',
+        'reference': 'string',
+        'created_at': 'datetime',
+        'updated_at': 'datetime',
+        'modified_at': 'datetime',
+    }
+    __xmlnodename__ = NodeName('customer')
+    __defaults__ = {
+        'id': None,
+        'first_name': '',
+        'last_name': '',
+        'email': '',
+        'organization': '',
+        'reference': '',
+        'created_at': None,
+        'modified_at': None,
+    }
+    __slots__ = tuple(set(__fields__) | set(__defaults__))
+    
+    def __init__(self, apikey, subdomain, nodename = '', transport = None, format = 'xml', base_host = None):
+        super( ChargifyCustomer, self ).__init__(apikey, subdomain, transport, format, base_host)
         if nodename:
             self.__xmlnodename__ = nodename
         
     def getAll(self):
-        return self._applyA(self._get('/customers.xml'), self.__name__, 'customer')
+        return self._fetch(self._url('/customers'), self.__name__, 'customer', many = True)
+    
+    def iter_all(self, page_size = DEFAULT_PAGE_SIZE, start_page = 1, prefetch = 0, since = None, date_field = 'updated_at'):
+        """
+        Lazily iterate over every customer, one page at a time.
+        With `prefetch` up to that many pages are fetched concurrently.
+        With `since` only the customers whose `date_field` is at or after
+        that datetime are listed, oldest first.
+        """
+        return self._pager('/customers', self.__name__, 'customer', page_size, start_page, prefetch,
+                           _changed_since(since, date_field))
+    
+    def getPage(self, page, page_size = DEFAULT_PAGE_SIZE, since = None, date_field = 'updated_at', until = None):
+        """
+        A single page of the customers, filtered and sorted as iter_all does,
+        changed up to `until` if given
+        """
+        return self._page('/customers', self.__name__, 'customer', page, page_size,
+                          _changed_since(since, date_field, until))
     
     def getById(self, id):
-        return self._applyS(self._get('/customers/' + str(id) + '.xml'), self.__name__, 'customer')
+        return self._fetch(self._url('/customers/' + str(id)), self.__name__, 'customer')
     
     def getByReference(self, reference):
-        return self._applyS(self._get('/customers/lookup' + '.xml' + str(reference)), self.__name__, 'customer')
+        url = self._url('/customers/lookup') + '?' + urllib.urlencode({'reference': reference})
+        return self._fetch(url, self.__name__, 'customer')
     
     def getSubscriptions(self):
-        obj = ChargifySubscription(self.api_key, self.sub_domain)
-        return obj.getByCustomerId(self.id)
+        return self._new_object('ChargifySubscription').getByCustomerId(self.id)
+    
+    def _iterxml(self):
+        if self.id is not None and self.__xmlnodename__ == 'customer_id':
+            return iter([encoder.leaf(self.__xmlnodename__, self.id)])
+        else:
+            return super(ChargifyCustomer, self)._iterxml()
     
-    def _toxml(self, dom):
+    def _todict(self):
         if self.id is not None and self.__xmlnodename__ == 'customer_id':
-            node = minidom.Element(self.__xmlnodename__)
-            node_txt = dom.createTextNode(str(self.id))
-            node.appendChild(node_txt)
-            return node
+            return self.__xmlnodename__, str(self.id)
         else:
-            return super(ChargifyCustomer, self)._toxml(dom)
+            return super(ChargifyCustomer, self)._todict()
     
     def save(self):
         return self._save('customers', 'customer')
@@ -398,37 +691,101 @@ class ChargifyProduct(ChargifyBase):
     @license    GNU General Public License
     """
     __name__ = 'ChargifyProduct'
-    __attribute_types__ = {}
-    __xmlnodename__ = 'product'
-    
-    id = None
-    price_in_cents = 0
-    name = ''
-    handle = ''
-    product_family = {}
-    accounting_code = ''
-    interval_unit = ''
-    interval = 0
-    
-    def __init__(self, apikey, subdomain, nodename = ''):
-        super( ChargifyProduct, self ).__init__(apikey, subdomain)
+    __fields__ = {
+        'id': 'integer',
+        'price_in_cents': 'integer',
+        'name': 'string',
+        'handle': 'string',
+        'description': 'string',
+        'accounting_code': 'string',
+        'interval_unit': 'string',
+        'interval': 'integer',
+        'initial_charge_in_cents': 'integer',
+        'trial_price_in_cents': 'integer',
+        'trial_interval': 'integer',
+        'trial_interval_unit': 'string',
+        'expiration_interval': 'integer',
+        'expiration_interval_unit': 'string',
+        'require_credit_card': 'boolean',
+        'created_at': 'datetime',
+        'updated_at': 'datetime',
+    }
+    __xmlnodename__ = NodeName('product')
+    __defaults__ = {
+        'id': None,
+        'price_in_cents': 0,
+        'name': '',
+        'handle': '',
+        'product_family': {},
+        'accounting_code': '',
+        'interval_unit': '',
+        'interval': 0,
+    }
+    __slots__ = tuple(set(__fields__) | set(__defaults__))
+    
+    def __init__(self, apikey, subdomain, nodename = '', transport = None, format = 'xml', base_host = None):
+        super( ChargifyProduct, self ).__init__(apikey, subdomain, transport, format, base_host)
         if nodename:
             self.__xmlnodename__ = nodename
 
     def getAll(self):
-        return self._applyA(self._get('/products.xml'), self.__name__, 'product')
+        return self._fetch(self._url('/products'), self.__name__, 'product', many = True)
+    
+    def iter_all(self, page_size = DEFAULT_PAGE_SIZE, start_page = 1, prefetch = 0):
+        """
+        Lazily iterate over every product, one page at a time.
+        With `prefetch` up to that many pages are fetched concurrently.
+        """
+        return self._pager('/products', self.__name__, 'product', page_size, start_page, prefetch)
+    
+    def getPage(self, page, page_size = DEFAULT_PAGE_SIZE):
+        """
+        A single page of the products
+        """
+        return self._page('/products', self.__name__, 'product', page, page_size)
     
     def getById(self, id):
-        return self._applyS(self._get('/products/' + str(id) + '.xml'), self.__name__, 'product')
+        return self._cached('id:%s' %(id), self._url('/products/' + str(id)))
     
     def getByHandle(self, handle):
-        return self._applyS(self._get('/products/handle/' + str(handle) + '.xml'), self.__name__, 'product')
+        return self._cached('handle:%s' %(handle), self._url('/products/handle/' + str(handle)))
+    
+    def _cache_key(self, key):
+        return '%s:product:%s' %(self.request_host, key)
+    
+    def _cached(self, key, url):
+        """
+        Fetch a product through the transport's catalog cache, if it has one
+        """
+        cache = self.transport.catalog_cache
+        if cache is None:
+            return self._fetch(url, self.__name__, 'product')
+        def fetch():
+            obj = self._fetch(url, self.__name__, 'product')
+            return obj and obj._state()
+        state = cache.get_or_fetch(self._cache_key(key), fetch, ChargifyNotFound)
+        if state is None:
+            return None
+        return self._restore(state)
     
     def save(self):
-        return self._save('products', 'product')
+        result = self._save('products', 'product')
+        cache = self.transport.catalog_cache
+        # Whatever _save made of the answer, the server may have changed it
+        if cache is not None:
+            keys = []
+            for obj in (self, result[1]):
+                if obj is None:
+                    continue
+                if obj.id is not None:
+                    keys.append(self._cache_key('id:%s' %(obj.id)))
+                if obj.handle:
+                    keys.append(self._cache_key('handle:%s' %(obj.handle)))
+            cache.invalidate(*keys)
+        return result
     
     def getPaymentPageUrl(self):
-        return 'https://' + self.request_host + '/h/' + self.id + '/subscriptions/new'
+        return 'https://%s/h/%s/subscriptions/new' %(self.request_host, self.id)
     
     def getPriceInDollars(self):
         return round(float(self.price_in_cents) / 100, 2)
@@ -443,67 +800,100 @@ class ChargifySubscription(ChargifyBase):
     @license    GNU General Public License
     """
     __name__ = 'ChargifySubscription'
-    __attribute_types__ = {
+    __fields__ = {
+        'id': 'integer',
+        'state': 'string',
+        'balance_in_cents': 'integer',
+        'current_period_started_at': 'datetime',
+        'current_period_ends_at': 'datetime',
+        'trial_started_at': 'datetime',
+        'trial_ended_at': 'datetime',
+        'activated_at': 'datetime',
+        'expires_at': 'datetime',
+        'created_at': 'datetime',
+        'updated_at': 'datetime',
+        'cancel_at_end_of_period': 'boolean',
+        'cancellation_message': 'string',
+        'product_handle': 'string',
         'customer': 'ChargifyCustomer',
         'product': 'ChargifyProduct',
-        'credit_card': 'ChargifyCreditCard'
+        'credit_card': 'ChargifyCreditCard',
+    }
+    __xmlnodename__ = NodeName('subscription')
+    __defaults__ = {
+        'id': None,
+        'state': '',
+        'balance_in_cents': 0,
+        'current_period_started_at': None,
+        'current_period_ends_at': None,
+        'trial_started_at': None,
+        'trial_ended_at': None,
+        'activated_at': None,
+        'expires_at': None,
+        'created_at': None,
+        'updated_at': None,
+        'customer': None,
+        'product': None,
+        'product_handle': '',
+        'credit_card': None,
     }
-    __xmlnodename__ = 'subscription'
-    
-    id = None
-    state = ''
-    balance_in_cents = 0
-    current_period_started_at = None
-    current_period_ends_at = None
-    trial_started_at = None
-    trial_ended_at = None
-    activated_at = None
-    expires_at = None
-    created_at = None
-    updated_at = None
-    customer = None
-    product = None
-    product_handle = ''
-    credit_card = None
-    
-    def __init__(self, apikey, subdomain, nodename = ''):
-        super( ChargifySubscription, self ).__init__(apikey, subdomain)
+    __slots__ = tuple(set(__fields__) | set(__defaults__))
+    
+    def __init__(self, apikey, subdomain, nodename = '', transport = None, format = 'xml', base_host = None):
+        super( ChargifySubscription, self ).__init__(apikey, subdomain, transport, format, base_host)
         if nodename:
             self.__xmlnodename__ = nodename
     
+    def iter_all(self, page_size = DEFAULT_PAGE_SIZE, start_page = 1, prefetch = 0, since = None, date_field = 'updated_at', sort = None):
+        """
+        Lazily iterate over every subscription of the account, one page at a
+        time.  With `prefetch` up to that many pages are fetched concurrently.
+        With `since` only the subscriptions whose `date_field` is at or after
+        that datetime are listed, oldest first.  Otherwise `sort` names the
+        field to list them by, ascending.
+        """
+        params = _changed_since(since, date_field)
+        if params is None and sort is not None:
+            params = {'sort': sort, 'direction': 'asc'}
+        return self._pager('/subscriptions', self.__name__, 'subscription', page_size, start_page, prefetch, params)
+    
+    def getPage(self, page, page_size = DEFAULT_PAGE_SIZE, since = None, date_field = 'updated_at', until = None):
+        """
+        A single page of the account's subscriptions, filtered and sorted as
+        iter_all does, changed up to `until` if given
+        """
+        return self._page('/subscriptions', self.__name__, 'subscription', page, page_size,
+                          _changed_since(since, date_field, until))
+    
     def getByCustomerId(self, customer_id):
-        return self._applyA(self._get('/customers/' + customer_id + '/subscriptions.xml'), self.__name__, 'subscription')
+        return self._fetch(self._url('/customers/' + str(customer_id) + '/subscriptions'), self.__name__, 'subscription', many = True)
+    
+    def iter_by_customer_id(self, customer_id, page_size = DEFAULT_PAGE_SIZE, start_page = 1, prefetch = 0):
+        """
+        Lazily iterate over a customer's subscriptions, one page at a time.
+        With `prefetch` up to that many pages are fetched concurrently.
+        """
+        return self._pager('/customers/' + str(customer_id) + '/subscriptions', self.__name__, 'subscription', page_size, start_page, prefetch)
     
     def getBySubscriptionId(self, subscription_id):
-        return self._applyA(self._get('/subscriptions/' + str(subscription_id) + '.xml'), self.__name__, 'subscription')
+        return self._fetch(self._url('/subscriptions/' + str(subscription_id)), self.__name__, 'subscription', many = True)
 
     def save(self):
         return self._save('subscriptions', 'subscription')
     
     def resetBalance(self):
-        self._put("/subscriptions/"+self.id+"/reset_balance.xml", "")
+        self._put("/subscriptions/%s/reset_balance.xml" %(self.id), "")
     
     def reactivate(self):
-        self._put("/subscriptions/"+self.id+"/reactivate.xml", "")
+        self._put("/subscriptions/%s/reactivate.xml" %(self.id), "")
 
     def upgrade(self, toProductHandle):
-        xml = """<?xml version="1.0" encoding="UTF-8"?>
-  <subscription>
-    <product_handle>%s</product_handle>
-  </subscription>""" % (toProductHandle)
-        #end improper indentation
-        
-        return self._applyS(self._put("/subscriptions/"+self.id+".xml", xml), self.__name__, "subscription")
+        xml = encoder.XML_DECLARATION + ''.join(encoder.iterelement('subscription', [('product_handle', toProductHandle)]))
+        return self._applyS(self._put("/subscriptions/%s.xml" %(self.id), xml), self.__name__, "subscription")
     
     def unsubscribe(self, message):
-        xml = """<?xml version="1.0" encoding="UTF-8"?>
-<subscription>
-  <cancellation_message>
-    %s
-  </cancellation_message>
-</subscription>""" % (message)
-        
-        self._delete("/subscriptions/"+self.id+".xml", xml)
+        xml = encoder.XML_DECLARATION + ''.join(encoder.iterelement('subscription', [('cancellation_message', message)]))
+        self._delete("/subscriptions/%s.xml" %(self.id), xml)
 
 
 class ChargifyCreditCard(ChargifyBase):
@@ -511,45 +901,61 @@ class ChargifyCreditCard(ChargifyBase):
     Represents Chargify Credit Cards
     """
     __name__ = 'ChargifyCreditCard'
-    __attribute_types__ = {}
-    __xmlnodename__ = 'credit_card_attributes'
-    
-    first_name = ''
-    last_name = ''
-    full_number = ''
-    masked_card_number = ''
-    expiration_month = ''
-    expiration_year = ''
-    cvv = ''
-    type = ''
-    billing_address = ''
-    billing_city = ''
-    billing_state = ''
-    billing_zip = ''
-    billing_country = ''
-    
-    def __init__(self, apikey, subdomain, nodename = ''):
-        super( ChargifyCreditCard, self ).__init__(apikey, subdomain)
+    __fields__ = {
+        'first_name': 'string',
+        'last_name': 'string',
+        'full_number': 'string',
+        'masked_card_number': 'string',
+        'expiration_month': 'integer',
+        'expiration_year': 'integer',
+        'cvv': 'string',
+        'type': 'string',
+        'card_type': 'string',
+        'billing_address': 'string',
+        'billing_city': 'string',
+        'billing_state': 'string',
+        'billing_zip': 'string',
+        'billing_country': 'string',
+        'customer_id': 'integer',
+    }
+    __xmlnodename__ = NodeName('credit_card_attributes')
+    __defaults__ = {
+        'first_name': '',
+        'last_name': '',
+        'full_number': '',
+        'masked_card_number': '',
+        'expiration_month': '',
+        'expiration_year': '',
+        'cvv': '',
+        'type': '',
+        'billing_address': '',
+        'billing_city': '',
+        'billing_state': '',
+        'billing_zip': '',
+        'billing_country': '',
+        'ccv': '',
+        'zip': '',
+    }
+    __slots__ = tuple(set(__fields__) | set(__defaults__))
+    
+    def __init__(self, apikey, subdomain, nodename = '', transport = None, format = 'xml', base_host = None):
+        super( ChargifyCreditCard, self ).__init__(apikey, subdomain, transport, format, base_host)
         if nodename:
             self.__xmlnodename__ = nodename
 
     def save(self, subscription):
         path = "/subscriptions/%s.xml" % (subscription.id)
         
-        data = u"""<?xml version="1.0" encoding="UTF-8"?>
-  <subscription>
-    <credit_card_attributes>
-      <full_number>%s</full_number>
-      <expiration_month>%s</expiration_month>
-      <expiration_year>%s</expiration_year>
-      <cvv>%s</cvv>
-      <first_name>%s</first_name>
-      <last_name>%s</last_name>
-      <zip>%s</zip>
-    </credit_card_attributes>
-  </subscription>""" % (self.full_number, self.expiration_month, self.expiration_year, self.cvv, self.first_name, self.last_name, self.zip)
-        # end improper indentation
-        
+        card = encoder.iterelement('credit_card_attributes', [
+            ('full_number', self.full_number),
+            ('expiration_month', self.expiration_month),
+            ('expiration_year', self.expiration_year),
+            ('cvv', self.cvv),
+            ('first_name', self.first_name),
+            ('last_name', self.last_name),
+            ('zip', self.zip),
+        ])
+        data = encoder.XML_DECLARATION + '<subscription>' + ''.join(card) + '</subscription>'
         return self._applyS(self._put(path, data), self.__name__, "subscription")
 
 
@@ -560,8 +966,8 @@ class ChargifyPostBack(ChargifyBase):
     """
     subscriptions = []
     
-    def __init__(self, apikey, subdomain, postback_data):
-        ChargifyBase.__init__(apikey, subdomain)
+    def __init__(self, apikey, subdomain, postback_data, transport = None, format = 'xml', base_host = None):
+        ChargifyBase.__init__(self, apikey, subdomain, transport, format, base_host)
         if postback_data:
             self._process_postback_data(postback_data)
     
@@ -569,34 +975,94 @@ class ChargifyPostBack(ChargifyBase):
         """
         Process the Json array and fetches the Subscription Objects
         """
-        csub = ChargifySubscription(self.api_key, self.sub_domain)
+        csub = self._new_object('ChargifySubscription')
         postdata_objects = json.loads(data)
         for obj in postdata_objects:
             self.subscriptions.append(csub.getBySubscriptionId(obj))
 
+decoder.compile_schema(ChargifyBase)
+for cls in (ChargifyCustomer, ChargifyProduct, ChargifySubscription, ChargifyCreditCard):
+    cls.__defaults__ = dict(ChargifyBase.__defaults__, **cls.__defaults__)
+    cls.__field_names__ = tuple(sorted(cls.__slots__))
+    decoder.compile_schema(cls)
+del cls
+
 class Chargify:
     """
     The Chargify class provides the main entry point to the Charify API
+    
+    All objects created from one Chargify instance share a pool of keep-alive
+    connections.  `pool_size` is the number of idle connections kept per host,
+    `idle_timeout` is how many seconds an idle connection may be reused for
+    and `timeout` is the socket timeout.  `format` picks the wire format,
+    'xml' or 'json', used for reading and saving objects.  `retry` is a
+    RetryPolicy for transient failures, by default requests are not retried.
+    `rate_limiter` is a RateLimiter holding requests to a per subdomain
+    budget; give it a FileBackend to share the budget between processes.
+    `http_cache` is a ValidatorCache that turns repeated reads into
+    conditional requests answered from memory when nothing changed.
+    `catalog_cache` is a CatalogCache serving product lookups by id or
+    handle without asking the server until its entries expire.
+    `base_host` and `scheme` point the client somewhere other than
+    https://<subdomain>.chargify.com, such as a local FakeChargify server.
     @license    GNU General Public License
     """
     api_key = ''
     sub_domain = ''
+    transport = None
+    format = 'xml'
+    base_host = None
     
-    def __init__(self, apikey, subdomain):
+    def __init__(self, apikey, subdomain, pool_size = 4, idle_timeout = 60, timeout = None, format = 'xml', retry = None, rate_limiter = None, http_cache = None, catalog_cache = None, base_host = None, scheme = 'https'):
+        if format not in FORMATS:
+            raise ValueError('Unsupported format: %s' %(format))
         self.api_key = apikey
         self.sub_domain = subdomain
+        self.format = format
+        self.base_host = base_host
+        self.transport = HTTPTransport(pool_size, idle_timeout, timeout, retry, rate_limiter, http_cache, catalog_cache, scheme)
     
     def Customer(self, nodename = ''):
-        return ChargifyCustomer(self.api_key, self.sub_domain, nodename)
+        return ChargifyCustomer(self.api_key, self.sub_domain, nodename, self.transport, self.format, self.base_host)
     
     def Product(self, nodename = ''):
-        return ChargifyProduct(self.api_key, self.sub_domain, nodename)
+        return ChargifyProduct(self.api_key, self.sub_domain, nodename, self.transport, self.format, self.base_host)
 
     def Subscription(self, nodename = ''):
-        return ChargifySubscription(self.api_key, self.sub_domain, nodename)
+        return ChargifySubscription(self.api_key, self.sub_domain, nodename, self.transport, self.format, self.base_host)
 
     def CreditCard(self, nodename = ''):
-        return ChargifyCreditCard(self.api_key, self.sub_domain, nodename)
+        return ChargifyCreditCard(self.api_key, self.sub_domain, nodename, self.transport, self.format, self.base_host)
     
     def PostBack(self, postbackdata):
-        return ChargifyPostBack(self.api_key, self.sub_domain, postbackdata)
+        return ChargifyPostBack(self.api_key, self.sub_domain, postbackdata, self.transport, self.format, self.base_host)
+    
+    def bulk(self, resources, concurrency = 4):
+        """
+        Save (create or update) every resource object in `resources`, up to
+        `concurrency` at a time over the shared connection pool and within
+        the rate limit.  Returns a Bulk iterator yielding, in input order,
+        the saved object or the ChargifyError raised for each resource;
+        its `stats` summarize the run once it is exhausted.
+        """
+        def save(resource):
+            saved, obj = resource.save()
+            return obj
+        return Bulk(resources, save, concurrency, ChargifyError)
+    
+    def add_hooks(self, pre_request = None, post_response = None):
+        """
+        Call `pre_request` before and `post_response` after every request
+        made by the objects of this client with a RequestInfo describing it,
+        e.g. add_hooks(post_response = MetricsCollector())
+        """
+        self.transport.add_hooks(pre_request, post_response)
+    
+    def remove_hooks(self, pre_request = None, post_response = None):
+        self.transport.remove_hooks(pre_request, post_response)
+    
+    def close(self):
+        """
+        Close all idle pooled connections
+        """
+        self.transport.close()
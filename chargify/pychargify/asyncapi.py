@@ -0,0 +1,124 @@
+'''
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+Non-blocking variant of the Chargify API.  Every call returns a Future
+straight away while the request runs on the client's own worker pool.
+'''
+
+from api import Chargify, ChargifyBase
+from _futures import ThreadPoolExecutor
+
+# Methods that talk to the server and return a Future
+ASYNC_METHODS = (
+    'getAll', 'getById', 'getByHandle', 'getByReference', 'getSubscriptions',
+    'getByCustomerId', 'getBySubscriptionId',
+    'save', 'upgrade', 'unsubscribe', 'reactivate', 'resetBalance',
+)
+
+
+def _wrap(value, executor):
+    """
+    Wrap resource objects returned by a call so they stay non-blocking
+    """
+    if isinstance(value, ChargifyBase):
+        return AsyncResource(value, executor)
+    if isinstance(value, list):
+        return [_wrap(item, executor) for item in value]
+    if isinstance(value, tuple):
+        return tuple([_wrap(item, executor) for item in value])
+    return value
+
+def _unwrap(value):
+    if isinstance(value, AsyncResource):
+        return value._resource
+    return value
+
+
+class AsyncResource(object):
+    """
+    Wraps a Chargify resource object.  The methods in ASYNC_METHODS return a
+    Future for their usual result, everything else (attributes, helpers such
+    as getFormattedPrice) is passed straight through to the resource.
+    """
+    def __init__(self, resource, executor):
+        object.__setattr__(self, '_resource', resource)
+        object.__setattr__(self, '_executor', executor)
+
+    def _call(self, name, *args, **kwargs):
+        method = getattr(self._resource, name)
+        args = [_unwrap(arg) for arg in args]
+        def run():
+            return _wrap(method(*args, **kwargs), self._executor)
+        return self._executor.submit(run)
+
+    def __getattr__(self, name):
+        if name in ASYNC_METHODS:
+            def method(*args, **kwargs):
+                return self._call(name, *args, **kwargs)
+            method.__name__ = name
+            return method
+        return _wrap(getattr(self._resource, name), self._executor)
+
+    def __setattr__(self, name, value):
+        setattr(self._resource, name, _unwrap(value))
+
+    def __repr__(self):
+        return '<AsyncResource %r>' %(self._resource,)
+
+
+class AsyncChargify(object):
+    """
+    The non-blocking entry point to the Chargify API
+
+        chargify = AsyncChargify(api_key, subdomain)
+        future = chargify.Customer().getById(1)
+        future.add_done_callback(...)
+        customer = future.result()
+
+    Requests run on `max_workers` threads which share their own connection
+    pool, so they never hold up the caller's thread.  The futures behave like
+    those of concurrent.futures: result(), exception(), cancel() for a call
+    that has not started and add_done_callback().  Decoding and encoding
+    are done by the same resource classes as the blocking Chargify client.
+    """
+    def __init__(self, apikey, subdomain, max_workers = 8, idle_timeout = 60, timeout = None, format = 'xml', retry = None, rate_limiter = None, http_cache = None, catalog_cache = None, base_host = None, scheme = 'https'):
+        self.chargify = Chargify(apikey, subdomain, max_workers, idle_timeout, timeout, format, retry, rate_limiter, http_cache, catalog_cache, base_host, scheme)
+        self._executor = ThreadPoolExecutor(max_workers, 'pychargify-async')
+
+    def _get_transport(self):
+        return self.chargify.transport
+    def _set_transport(self, transport):
+        self.chargify.transport = transport
+    transport = property(_get_transport, _set_transport)
+
+    def Customer(self, nodename = ''):
+        return AsyncResource(self.chargify.Customer(nodename), self._executor)
+
+    def Product(self, nodename = ''):
+        return AsyncResource(self.chargify.Product(nodename), self._executor)
+
+    def Subscription(self, nodename = ''):
+        return AsyncResource(self.chargify.Subscription(nodename), self._executor)
+
+    def CreditCard(self, nodename = ''):
+        return AsyncResource(self.chargify.CreditCard(nodename), self._executor)
+
+    def close(self, wait = True):
+        """
+        Stop the workers and close the pooled connections
+        """
+        self._executor.shutdown(wait)
+        self.chargify.close()
@@ -0,0 +1,126 @@
+'''
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+Bulk writes run with bounded concurrency
+'''
+
+import logging
+import threading
+import time
+from collections import deque
+
+from _futures import ThreadPoolExecutor
+from stats import Histogram
+
+log = logging.getLogger("pychargify.bulk")
+
+
+class BulkStats(object):
+    """
+    Counters and a latency Histogram for one bulk run
+    """
+    clock = staticmethod(time.time)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.succeeded = 0
+        self.failed = 0
+        self.latency = Histogram()
+        self.started = None
+        self.finished = None
+
+    def record(self, ok, elapsed):
+        self._lock.acquire()
+        try:
+            if ok:
+                self.succeeded += 1
+            else:
+                self.failed += 1
+        finally:
+            self._lock.release()
+        self.latency.observe(elapsed)
+
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or self.clock()) - self.started
+
+    def summary(self):
+        total = self.succeeded + self.failed
+        elapsed = self.elapsed()
+        return {
+            'total': total,
+            'succeeded': self.succeeded,
+            'failed': self.failed,
+            'seconds': elapsed,
+            'per_second': elapsed and total / elapsed or 0.0,
+            'latency_p50': self.latency.quantile(0.5),
+            'latency_p99': self.latency.quantile(0.99),
+        }
+
+
+class Bulk(object):
+    """
+    Calls `call` for every item of `items` on `concurrency` threads and
+    yields the results in input order while later items are still running.
+
+    An item whose call raised one of `errors` yields the exception instead
+    of a result, any other exception is raised from the iterator.  Items are
+    taken from `items` only as workers become free, so a generator of
+    thousands of records is never held in memory.  `stats` is a BulkStats
+    and is complete once iteration ends.
+    """
+    def __init__(self, items, call, concurrency = 4, errors = (Exception,)):
+        if concurrency < 1:
+            raise ValueError('concurrency must be at least 1')
+        self.items = items
+        self.call = call
+        self.concurrency = concurrency
+        self.errors = errors
+        self.stats = BulkStats()
+
+    def _run(self, item):
+        stats = self.stats
+        start = stats.clock()
+        try:
+            result = self.call(item)
+        except self.errors, e:
+            stats.record(False, stats.clock() - start)
+            return e
+        except:
+            stats.record(False, stats.clock() - start)
+            raise
+        stats.record(True, stats.clock() - start)
+        return result
+
+    def __iter__(self):
+        executor = ThreadPoolExecutor(self.concurrency, 'pychargify-bulk')
+        window = deque()
+        items = iter(self.items)
+        self.stats.started = self.stats.clock()
+        try:
+            for item in items:
+                window.append(executor.submit(self._run, item))
+                if len(window) >= self.concurrency * 2:
+                    yield window.popleft().result()
+            while window:
+                yield window.popleft().result()
+        finally:
+            for future in window:
+                future.cancel()
+            executor.shutdown(wait = False)
+            self.stats.finished = self.stats.clock()
+            log.info("Bulk run finished: %(total)i items, %(failed)i failed, %(per_second).1f/s" % self.stats.summary())
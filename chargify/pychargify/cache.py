@@ -0,0 +1,270 @@
+'''
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+Caches for decoded API responses
+'''
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class ValidatorEntry(object):
+    """
+    A cached response: its validators and the object decoded from it
+    """
+    def __init__(self, etag, last_modified, obj, size):
+        self.etag = etag
+        self.last_modified = last_modified
+        self.obj = obj
+        self.size = size
+
+    def conditional_headers(self):
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class ValidatorCache(object):
+    """
+    Remembers the ETag / Last-Modified validators of GET responses together
+    with the decoded objects, so a 304 Not Modified answer can be served
+    without downloading or parsing the body again.
+
+    Entries are evicted least recently used first once the bodies they were
+    decoded from add up to more than `max_bytes`.
+    """
+    def __init__(self, max_bytes = 8 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, key):
+        """
+        Return the entry for `key`, marking it as recently used
+        """
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+            return entry
+        finally:
+            self._lock.release()
+
+    def store(self, key, etag, last_modified, obj, size):
+        if not (etag or last_modified) or size > self.max_bytes:
+            return
+        self._lock.acquire()
+        try:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old.size
+            self._entries[key] = ValidatorEntry(etag, last_modified, obj, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                evicted_key, evicted = self._entries.popitem(last = False)
+                self._bytes -= evicted.size
+                self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def invalidate(self, key):
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry.size
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self._bytes = 0
+        finally:
+            self._lock.release()
+
+    def hit(self):
+        self._lock.acquire()
+        self.hits += 1
+        self._lock.release()
+
+    def miss(self):
+        self._lock.acquire()
+        self.misses += 1
+        self._lock.release()
+
+    def stats(self):
+        self._lock.acquire()
+        try:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self._entries), 'bytes': self._bytes}
+        finally:
+            self._lock.release()
+
+
+class CacheBackend(object):
+    """
+    Storage for the CatalogCache.  get() returns None on a miss.
+    """
+    def get(self, key):
+        raise NotImplementedError()
+
+    def set(self, key, value, ttl):
+        raise NotImplementedError()
+
+    def delete(self, key):
+        raise NotImplementedError()
+
+
+class LocalCache(CacheBackend):
+    """
+    An in-process cache with per entry expiry, evicting the least recently
+    used entry beyond `max_entries`
+    """
+    clock = staticmethod(time.time)
+
+    def __init__(self, max_entries = 256):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires is not None and expires <= self.clock():
+                return None
+            self._entries[key] = entry
+            return value
+        finally:
+            self._lock.release()
+
+    def set(self, key, value, ttl):
+        expires = None
+        if ttl is not None:
+            expires = self.clock() + ttl
+        self._lock.acquire()
+        try:
+            self._entries.pop(key, None)
+            self._entries[key] = (expires, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last = False)
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            self._entries.pop(key, None)
+        finally:
+            self._lock.release()
+
+
+class DjangoCache(CacheBackend):
+    """
+    Stores entries in one of the Django cache framework's caches, so they are
+    shared by every process using that cache
+    """
+    def __init__(self, alias = 'default'):
+        from django.core import cache
+        if hasattr(cache, 'caches'):
+            self.cache = cache.caches[alias]
+        else:
+            self.cache = cache.get_cache(alias)
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value, ttl):
+        self.cache.set(key, value, ttl)
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+
+# Stored in place of a value for lookups that raised ChargifyNotFound
+NOT_FOUND = ('pychargify', 'not-found')
+
+
+class CatalogCache(object):
+    """
+    A read-through cache for rarely changing lookups (the product catalog).
+    Values live for `ttl` seconds and misses on the server (ChargifyNotFound)
+    for `negative_ttl` seconds.  Values must be picklable for shared backends.
+    """
+    def __init__(self, backend = None, ttl = 3600, negative_ttl = 300, prefix = 'pychargify'):
+        if backend is None:
+            backend = LocalCache()
+        self.backend = backend
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, key):
+        return '%s:%s' %(self.prefix, key)
+
+    def _count(self, hit):
+        self._lock.acquire()
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        self._lock.release()
+
+    def get_or_fetch(self, key, fetch, not_found):
+        """
+        Return the cached value for `key` or store and return fetch().
+        `not_found` is the exception class of a (cached) missing value.
+        """
+        value = self.backend.get(self._key(key))
+        if value is not None:
+            self._count(True)
+            if value == NOT_FOUND:
+                raise not_found()
+            return value
+        self._count(False)
+        try:
+            value = fetch()
+        except not_found:
+            if self.negative_ttl:
+                self.backend.set(self._key(key), NOT_FOUND, self.negative_ttl)
+            raise
+        if value is not None:
+            self.backend.set(self._key(key), value, self.ttl)
+        return value
+
+    def invalidate(self, *keys):
+        for key in keys:
+            self.backend.delete(self._key(key))
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,109 @@
+'''
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+Timezone aware parsing of the timestamps in API payloads
+'''
+
+import datetime
+import iso8601
+
+# How many distinct timestamps are remembered
+MEMO_SIZE = 4096
+
+ZERO = datetime.timedelta(0)
+
+
+class FixedOffset(datetime.tzinfo):
+    """
+    A fixed offset of `minutes` east of UTC
+    """
+    def __init__(self, minutes):
+        self.minutes = minutes
+        self.offset = datetime.timedelta(minutes = minutes)
+        sign = minutes < 0 and '-' or '+'
+        self.name = '%s%02d:%02d' %(sign, abs(minutes) // 60, abs(minutes) % 60)
+
+    def utcoffset(self, dt):
+        return self.offset
+
+    def dst(self, dt):
+        return ZERO
+
+    def tzname(self, dt):
+        return self.name
+
+    def __reduce__(self):
+        return (FixedOffset, (self.minutes,))
+
+    def __repr__(self):
+        return '<FixedOffset %s>' %(self.name)
+
+
+UTC = FixedOffset(0)
+_offsets = {0: UTC}
+
+def get_offset(minutes):
+    """
+    The shared FixedOffset instance for `minutes` east of UTC
+    """
+    tz = _offsets.get(minutes)
+    if tz is None:
+        tz = _offsets.setdefault(minutes, FixedOffset(minutes))
+    return tz
+
+_memo = {}
+
+def _parse_fixed(s):
+    """
+    Parse the YYYY-MM-DDTHH:MM:SS+HH:MM (or ...SSZ) shape Chargify sends,
+    returns None for anything else
+    """
+    length = len(s)
+    if length == 25:
+        if s[19] not in '+-' or s[22] != ':':
+            return None
+        minutes = int(s[20:22]) * 60 + int(s[23:25])
+        if s[19] == '-':
+            minutes = -minutes
+    elif length == 20 and s[19] == 'Z':
+        minutes = 0
+    else:
+        return None
+    if s[4] != '-' or s[7] != '-' or s[10] != 'T' or s[13] != ':' or s[16] != ':':
+        return None
+    return datetime.datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]),
+                             int(s[14:16]), int(s[17:19]), 0, get_offset(minutes))
+
+def parse_datetime(s):
+    """
+    Parse an ISO-8601 timestamp into a timezone aware datetime.  The fixed
+    shape of API timestamps is parsed directly and remembered, as the same
+    timestamps repeat throughout a listing.  Any other ISO-8601 value goes
+    through iso8601.parse and comes back in UTC.
+    """
+    value = _memo.get(s)
+    if value is not None:
+        return value
+    try:
+        value = _parse_fixed(s)
+    except ValueError:
+        value = None
+    if value is None:
+        return datetime.datetime.fromtimestamp(iso8601.parse(s), UTC)
+    if len(_memo) >= MEMO_SIZE:
+        _memo.clear()
+    _memo[s] = value
+    return value
@@ -0,0 +1,251 @@
+'''
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+Decoders for Chargify XML and JSON responses
+'''
+
+import datetime
+from cStringIO import StringIO
+
+try:
+    import json
+except ImportError:
+    import simplejson as json #@UnresolvedImport
+
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+
+from dates import parse_datetime
+
+
+# Sets a slot (or instance attribute) without going through __setattr__,
+# objects fall back to their own __setattr__ for names without a slot
+_set_field = object.__setattr__
+
+def _get_text(element):
+    """
+    Get the text directly inside an element, ignoring any child elements
+    """
+    text = element.text or ''
+    for child in element:
+        if child.tail:
+            text += child.tail
+    return text
+
+def to_string(value):
+    if value is None:
+        return u''
+    if isinstance(value, bool):
+        return value and u'true' or u'false'
+    if not isinstance(value, basestring):
+        return unicode(value)
+    return value
+
+def to_integer(value):
+    if value is None or value == '':
+        return None
+    return int(value)
+
+def to_boolean(value):
+    if value is None or value == '':
+        return None
+    if isinstance(value, bool):
+        return value
+    return value.strip().lower() in ('true', '1')
+
+def to_datetime(value):
+    if not value:
+        return None
+    if isinstance(value, datetime.datetime):
+        return value
+    return parse_datetime(value)
+
+def _xml_text(text):
+    return text or u''
+
+# Coercers for the scalar field types of a resource schema, converting
+# values decoded from JSON
+COERCERS = {
+    'string': to_string,
+    'integer': to_integer,
+    'boolean': to_boolean,
+    'datetime': to_datetime,
+}
+
+# Coercers for element text, which is always a string or None
+XML_COERCERS = dict(COERCERS, string = _xml_text)
+
+def _json_scalar(coerce):
+    def decode(value, factory):
+        return coerce(value)
+    return decode
+
+def _json_nested(obj_type):
+    def decode(value, factory):
+        return decode_json_object(value or {}, factory, obj_type)
+    return decode
+
+def compile_schema(cls):
+    """
+    Generate the decoders for a resource class from its __fields__ schema,
+    a dict of field name to a scalar type in COERCERS or the class name of a
+    nested resource.  The class gets __xml_decoders__, a dict of tag name to
+    the coercer for the element text of a scalar field, __json_decoders__,
+    a dict of field name to a function decoding any field, and
+    __attribute_types__ listing its nested resources.
+    """
+    xml_decoders = {}
+    json_decoders = {}
+    attribute_types = {}
+    for name, kind in cls.__fields__.iteritems():
+        if kind in COERCERS:
+            xml_decoders[name] = XML_COERCERS[kind]
+            json_decoders[name] = _json_scalar(COERCERS[kind])
+        else:
+            json_decoders[name] = _json_nested(kind)
+            attribute_types[name] = kind
+    cls.__xml_decoders__ = xml_decoders
+    cls.__json_decoders__ = json_decoders
+    cls.__attribute_types__ = attribute_types
+    return cls
+
+def decode_element(element, factory, obj_type):
+    """
+    Build an object of `obj_type` from an element using the decoders
+    compiled from its class schema, nested objects are decoded in the same
+    pass.  Tags missing from the schema are kept as text, or a datetime for
+    type="datetime".  `factory` is called with a class name and returns a
+    new empty object.
+    """
+    obj = factory(obj_type)
+    coercers = obj.__xml_decoders__
+    attribute_types = obj.__attribute_types__
+    for child in element:
+        tag = child.tag
+        coerce = coercers.get(tag)
+        if coerce is not None:
+            value = coerce(child.text)
+        elif tag in attribute_types:
+            value = decode_element(child, factory, attribute_types[tag])
+        else:
+            value = _get_text(child)
+            if value and child.get('type') == 'datetime':
+                value = to_datetime(value)
+        try:
+            _set_field(obj, tag, value)
+        except AttributeError:
+            setattr(obj, tag, value)
+    return obj
+
+def iterdecode(xml, node_name, factory, obj_type):
+    """
+    Incrementally parse `xml` and yield an object for each `node_name`
+    element as soon as it is complete.  Each decoded element is released
+    straight away so memory stays bounded by the size of one record.
+    """
+    if isinstance(xml, unicode):
+        xml = xml.encode('utf-8')
+    if isinstance(xml, str):
+        xml = StringIO(xml)
+    root = None
+    current = None
+    for event, element in ElementTree.iterparse(xml, events = ('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = element
+            if current is None and element.tag == node_name:
+                current = element
+        elif element is current:
+            yield decode_element(element, factory, obj_type)
+            current = None
+            element.clear()
+            if element is not root:
+                root.clear()
+
+def decode_list(xml, node_name, factory, obj_type):
+    """
+    Decode every `node_name` element into a list of objects
+    """
+    return list(iterdecode(xml, node_name, factory, obj_type))
+
+def decode_single(xml, node_name, factory, obj_type):
+    """
+    Decode the only `node_name` element, returns None unless there is exactly one
+    """
+    obj = None
+    for count, decoded in enumerate(iterdecode(xml, node_name, factory, obj_type)):
+        if count:
+            return None
+        obj = decoded
+    return obj
+
+def _json_value(name, value):
+    """
+    Convert a JSON scalar missing from the schema to the value the XML
+    decoder would produce: text, with datetimes for the `*_at` timestamps
+    """
+    if value and isinstance(value, basestring) and name.endswith('_at'):
+        return to_datetime(value)
+    return to_string(value)
+
+def decode_json_object(data, factory, obj_type):
+    """
+    Build an object of `obj_type` from a decoded JSON dict using the
+    decoders compiled from its class schema
+    """
+    obj = factory(obj_type)
+    decoders = obj.__json_decoders__
+    for name, value in data.iteritems():
+        name = str(name)
+        decode = decoders.get(name)
+        if decode is not None:
+            value = decode(value, factory)
+        elif not isinstance(value, (dict, list)):
+            value = _json_value(name, value)
+        try:
+            _set_field(obj, name, value)
+        except AttributeError:
+            setattr(obj, name, value)
+    return obj
+
+def _unwrap(item, node_name):
+    if isinstance(item, dict) and isinstance(item.get(node_name), dict):
+        return item[node_name]
+    return item
+
+def decode_json_list(text, node_name, factory, obj_type):
+    """
+    Decode a JSON array of `{node_name: {...}}` records into a list of objects
+    """
+    data = json.loads(text)
+    if isinstance(data, dict):
+        data = [data]
+    return [decode_json_object(_unwrap(item, node_name), factory, obj_type) for item in data]
+
+def decode_json_single(text, node_name, factory, obj_type):
+    """
+    Decode a single `{node_name: {...}}` record, returns None unless there is exactly one
+    """
+    data = json.loads(text)
+    if isinstance(data, list):
+        if len(data) != 1:
+            return None
+        data = data[0]
+    if not isinstance(data, dict) or not isinstance(data.get(node_name), dict):
+        return None
+    return decode_json_object(data[node_name], factory, obj_type)
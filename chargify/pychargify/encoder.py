@@ -0,0 +1,135 @@
+'''
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+Encoders for Chargify XML and JSON request bodies
+'''
+
+import datetime
+
+try:
+    import json
+except ImportError:
+    import simplejson as json #@UnresolvedImport
+
+XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8"?>'
+
+# Bulk bodies are yielded in chunks of at least this many bytes
+CHUNK_SIZE = 16 * 1024
+
+
+def escape(text):
+    """
+    Escape element text, returns UTF-8 encoded bytes
+    """
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    return text
+
+def to_text(value):
+    """
+    The wire representation of a scalar field value
+    """
+    if value is None:
+        return ''
+    if value is True:
+        return 'true'
+    if value is False:
+        return 'false'
+    if isinstance(value, basestring):
+        return value
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return str(value)
+
+def leaf(name, value):
+    """
+    A single element holding the text of a scalar value
+    """
+    return '<%s>%s</%s>' %(name, escape(to_text(value)), name)
+
+def iterelement(name, fields):
+    """
+    Yield the chunks of an element with a child for each (name, value) in
+    `fields`, resource objects are written through their own _iterxml()
+    """
+    yield '<%s>' %(name)
+    for field, value in fields:
+        if hasattr(value, '_iterxml'):
+            for chunk in value._iterxml():
+                yield chunk
+        else:
+            yield leaf(field, value)
+    yield '</%s>' %(name)
+
+def to_json(value):
+    """
+    The JSON representation of a scalar field value
+    """
+    if value is None or isinstance(value, (basestring, bool, int, long, float)):
+        return value
+    return to_text(value)
+
+def _buffered(chunks, chunk_size):
+    """
+    Join small chunks so they are written to the socket in larger pieces
+    """
+    buffer = []
+    size = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        size += len(chunk)
+        if size >= chunk_size:
+            yield ''.join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield ''.join(buffer)
+
+def _iterxml_array(objs, root_name):
+    yield XML_DECLARATION
+    yield '<%s type="array">' %(root_name)
+    for obj in objs:
+        for chunk in obj._iterxml():
+            yield chunk
+    yield '</%s>' %(root_name)
+
+def _iterjson_array(objs):
+    separator = '['
+    for obj in objs:
+        name, data = obj._todict()
+        yield separator
+        yield json.dumps({name: data})
+        separator = ','
+    if separator == '[':
+        yield '['
+    yield ']'
+
+def iterencode(objs, root_name, format = 'xml', chunk_size = CHUNK_SIZE):
+    """
+    Lazily encode a bulk body of resource objects, `objs` may be any
+    iterable so records are only built as the body is sent
+    """
+    if format == 'json':
+        chunks = _iterjson_array(objs)
+    else:
+        chunks = _iterxml_array(objs, root_name)
+    return _buffered(chunks, chunk_size)
@@ -0,0 +1,627 @@
+'''
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+A local stand-in for the Chargify API, for tests and benchmarks that must
+run without a Chargify account
+
+    server = FakeChargify(latency = lognormal(0.05, 0.5), error_rate = 0.01)
+    server.store.seed(customers = 1000, products = 5)
+    server.start()
+    chargify = server.client()
+    ...
+    server.stop()
+'''
+
+import BaseHTTPServer
+import SocketServer
+import base64
+import cgi
+import datetime
+import random
+import re
+import socket
+import struct
+import threading
+import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json #@UnresolvedImport
+
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+
+from dates import FixedOffset
+from encoder import XML_DECLARATION, escape
+
+# Fields the store fills in itself
+READ_ONLY = ('id', 'created_at', 'updated_at')
+
+
+def stored_card(attributes):
+    """
+    The credit_card of a subscription from its credit_card_attributes, only
+    the last 4 digits of the number are kept
+    """
+    number = str(attributes.get('full_number') or '')
+    return {
+        'first_name': attributes.get('first_name', ''),
+        'last_name': attributes.get('last_name', ''),
+        'masked_card_number': 'XXXX-XXXX-XXXX-' + (number[-4:] or '1111'),
+        'card_type': attributes.get('card_type') or 'visa',
+        'expiration_month': int(attributes.get('expiration_month') or 12),
+        'expiration_year': int(attributes.get('expiration_year') or 2030),
+    }
+
+
+def constant(seconds):
+    """
+    A latency distribution that always waits `seconds`
+    """
+    return lambda: seconds
+
+def uniform(low, high):
+    return lambda: random.uniform(low, high)
+
+def lognormal(median, sigma):
+    """
+    A long tailed latency distribution around `median` seconds
+    """
+    import math
+    mu = math.log(median)
+    return lambda: random.lognormvariate(mu, sigma)
+
+def now():
+    """
+    The current time in the local UTC offset
+    """
+    offset = time.daylight and time.localtime().tm_isdst > 0 and time.altzone or time.timezone
+    tz = FixedOffset(-offset // 60)
+    return datetime.datetime.now(tz).replace(microsecond = 0)
+
+
+class Store(object):
+    """
+    The in-memory customers, products and subscriptions.  Records are dicts,
+    a subscription refers to its customer and product by id.
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.customers = {}
+        self.products = {}
+        self.subscriptions = {}
+
+    def _stamp(self, record, records = None):
+        if records is not None:
+            record['id'] = max(records or [0]) + 1
+            record['created_at'] = now()
+            records[record['id']] = record
+        record['updated_at'] = now()
+        return record
+
+    def update(self, records, id, **fields):
+        """
+        Change a record of `records` (e.g. store.subscriptions) as if it was
+        edited in Chargify, `fields` may set its updated_at
+        """
+        with self.lock:
+            record = self._stamp(records[id])
+            record.update(fields)
+            return record
+
+    def add_customer(self, **fields):
+        with self.lock:
+            return self._stamp(dict(fields), self.customers)
+
+    def add_product(self, **fields):
+        with self.lock:
+            return self._stamp(dict(fields), self.products)
+
+    def add_subscription(self, customer_id, product_id, **fields):
+        with self.lock:
+            record = {
+                'state': 'active',
+                'balance_in_cents': 0,
+                'current_period_started_at': now(),
+                'current_period_ends_at': now() + datetime.timedelta(days = 30),
+                'activated_at': now(),
+                'expires_at': None,
+            }
+            record.update(fields)
+            record['customer_id'] = customer_id
+            record['product_id'] = product_id
+            return self._stamp(record, self.subscriptions)
+
+    def seed(self, customers = 0, products = 1, subscriptions_per_customer = 1):
+        """
+        Fill the store with generated records
+        """
+        product_ids = []
+        for i in range(products):
+            product_ids.append(self.add_product(
+                name = 'Plan %i' % (i + 1), handle = 'plan-%i' % (i + 1), accounting_code = 'AC%i' % (i + 1),
+                price_in_cents = (i + 1) * 1000, interval_unit = 'month', interval = 1)['id'])
+        for i in range(customers):
+            customer = self.add_customer(
+                first_name = 'First%i' % i, last_name = 'Last%i' % i, email = 'customer%i@example.com' % i,
+                organization = 'Organization %i' % i, reference = 'ref%i' % i)
+            card = stored_card({'first_name': 'First%i' % i, 'last_name': 'Last%i' % i, 'full_number': '4111111111111111'})
+            for j in range(subscriptions_per_customer):
+                self.add_subscription(customer['id'], product_ids[(i + j) % len(product_ids)], credit_card = dict(card))
+
+    def subscription(self, record):
+        """
+        A subscription with its customer and product embedded
+        """
+        data = dict(record)
+        data['customer'] = self.customers.get(data.pop('customer_id'))
+        data['product'] = self.products.get(data.pop('product_id'))
+        return data
+
+
+class FakeError(Exception):
+    def __init__(self, status, errors = ()):
+        self.status = status
+        self.errors = errors
+
+
+def _render_value(value):
+    if value is None:
+        return ' nil="true">', ''
+    if isinstance(value, bool):
+        return ' type="boolean">', value and 'true' or 'false'
+    if isinstance(value, (int, long)):
+        return ' type="integer">', str(value)
+    if isinstance(value, datetime.datetime):
+        return ' type="datetime">', value.isoformat()
+    return '>', escape(unicode(value))
+
+def render_xml(name, record, out):
+    out.append('<%s>' % name)
+    for field, value in sorted(record.items()):
+        if isinstance(value, dict):
+            render_xml(field, value, out)
+        else:
+            attributes, text = _render_value(value)
+            out.append('<%s%s%s</%s>' % (field, attributes, text, field))
+    out.append('</%s>' % name)
+
+def _json_ready(record):
+    data = {}
+    for field, value in record.items():
+        if isinstance(value, dict):
+            value = _json_ready(value)
+        elif isinstance(value, datetime.datetime):
+            value = value.isoformat()
+        data[field] = value
+    return data
+
+def _parse_xml(body):
+    def element(node):
+        if len(node):
+            return dict((child.tag, element(child)) for child in node)
+        return node.text or ''
+    root = ElementTree.fromstring(body)
+    return root.tag, element(root)
+
+def _parse_json(body):
+    data = json.loads(body)
+    name, record = data.items()[0]
+    return str(name), record
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers one request from the server's store, after the configured
+    latency, unless a fault is injected
+    """
+    protocol_version = 'HTTP/1.1'
+    # Buffer the status line, headers and body into one write, flushed after
+    # each request, small writes stall on delayed ACKs
+    wbufsize = -1
+    routes = (
+        ('GET', r'/customers', 'list_customers'),
+        ('POST', r'/customers', 'create_customer'),
+        ('GET', r'/customers/lookup', 'lookup_customer'),
+        ('GET', r'/customers/(\d+)', 'get_customer'),
+        ('PUT', r'/customers/(\d+)', 'update_customer'),
+        ('GET', r'/customers/(\d+)/subscriptions', 'customer_subscriptions'),
+        ('GET', r'/products', 'list_products'),
+        ('POST', r'/products', 'create_product'),
+        ('GET', r'/products/(\d+)', 'get_product'),
+        ('PUT', r'/products/(\d+)', 'update_product'),
+        ('GET', r'/products/handle/([^/]+)', 'get_product_by_handle'),
+        ('GET', r'/subscriptions', 'list_subscriptions'),
+        ('POST', r'/subscriptions', 'create_subscription'),
+        ('GET', r'/subscriptions/(\d+)', 'get_subscription'),
+        ('PUT', r'/subscriptions/(\d+)', 'update_subscription'),
+        ('DELETE', r'/subscriptions/(\d+)', 'cancel_subscription'),
+        ('PUT', r'/subscriptions/(\d+)/reset_balance', 'reset_balance'),
+        ('PUT', r'/subscriptions/(\d+)/reactivate', 'reactivate'),
+    )
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    @property
+    def store(self):
+        return self.server.fake.store
+
+    def read_body(self):
+        if self.headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(';')[0], 16)
+                if not size:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            return ''.join(chunks)
+        length = int(self.headers.get('content-length') or 0)
+        return length and self.rfile.read(length) or ''
+
+    def reset(self):
+        """
+        Drop the connection with a TCP reset instead of answering
+        """
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        self.close_connection = 1
+
+    def send(self, status, body = '', content_type = 'application/xml'):
+        """
+        Set the response, written by dispatch once the store is unlocked
+        """
+        self.response = (status, body, content_type)
+
+    def write_response(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_errors(self, status, errors):
+        if self.format == 'json':
+            self.send(status, json.dumps({'errors': list(errors)}), 'application/json')
+        else:
+            out = [XML_DECLARATION, '<errors>']
+            out.extend(['<error>%s</error>' % escape(error) for error in errors])
+            out.append('</errors>')
+            self.send(status, ''.join(out))
+
+    def send_records(self, name, records, many = False):
+        if self.format == 'json':
+            if many:
+                body = json.dumps([{name: _json_ready(record)} for record in records])
+            else:
+                body = json.dumps({name: _json_ready(records)})
+            return self.send(200, body, 'application/json')
+        out = [XML_DECLARATION]
+        if many:
+            out.append('<%ss type="array">' % name)
+            for record in records:
+                render_xml(name, record, out)
+            out.append('</%ss>' % name)
+        else:
+            render_xml(name, records, out)
+        self.send(200, ''.join(out))
+
+    def authorized(self):
+        api_key = self.server.fake.api_key
+        if api_key is None:
+            return True
+        expected = 'Basic ' + base64.b64encode('%s:x' % api_key)
+        return self.headers.get('authorization') == expected
+
+    def dispatch(self, method):
+        self.response = None
+        self.route(method)
+        # A slow client must not hold up the other requests on the store
+        if self.response is not None:
+            self.write_response(*self.response)
+
+    def route(self, method):
+        fake = self.server.fake
+        path, _, query = self.path.partition('?')
+        path, _, self.format = path.rpartition('.')
+        self.query = cgi.parse_qs(query)
+        body = self.read_body()
+        fake.count(method)
+        if fake.latency is not None:
+            time.sleep(max(0.0, fake.latency()))
+        if fake.reset_rate and fake.random() < fake.reset_rate:
+            return self.reset()
+        if fake.error_rate and fake.random() < fake.error_rate:
+            status = random.choice(fake.error_statuses)
+            return self.send_errors(status, ['Injected error %i' % status])
+        if self.format not in ('xml', 'json'):
+            return self.send_errors(404, ['Not found'])
+        if not self.authorized():
+            return self.send_errors(401, ['Access denied'])
+        for route_method, pattern, handler in self.routes:
+            match = re.match(pattern + '$', path)
+            if route_method == method and match:
+                try:
+                    with self.store.lock:
+                        getattr(self, handler)(body, *match.groups())
+                except FakeError, e:
+                    self.send_errors(e.status, e.errors or ['Error'])
+                return
+        self.send_errors(404, ['Not found'])
+
+    # Request bodies and lookups
+
+    def record(self, body, name):
+        try:
+            if self.format == 'json':
+                root, record = _parse_json(body)
+            else:
+                root, record = _parse_xml(body)
+        except Exception:
+            raise FakeError(422, ['Could not parse the request body'])
+        if root != name or not isinstance(record, dict):
+            raise FakeError(422, ['Expected a %s' % name])
+        for field in READ_ONLY:
+            record.pop(field, None)
+        return record
+
+    def find(self, records, id):
+        record = records.get(int(id))
+        if record is None:
+            raise FakeError(404, ['Not found'])
+        return record
+
+    def changed(self, records):
+        """
+        Apply the date_field / start_datetime / end_datetime filters and the
+        sort / direction order of a listing
+        """
+        from dates import parse_datetime
+        date_field = self.query.get('date_field', ['updated_at'])[0]
+        records = [records[id] for id in sorted(records)]
+        for name, keep in (('start_datetime', lambda value, bound: value >= bound),
+                           ('end_datetime', lambda value, bound: value <= bound)):
+            if name in self.query:
+                bound = parse_datetime(self.query[name][0])
+                records = [record for record in records
+                           if record.get(date_field) is not None and keep(record[date_field], bound)]
+        sort = self.query.get('sort', [None])[0]
+        if sort:
+            records.sort(key = lambda record: (record.get(sort), record['id']))
+        if self.query.get('direction', ['asc'])[0] == 'desc':
+            records.reverse()
+        return records
+
+    def page(self, records):
+        fake = self.server.fake
+        if isinstance(records, dict):
+            records = [records[id] for id in sorted(records)]
+        page = int(self.query.get('page', ['1'])[0])
+        per_page = int(self.query.get('per_page', [fake.page_size])[0])
+        per_page = min(per_page, fake.max_per_page)
+        start = (page - 1) * per_page
+        return records[start:start + per_page]
+
+    def customer_fields(self, record):
+        missing = [field for field in ('first_name', 'last_name', 'email') if not record.get(field)]
+        if missing:
+            raise FakeError(422, ['%s: cannot be blank.' % field.replace('_', ' ').capitalize() for field in missing])
+        return record
+
+    # Customers
+
+    def list_customers(self, body):
+        self.send_records('customer', self.page(self.changed(self.store.customers)), True)
+
+    def create_customer(self, body):
+        record = self.customer_fields(self.record(body, 'customer'))
+        self.send_records('customer', self.store.add_customer(**record))
+
+    def lookup_customer(self, body):
+        reference = self.query.get('reference', [''])[0]
+        for record in self.store.customers.values():
+            if record.get('reference') == reference:
+                return self.send_records('customer', record)
+        raise FakeError(404, ['Not found'])
+
+    def get_customer(self, body, id):
+        self.send_records('customer', self.find(self.store.customers, id))
+
+    def update_customer(self, body, id):
+        record = self.find(self.store.customers, id)
+        record.update(self.record(body, 'customer'))
+        self.send_records('customer', self.store._stamp(record))
+
+    def customer_subscriptions(self, body, id):
+        self.find(self.store.customers, id)
+        records = dict((key, record) for key, record in self.store.subscriptions.items()
+                       if record['customer_id'] == int(id))
+        self.send_records('subscription', [self.store.subscription(record) for record in self.page(records)], True)
+
+    # Products
+
+    def list_products(self, body):
+        self.send_records('product', self.page(self.store.products), True)
+
+    def create_product(self, body):
+        self.send_records('product', self.store.add_product(**self.record(body, 'product')))
+
+    def get_product(self, body, id):
+        self.send_records('product', self.find(self.store.products, id))
+
+    def update_product(self, body, id):
+        record = self.find(self.store.products, id)
+        record.update(self.record(body, 'product'))
+        self.send_records('product', self.store._stamp(record))
+
+    def get_product_by_handle(self, body, handle):
+        for record in self.store.products.values():
+            if record.get('handle') == handle:
+                return self.send_records('product', record)
+        raise FakeError(404, ['Not found'])
+
+    # Subscriptions
+
+    def list_subscriptions(self, body):
+        records = self.page(self.changed(self.store.subscriptions))
+        self.send_records('subscription', [self.store.subscription(record) for record in records], True)
+
+    def create_subscription(self, body):
+        record = self.record(body, 'subscription')
+        customer = record.pop('customer_attributes', None)
+        customer_id = record.pop('customer_id', None)
+        if customer_id:
+            customer_id = self.find(self.store.customers, customer_id)['id']
+        elif isinstance(customer, dict):
+            customer_id = self.store.add_customer(**self.customer_fields(customer))['id']
+        else:
+            raise FakeError(422, ['A customer is required'])
+        handle = record.pop('product_handle', None)
+        record.pop('product', None)
+        for product in self.store.products.values():
+            if product.get('handle') == handle:
+                break
+        else:
+            raise FakeError(422, ['Product: must be specified'])
+        card = record.pop('credit_card_attributes', None)
+        if isinstance(card, dict):
+            record['credit_card'] = stored_card(card)
+        subscription = self.store.add_subscription(customer_id, product['id'], **record)
+        self.send_records('subscription', self.store.subscription(subscription))
+
+    def get_subscription(self, body, id):
+        self.send_records('subscription', self.store.subscription(self.find(self.store.subscriptions, id)))
+
+    def update_subscription(self, body, id):
+        record = self.find(self.store.subscriptions, id)
+        changes = self.record(body, 'subscription')
+        handle = changes.pop('product_handle', None)
+        if handle:
+            for product in self.store.products.values():
+                if product.get('handle') == handle:
+                    record['product_id'] = product['id']
+                    break
+            else:
+                raise FakeError(422, ['Product: must be specified'])
+        card = changes.pop('credit_card_attributes', None)
+        if isinstance(card, dict):
+            changes['credit_card'] = stored_card(card)
+        for field in ('customer', 'product', 'customer_id', 'customer_attributes'):
+            changes.pop(field, None)
+        record.update(changes)
+        self.send_records('subscription', self.store.subscription(self.store._stamp(record)))
+
+    def cancel_subscription(self, body, id):
+        record = self.find(self.store.subscriptions, id)
+        record['state'] = 'canceled'
+        self.send_records('subscription', self.store.subscription(self.store._stamp(record)))
+
+    def reset_balance(self, body, id):
+        record = self.find(self.store.subscriptions, id)
+        record['balance_in_cents'] = 0
+        self.send_records('subscription', self.store.subscription(self.store._stamp(record)))
+
+    def reactivate(self, body, id):
+        record = self.find(self.store.subscriptions, id)
+        record['state'] = 'active'
+        self.send_records('subscription', self.store.subscription(self.store._stamp(record)))
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeChargify(object):
+    """
+    Serves the Chargify endpoints used by pychargify from an in-memory Store
+    on `host`:`port` (0 picks a free port).
+
+    `page_size` is the default per_page of listings and `max_per_page` its
+    upper limit.  Every request first waits for `latency()` seconds, when
+    set, then with probability `reset_rate` the connection is reset and with
+    probability `error_rate` the answer is one of `error_statuses`.  With an
+    `api_key` requests must authenticate with it.
+    """
+    # Hook so tests can control fault injection
+    random = staticmethod(random.random)
+
+    def __init__(self, host = '127.0.0.1', port = 0, page_size = 20, max_per_page = 200,
+                 latency = None, error_rate = 0.0, error_statuses = (401, 404, 422, 500),
+                 reset_rate = 0.0, api_key = None, store = None):
+        self.page_size = page_size
+        self.max_per_page = max_per_page
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_statuses = error_statuses
+        self.reset_rate = reset_rate
+        self.api_key = api_key
+        self.store = store or Store()
+        self.requests = {}
+        self._lock = threading.Lock()
+        self.server = Server((host, port), Handler)
+        self.server.fake = self
+        self._thread = None
+
+    @property
+    def host(self):
+        host, port = self.server.server_address
+        return '%s:%i' % (host, port)
+
+    def count(self, method):
+        with self._lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+
+    def start(self):
+        self._thread = threading.Thread(target = self.server.serve_forever, name = 'fake-chargify')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def client(self, **kwargs):
+        """
+        A Chargify client talking to this server
+        """
+        from api import Chargify
+        return Chargify(self.api_key or 'key', 'fake', base_host = self.host, scheme = 'http', **kwargs)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
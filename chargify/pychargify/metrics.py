@@ -0,0 +1,270 @@
+'''
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+Request instrumentation: hooks called around every API request, an
+in-process aggregator and a Prometheus text exporter for it
+'''
+
+import logging
+import re
+import threading
+import time
+
+from stats import Histogram, DEFAULT_BUCKETS
+
+log = logging.getLogger("pychargify.metrics")
+
+clock = time.time
+
+_ID_RX = re.compile(r'/\d+(?=[/.]|$)')
+_HANDLE_RX = re.compile(r'/handle/[^/.]+')
+
+
+def path_template(url):
+    """
+    The path of `url` with ids and handles collapsed and the query dropped,
+    so every request to one endpoint shares a template:
+    '/customers/42/subscriptions.xml' -> '/customers/:id/subscriptions.xml'
+    """
+    path = url.split('?', 1)[0]
+    path = _HANDLE_RX.sub('/handle/:handle', path)
+    return _ID_RX.sub('/:id', path)
+
+
+class RequestInfo(object):
+    """
+    What is known about one API request.  Hooks get it before the request
+    is sent (method, url, path, request_bytes) and after the response has
+    been read, with the status (None when the request raised `error`), the
+    response size and its timings in seconds:
+
+    `connect`   opening the connection, 0 for a reused one
+    `ttfb`      from starting the attempt to reading the response headers
+    `total`     the whole call including retries and rate limit waits
+    `decode`    decoding the body into objects, None unless the call decoded it
+
+    `connect` and `ttfb` are those of the last of `attempts`.
+    """
+    __slots__ = ('method', 'url', 'path', 'status', 'request_bytes', 'response_bytes',
+                 'connect', 'ttfb', 'total', 'decode', 'attempts', 'error')
+
+    def __init__(self, method, url, body = None):
+        self.method = method
+        self.url = url
+        self.path = path_template(url)
+        self.status = None
+        if isinstance(body, basestring):
+            self.request_bytes = len(body)
+        else:
+            self.request_bytes = 0
+        self.response_bytes = 0
+        self.connect = None
+        self.ttfb = None
+        self.total = None
+        self.decode = None
+        self.attempts = 0
+        self.error = None
+
+    def __repr__(self):
+        return '<RequestInfo %s %s %s %.4fs>' %(self.method, self.path, self.status, self.total or 0)
+
+
+class RequestHooks(object):
+    """
+    The pre-request and post-response callbacks of a transport, each is
+    called with the RequestInfo.  An exception raised by a hook is logged
+    and does not affect the request.
+    """
+    def __init__(self):
+        self.pre_request_hooks = []
+        self.post_response_hooks = []
+
+    def add(self, pre_request = None, post_response = None):
+        if pre_request is not None:
+            self.pre_request_hooks.append(pre_request)
+        if post_response is not None:
+            self.post_response_hooks.append(post_response)
+
+    def remove(self, pre_request = None, post_response = None):
+        if pre_request in self.pre_request_hooks:
+            self.pre_request_hooks.remove(pre_request)
+        if post_response in self.post_response_hooks:
+            self.post_response_hooks.remove(post_response)
+
+    def __len__(self):
+        return len(self.pre_request_hooks) + len(self.post_response_hooks)
+
+    def _run(self, hooks, info):
+        for hook in hooks:
+            try:
+                hook(info)
+            except Exception:
+                log.exception("Request hook %r failed" %(hook,))
+
+    def pre_request(self, info):
+        self._run(self.pre_request_hooks, info)
+
+    def post_response(self, info):
+        self._run(self.post_response_hooks, info)
+
+
+class EndpointMetrics(object):
+    """
+    The histograms and counters of one method and path template
+    """
+    def __init__(self, buckets):
+        self.total = Histogram(buckets)
+        self.ttfb = Histogram(buckets)
+        self.connect = Histogram(buckets)
+        self.decode = Histogram(buckets)
+        self.statuses = {}
+        self.request_bytes = 0
+        self.response_bytes = 0
+
+
+class MetricsCollector(object):
+    """
+    A post-response hook aggregating requests per method and path template
+    into duration Histograms and status and byte counters
+
+        collector = MetricsCollector()
+        chargify.add_hooks(post_response = collector)
+        ...
+        collector.snapshot()
+        collector.prometheus()
+    """
+    def __init__(self, buckets = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def _endpoint(self, method, path):
+        key = (method, path)
+        endpoint = self._endpoints.get(key)
+        if endpoint is None:
+            self._lock.acquire()
+            try:
+                endpoint = self._endpoints.get(key)
+                if endpoint is None:
+                    endpoint = self._endpoints[key] = EndpointMetrics(self.buckets)
+            finally:
+                self._lock.release()
+        return endpoint
+
+    def __call__(self, info):
+        endpoint = self._endpoint(info.method, info.path)
+        endpoint.total.observe(info.total or 0.0)
+        if info.ttfb is not None:
+            endpoint.ttfb.observe(info.ttfb)
+        if info.connect:
+            endpoint.connect.observe(info.connect)
+        if info.decode is not None:
+            endpoint.decode.observe(info.decode)
+        status = info.status is None and 'error' or str(info.status)
+        self._lock.acquire()
+        try:
+            endpoint.statuses[status] = endpoint.statuses.get(status, 0) + 1
+            endpoint.request_bytes += info.request_bytes
+            endpoint.response_bytes += info.response_bytes
+        finally:
+            self._lock.release()
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self._endpoints = {}
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        """
+        A dict of (method, path) to the counters and histogram snapshots
+        """
+        self._lock.acquire()
+        try:
+            endpoints = self._endpoints.items()
+            counters = dict((key, (dict(endpoint.statuses), endpoint.request_bytes, endpoint.response_bytes))
+                            for key, endpoint in endpoints)
+        finally:
+            self._lock.release()
+        snapshot = {}
+        for key, endpoint in endpoints:
+            statuses, request_bytes, response_bytes = counters[key]
+            snapshot[key] = {
+                'statuses': statuses,
+                'request_bytes': request_bytes,
+                'response_bytes': response_bytes,
+                'total': endpoint.total.snapshot(),
+                'ttfb': endpoint.ttfb.snapshot(),
+                'connect': endpoint.connect.snapshot(),
+                'decode': endpoint.decode.snapshot(),
+            }
+        return snapshot
+
+    def prometheus(self, prefix = 'pychargify'):
+        return prometheus_text(self.snapshot(), prefix)
+
+
+# Metric name suffix, help text and snapshot key of each histogram
+HISTOGRAMS = (
+    ('request_duration_seconds', 'Time spent in Chargify API calls, including retries', 'total'),
+    ('time_to_first_byte_seconds', 'Time until the response headers were read', 'ttfb'),
+    ('connect_seconds', 'Time spent opening new connections', 'connect'),
+    ('decode_duration_seconds', 'Time spent decoding response bodies', 'decode'),
+)
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(**labels):
+    return '{%s}' % ','.join(['%s="%s"' %(name, _label(value)) for name, value in sorted(labels.items())])
+
+def _number(value):
+    return repr(float(value))
+
+def prometheus_text(snapshot, prefix = 'pychargify'):
+    """
+    Render a MetricsCollector snapshot in the Prometheus text exposition
+    format, for a metrics view or the textfile collector
+    """
+    lines = []
+    endpoints = sorted(snapshot.items())
+    lines.append('# HELP %s_requests_total Chargify API requests by response status' % prefix)
+    lines.append('# TYPE %s_requests_total counter' % prefix)
+    for (method, path), data in endpoints:
+        for status, count in sorted(data['statuses'].items()):
+            lines.append('%s_requests_total%s %i' %(prefix, _labels(method = method, path = path, status = status), count))
+    for name, help, key in (('request_bytes_total', 'Bytes sent in request bodies', 'request_bytes'),
+                            ('response_bytes_total', 'Bytes received in response bodies', 'response_bytes')):
+        lines.append('# HELP %s_%s %s' %(prefix, name, help))
+        lines.append('# TYPE %s_%s counter' %(prefix, name))
+        for (method, path), data in endpoints:
+            lines.append('%s_%s%s %i' %(prefix, name, _labels(method = method, path = path), data[key]))
+    for name, help, key in HISTOGRAMS:
+        metric = '%s_%s' %(prefix, name)
+        lines.append('# HELP %s %s' %(metric, help))
+        lines.append('# TYPE %s histogram' % metric)
+        for (method, path), data in endpoints:
+            histogram = data[key]
+            if not histogram['count']:
+                continue
+            for bound, count in histogram['buckets']:
+                le = bound is None and '+Inf' or _number(bound)
+                lines.append('%s_bucket%s %i' %(metric, _labels(method = method, path = path, le = le), count))
+            labels = _labels(method = method, path = path)
+            lines.append('%s_sum%s %s' %(metric, labels, _number(histogram['sum'])))
+            lines.append('%s_count%s %i' %(metric, labels, histogram['count']))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,133 @@
+'''
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+Lazy iteration over Chargify's paged listing endpoints
+'''
+
+from collections import deque
+from _futures import ThreadPoolExecutor
+
+DEFAULT_PAGE_SIZE = 50
+
+
+class Pager(object):
+    """
+    Iterates over a paged listing, fetching a page only once the objects of
+    the previous one have been consumed.
+
+    `fetch` is called with (page, page_size) and returns the list of objects
+    on that page.  Iteration stops after the first short page, or with
+    `until_empty` set only after an empty one, for walks that must not end
+    early when the server caps per_page below page_size.  `complete` tells
+    whether the walk reached that end, rather than stopping because the
+    endpoint repeated a page.
+
+    `next_page` is the cursor to resume from: the first page that has not
+    been completely consumed.  Passing it as `start_page` to a new Pager
+    continues the walk (objects of a partially consumed page are repeated).
+    """
+    def __init__(self, fetch, page_size = DEFAULT_PAGE_SIZE, start_page = 1):
+        if page_size < 1:
+            raise ValueError('page_size must be at least 1')
+        if start_page < 1:
+            raise ValueError('start_page must be at least 1')
+        self.fetch = fetch
+        self.page_size = page_size
+        self.start_page = start_page
+        self.page = None
+        self.next_page = start_page
+        self.finished = False
+        self.complete = False
+        self.until_empty = False
+
+    def _last(self, objs):
+        """
+        Whether `objs` is the last page of the listing
+        """
+        if self.until_empty:
+            return not objs
+        return len(objs) < self.page_size
+
+    def __iter__(self):
+        page = self.next_page
+        last_ids = None
+        while not self.finished:
+            objs = self.fetch(page, self.page_size)
+            ids = [getattr(obj, 'id', None) for obj in objs]
+            if objs and ids == last_ids:
+                # The endpoint ignored the page parameter and repeated itself
+                self.finished = True
+                break
+            last_ids = ids
+            self.page = page
+            for obj in objs:
+                yield obj
+            page += 1
+            self.next_page = page
+            if self._last(objs):
+                self.finished = self.complete = True
+
+
+class PrefetchPager(Pager):
+    """
+    A Pager that keeps up to `prefetch` pages requested ahead of the consumer
+    on a pool of threads.  Pages are still yielded in order.
+
+    The window also bounds memory: at most `prefetch` pages are being fetched
+    or sit decoded waiting for the consumer, a new request is only sent when
+    the consumer moves on to the next page.
+    """
+    def __init__(self, fetch, page_size = DEFAULT_PAGE_SIZE, start_page = 1, prefetch = 4):
+        super(PrefetchPager, self).__init__(fetch, page_size, start_page)
+        if prefetch < 1:
+            raise ValueError('prefetch must be at least 1')
+        self.prefetch = prefetch
+
+    def __iter__(self):
+        if self.finished:
+            return
+        executor = ThreadPoolExecutor(self.prefetch, 'pychargify-prefetch')
+        window = deque()
+        submit_page = self.next_page
+        last_ids = None
+        try:
+            for i in range(self.prefetch):
+                window.append(executor.submit(self.fetch, submit_page, self.page_size))
+                submit_page += 1
+            while window:
+                objs = window.popleft().result()
+                ids = [getattr(obj, 'id', None) for obj in objs]
+                if objs and ids == last_ids:
+                    # The endpoint ignored the page parameter and repeated itself
+                    self.finished = True
+                    break
+                if self._last(objs):
+                    self.finished = self.complete = True
+                else:
+                    window.append(executor.submit(self.fetch, submit_page, self.page_size))
+                    submit_page += 1
+                last_ids = ids
+                page = self.next_page
+                self.page = page
+                for obj in objs:
+                    yield obj
+                self.next_page = page + 1
+                if self.finished:
+                    break
+        finally:
+            for future in window:
+                future.cancel()
+            executor.shutdown(wait = False)
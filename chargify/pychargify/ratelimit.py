@@ -0,0 +1,176 @@
+'''
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+Client side token bucket rate limiting
+'''
+
+import os
+import re
+import threading
+import time
+
+from _futures import Future
+from stats import Histogram
+
+
+class RateLimitBackend(object):
+    """
+    Stores token buckets.  Subclasses implement `take` atomically, for
+    example on top of a shared cache so several hosts share one budget.
+    """
+    def take(self, key, rate, burst, now, reserve):
+        """
+        Refill the bucket for `key` at `rate` tokens per second up to `burst`
+        and take one token.  Returns how many seconds the caller has to wait
+        for its token, 0 when one was available.  When the bucket is empty
+        a token is only taken (borrowed against the refill) if `reserve`.
+        """
+        raise NotImplementedError()
+
+    def _take(self, state, rate, burst, now, reserve):
+        """
+        The token bucket arithmetic on a (tokens, last refill) tuple,
+        returns (new state, wait)
+        """
+        if state is None:
+            tokens, last = burst, now
+        else:
+            tokens, last = state
+        tokens = min(burst, tokens + max(0.0, now - last) * rate)
+        if tokens >= 1:
+            return (tokens - 1, now), 0.0
+        wait = (1 - tokens) / rate
+        if reserve:
+            return (tokens - 1, now), wait
+        return (tokens, now), wait
+
+
+class LocalBackend(RateLimitBackend):
+    """
+    Buckets shared by the threads of one process
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def take(self, key, rate, burst, now, reserve):
+        self._lock.acquire()
+        try:
+            self._buckets[key], wait = self._take(self._buckets.get(key), rate, burst, now, reserve)
+            return wait
+        finally:
+            self._lock.release()
+
+
+class FileBackend(RateLimitBackend):
+    """
+    Buckets kept in small files under `directory` and updated under an
+    exclusive lock, so every process on one host shares the same budget
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory, re.sub(r'[^A-Za-z0-9_.-]', '_', key) + '.bucket')
+
+    def take(self, key, rate, burst, now, reserve):
+        import fcntl
+        fd = os.open(self._path(key), os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            data = os.read(fd, 64).split()
+            state = None
+            if len(data) == 2:
+                state = (float(data[0]), float(data[1]))
+            state, wait = self._take(state, rate, burst, now, reserve)
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, '%r %r' % state)
+            return wait
+        finally:
+            os.close(fd)
+
+
+class RateLimiter(object):
+    """
+    Limits requests to `rate` per second for each key (the request host, so
+    one budget per Chargify subdomain), allowing bursts of up to `burst`.
+
+    acquire() blocks until a token is available (or gives up after
+    `timeout`), try_acquire() never blocks and acquire_async() returns a
+    Future that completes once the token may be used.  Time spent waiting
+    is recorded in the `wait_times` Histogram.
+    """
+    clock = staticmethod(time.time)
+    sleep = staticmethod(time.sleep)
+
+    def __init__(self, rate, burst = None, backend = None):
+        if rate <= 0:
+            raise ValueError('rate must be positive')
+        self.rate = float(rate)
+        self.burst = float(burst or max(1, rate))
+        if backend is None:
+            backend = LocalBackend()
+        self.backend = backend
+        self.wait_times = Histogram()
+
+    def acquire(self, key, block = True, timeout = None):
+        """
+        Take a token for `key`, returns False if none could be had without
+        blocking or within `timeout` seconds
+        """
+        if not block:
+            return self.try_acquire(key)
+        if timeout is not None:
+            wait = self.backend.take(key, self.rate, self.burst, self.clock(), False)
+            if wait == 0:
+                self.wait_times.observe(0.0)
+                return True
+            if wait > timeout:
+                return False
+        wait = self.backend.take(key, self.rate, self.burst, self.clock(), True)
+        if wait > 0:
+            self.sleep(wait)
+        self.wait_times.observe(wait)
+        return True
+
+    def try_acquire(self, key):
+        """
+        Take a token for `key` only if one is available right now
+        """
+        if self.backend.take(key, self.rate, self.burst, self.clock(), False) == 0:
+            self.wait_times.observe(0.0)
+            return True
+        return False
+
+    def acquire_async(self, key):
+        """
+        Reserve a token for `key` and return a Future that completes with the
+        seconds waited once the token may be used
+        """
+        wait = self.backend.take(key, self.rate, self.burst, self.clock(), True)
+        self.wait_times.observe(wait)
+        future = Future()
+        future.set_running_or_notify_cancel()
+        if wait <= 0:
+            future.set_result(wait)
+        else:
+            timer = threading.Timer(wait, future.set_result, [wait])
+            timer.daemon = True
+            timer.start()
+        return future
@@ -0,0 +1,150 @@
+'''
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+Logging of request and response bodies.  Nothing is formatted unless a
+record is emitted, and bodies are then truncated and scrubbed of card
+numbers and verification codes.
+'''
+
+import logging
+import random
+import re
+
+# Below DEBUG, the level the bodies have always been logged at
+TRACE = 5
+logging.addLevelName(TRACE, 'TRACE')
+
+# Card fields whose values are never logged
+SECRET_FIELDS = ('full_number', 'card_number', 'cvv', 'ccv')
+# Card fields replaced by their last four digits
+MASKED_FIELDS = ('full_number', 'card_number')
+
+_XML_FIELD_RX = re.compile(r'(<(%s)(?:\s[^>]*)?>)([^<]*)(</\2>)' % '|'.join(SECRET_FIELDS))
+_JSON_FIELD_RX = re.compile(r'("(%s)"\s*:\s*)("[^"]*"|\d+)' % '|'.join(SECRET_FIELDS))
+# 13 to 19 digits, optionally grouped by spaces or dashes
+_PAN_RX = re.compile(r'(?<!\d)\d(?:[ -]?\d){12,18}(?!\d)')
+
+
+def luhn_valid(digits):
+    total = 0
+    for i, digit in enumerate(reversed(digits)):
+        n = ord(digit) - 48
+        if i % 2:
+            n *= 2
+            if n > 9:
+                n -= 9
+        total += n
+    return total % 10 == 0
+
+def _mask(value, field):
+    digits = re.sub(r'\D', '', value)
+    if field in MASKED_FIELDS and len(digits) > 4:
+        return 'XXXX-XXXX-XXXX-' + digits[-4:]
+    return '[FILTERED]'
+
+def _mask_pan(match):
+    digits = re.sub(r'\D', '', match.group())
+    if luhn_valid(digits):
+        return 'XXXX-XXXX-XXXX-' + digits[-4:]
+    return match.group()
+
+def _mask_xml(match):
+    return match.group(1) + _mask(match.group(3), match.group(2)) + match.group(4)
+
+def _mask_json(match):
+    value = match.group(3)
+    return '%s"%s"' %(match.group(1), _mask(value.strip('"'), match.group(2)))
+
+def redact(text):
+    """
+    Replace card numbers and verification codes in an XML or JSON body
+    """
+    text = _XML_FIELD_RX.sub(_mask_xml, text)
+    text = _JSON_FIELD_RX.sub(_mask_json, text)
+    return _PAN_RX.sub(_mask_pan, text)
+
+
+class Payload(object):
+    """
+    A request or response body formatted only if a log record shows it:
+    redacted, then cut down to `max_bytes`
+    """
+    __slots__ = ('body', 'max_bytes')
+
+    def __init__(self, body, max_bytes):
+        self.body = body
+        self.max_bytes = max_bytes
+
+    def __str__(self):
+        body = self.body
+        if body is None:
+            return ''
+        if not isinstance(body, basestring):
+            return '<streamed body>'
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        size = len(body)
+        # Redacted whole, a cut through a card number or its element would
+        # keep it from being recognised
+        text = redact(body)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return '%s... (%i bytes)' %(text[:self.max_bytes], size)
+        return text
+
+
+class RequestLogger(object):
+    """
+    Logs one record per request and per response at `level`, with the
+    method, url, status and body size as structured fields (the `chargify`
+    dict attribute of the record).  Bodies are attached to a `sample_rate`
+    fraction of the records, truncated to `max_bytes` (None for whole
+    bodies).
+    """
+    def __init__(self, logger, level = TRACE, max_bytes = 2048, sample_rate = 1.0):
+        self.logger = logger
+        self.level = level
+        self.max_bytes = max_bytes
+        self.sample_rate = sample_rate
+
+    # Hook so tests can control sampling
+    random = staticmethod(random.random)
+
+    def _payload(self, body):
+        if body and (self.sample_rate >= 1 or self.random() < self.sample_rate):
+            return Payload(body, self.max_bytes)
+        return '-'
+
+    def _size(self, body):
+        if isinstance(body, basestring):
+            return len(body)
+        return None
+
+    def enabled(self):
+        return self.logger.isEnabledFor(self.level)
+
+    def request(self, method, url, body):
+        if not self.logger.isEnabledFor(self.level):
+            return
+        fields = {'method': method, 'url': url, 'bytes': self._size(body)}
+        self.logger.log(self.level, "Sending %s %s: %s", method, url, self._payload(body),
+                        extra = {'chargify': fields})
+
+    def response(self, method, url, status, body):
+        if not self.logger.isEnabledFor(self.level):
+            return
+        fields = {'method': method, 'url': url, 'status': status, 'bytes': self._size(body)}
+        self.logger.log(self.level, "Server Response %s to %s %s: %s", status, method, url, self._payload(body),
+                        extra = {'chargify': fields})
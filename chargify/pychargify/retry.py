@@ -0,0 +1,196 @@
+'''
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+Retrying of failed requests with exponential backoff
+'''
+
+import httplib
+import random
+import socket
+import sys
+import threading
+import time
+from email.utils import parsedate_tz, mktime_tz
+import logging
+
+log = logging.getLogger("pychargify.retry")
+
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+
+
+def _rules(rules, default):
+    """
+    Turn a sequence of statuses/exceptions into a {rule: max retries} dict
+    """
+    if rules is None:
+        return {}
+    if isinstance(rules, dict):
+        return dict(rules)
+    return dict((rule, default) for rule in rules)
+
+def parse_retry_after(value, now = None):
+    """
+    Return the number of seconds a Retry-After header asks us to wait, it is
+    either a number of seconds or an HTTP date
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    if now is None:
+        now = time.time()
+    return max(0, mktime_tz(parsed) - now)
+
+
+class RetryPolicy(object):
+    """
+    Decides whether and when a failed request is sent again.
+
+    `statuses` and `exceptions` are either sequences, each allowed
+    `max_retries` retries, or dicts mapping a status code / exception class to
+    its own number of retries.  The wait before retry n is drawn uniformly
+    from [0, min(max_backoff, backoff_factor * 2 ** n)] ("full jitter"), unless
+    the server sent a Retry-After header which is then honoured.  No retry is
+    started once it would end after `deadline` seconds from the first attempt.
+
+    Only idempotent methods are retried, other methods only when the request
+    carries an Idempotency-Key header.
+
+    `stats()` returns counters for retries and give ups by reason.
+    """
+    def __init__(self, max_retries = 3,
+                 statuses = (429, 500, 502, 503, 504),
+                 exceptions = (socket.error, httplib.HTTPException),
+                 backoff_factor = 0.5, max_backoff = 30, deadline = None,
+                 respect_retry_after = True, methods = IDEMPOTENT_METHODS):
+        self.max_retries = max_retries
+        self.statuses = _rules(statuses, max_retries)
+        self.exceptions = _rules(exceptions, max_retries)
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+        self.respect_retry_after = respect_retry_after
+        self.methods = tuple(methods)
+        self._lock = threading.Lock()
+        self._stats = {'requests': 0, 'retries': 0, 'giveups': 0, 'reasons': {}}
+
+    # Hooks so tests can control time
+    sleep = staticmethod(time.sleep)
+    clock = staticmethod(time.time)
+    jitter = staticmethod(random.random)
+
+    def is_retryable(self, method, headers):
+        if method.upper() in self.methods:
+            return True
+        for name in (headers or {}):
+            if name.lower() == IDEMPOTENCY_HEADER.lower():
+                return True
+        return False
+
+    def backoff(self, retry):
+        return self.jitter() * min(self.max_backoff, self.backoff_factor * (2 ** retry))
+
+    def _exception_limit(self, error):
+        for exception, limit in self.exceptions.items():
+            if isinstance(error, exception):
+                return limit
+        return None
+
+    def _record(self, key, reason):
+        self._lock.acquire()
+        try:
+            self._stats[key] += 1
+            reasons = self._stats['reasons'].setdefault(reason, {'retries': 0, 'giveups': 0})
+            reasons[key] += 1
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """
+        A snapshot of the retry counters
+        """
+        self._lock.acquire()
+        try:
+            reasons = dict((k, dict(v)) for k, v in self._stats['reasons'].items())
+            return {'requests': self._stats['requests'], 'retries': self._stats['retries'],
+                    'giveups': self._stats['giveups'], 'reasons': reasons}
+        finally:
+            self._lock.release()
+
+    def _wait(self, start, delay, reason):
+        """
+        Sleep before the next attempt, returns False if the deadline forbids it
+        """
+        if self.deadline is not None and self.clock() - start + delay > self.deadline:
+            log.warning("Giving up on %s, retry would pass the %ss deadline" %(reason, self.deadline))
+            self._record('giveups', reason)
+            return False
+        log.warning("Retrying after %s in %.2fs" %(reason, delay))
+        self._record('retries', reason)
+        self.sleep(delay)
+        return True
+
+    def call(self, method, headers, send):
+        """
+        Call `send` until it returns a response that should not be retried,
+        or the retries or the deadline are used up.  The response gets a
+        `retries` attribute with the number of retries it took.
+        """
+        self._lock.acquire()
+        self._stats['requests'] += 1
+        self._lock.release()
+        retryable = self.is_retryable(method, headers)
+        start = self.clock()
+        retries = 0
+        while True:
+            try:
+                response = send()
+            except Exception, e:
+                exc_info = sys.exc_info()
+                reason = e.__class__.__name__
+                limit = self._exception_limit(e)
+                if limit is None:
+                    raise
+                if not retryable or retries >= limit:
+                    self._record('giveups', reason)
+                    raise
+                if not self._wait(start, self.backoff(retries), reason):
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                del exc_info
+            else:
+                limit = self.statuses.get(response.status)
+                if limit is None:
+                    response.retries = retries
+                    return response
+                reason = str(response.status)
+                if not retryable or retries >= limit:
+                    self._record('giveups', reason)
+                    response.retries = retries
+                    return response
+                delay = None
+                if self.respect_retry_after:
+                    delay = parse_retry_after(response.getheader('retry-after'), self.clock())
+                if delay is None:
+                    delay = self.backoff(retries)
+                if not self._wait(start, delay, reason):
+                    response.retries = retries
+                    return response
+            retries += 1
@@ -0,0 +1,89 @@
+'''
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+In-process statistics collectors
+'''
+
+import bisect
+import threading
+
+# Bucket upper bounds in seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram(object):
+    """
+    A thread safe histogram with fixed, cumulative buckets
+    """
+    def __init__(self, buckets = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self._counts = [0] * (len(self.buckets) + 1)
+            self._count = 0
+            self._sum = 0.0
+            self._max = 0.0
+        finally:
+            self._lock.release()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        self._lock.acquire()
+        try:
+            self._counts[index] += 1
+            self._count += 1
+            self._sum += value
+            if value > self._max:
+                self._max = value
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        """
+        Return count, sum, max and the cumulative (upper bound, count) buckets,
+        the last bucket's upper bound is None (+Inf)
+        """
+        self._lock.acquire()
+        try:
+            counts = list(self._counts)
+            count, total, largest = self._count, self._sum, self._max
+        finally:
+            self._lock.release()
+        cumulative = []
+        running = 0
+        for bound, n in zip(self.buckets + (None,), counts):
+            running += n
+            cumulative.append((bound, running))
+        return {'count': count, 'sum': total, 'max': largest, 'buckets': cumulative}
+
+    def quantile(self, q):
+        """
+        Estimate a quantile as the upper bound of the bucket it falls in
+        """
+        snapshot = self.snapshot()
+        if not snapshot['count']:
+            return 0.0
+        rank = q * snapshot['count']
+        for bound, running in snapshot['buckets']:
+            if running >= rank:
+                if bound is None:
+                    return snapshot['max']
+                return bound
+        return snapshot['max']
@@ -0,0 +1,362 @@
+'''
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+Keep-alive HTTPS connection pooling for the Chargify API
+'''
+
+import httplib
+import os
+import socket
+import sys
+import threading
+import time
+import logging
+
+from metrics import RequestHooks, clock
+from retry import IDEMPOTENT_METHODS, IDEMPOTENCY_HEADER
+
+log = logging.getLogger("pychargify.transport")
+
+# Errors raised by a kept-alive socket that the server has already closed
+STALE_ERRORS = (httplib.HTTPException, socket.error)
+
+
+def is_replayable(body):
+    """
+    Whether a request body can be sent again, streamed bodies can not
+    """
+    return body is None or isinstance(body, basestring)
+
+def is_idempotent(method, headers):
+    """
+    Whether sending a request twice has the same effect as sending it once
+    """
+    if method.upper() in IDEMPOTENT_METHODS:
+        return True
+    for name in (headers or {}):
+        if name.lower() == IDEMPOTENCY_HEADER.lower():
+            return True
+    return False
+
+def send_chunked(conn, method, url, chunks, headers):
+    """
+    Send a request whose body is an iterable of byte strings using chunked
+    transfer encoding, so the body never has to be held in memory
+    """
+    conn.putrequest(method, url)
+    for name, value in headers.iteritems():
+        conn.putheader(name, value)
+    conn.putheader('Transfer-Encoding', 'chunked')
+    conn.endheaders()
+    for chunk in chunks:
+        if chunk:
+            conn.send('%x\r\n%s\r\n' %(len(chunk), chunk))
+    conn.send('0\r\n\r\n')
+
+
+class RequestNotSent(Exception):
+    """
+    Writing a request failed, so the server never got it.  Carries the
+    exc_info of the original error.
+    """
+    def __init__(self, exc_info):
+        Exception.__init__(self, exc_info[1])
+        self.exc_info = exc_info
+
+
+class Response(object):
+    """
+    A fully read HTTP response
+    """
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+        # The RequestInfo of an instrumented request and the RequestHooks
+        # it was started with
+        self.info = None
+        self.hooks = None
+
+    def getheader(self, name, default = None):
+        return self.headers.get(name.lower(), default)
+
+
+class ConnectionPool(object):
+    """
+    A thread safe pool of keep-alive connections to a single host.
+
+    Up to `maxsize` idle connections are kept; callers never block waiting for
+    a connection, extra connections are simply closed when they are returned.
+    Connections that sat idle for longer than `idle_timeout` seconds are
+    evicted, and a reused connection the server has dropped is replaced once.
+    `scheme` is 'https', or 'http' for a local stand-in server.
+    """
+    connection_classes = {'http': httplib.HTTPConnection, 'https': httplib.HTTPSConnection}
+    # Overrides the connection class picked by the scheme
+    connection_class = None
+
+    def __init__(self, host, maxsize = 4, idle_timeout = 60, timeout = None, scheme = 'https'):
+        if scheme not in self.connection_classes:
+            raise ValueError('Unsupported scheme: %s' %(scheme))
+        self.host = host
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.scheme = scheme
+        self._reset()
+
+    def _reset(self):
+        """
+        Start with an empty pool owned by the current process
+        """
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._idle = []
+
+    def _check_fork(self):
+        """
+        A forked child must not share sockets (or a held lock) with its parent.
+        The inherited connections are dropped without being closed so the
+        parent's TLS sessions are left untouched.
+        """
+        if self._pid != os.getpid():
+            self._reset()
+
+    def _new_conn(self):
+        connection_class = self.connection_class or self.connection_classes[self.scheme]
+        if self.timeout is None:
+            return connection_class(self.host)
+        return connection_class(self.host, timeout = self.timeout)
+
+    def _get_conn(self):
+        """
+        Return a (connection, reused) tuple, preferring the most recently used
+        idle connection
+        """
+        self._check_fork()
+        expired = []
+        conn = None
+        now = time.time()
+        self._lock.acquire()
+        try:
+            while self._idle:
+                candidate, last_used = self._idle.pop()
+                if self.idle_timeout is not None and now - last_used > self.idle_timeout:
+                    expired.append(candidate)
+                    continue
+                conn = candidate
+                break
+        finally:
+            self._lock.release()
+        for candidate in expired:
+            candidate.close()
+        if conn is None:
+            return self._new_conn(), False
+        return conn, True
+
+    def _put_conn(self, conn):
+        self._check_fork()
+        self._lock.acquire()
+        try:
+            if len(self._idle) < self.maxsize:
+                self._idle.append((conn, time.time()))
+                conn = None
+        finally:
+            self._lock.release()
+        if conn is not None:
+            conn.close()
+
+    def clear(self):
+        """
+        Close every idle connection
+        """
+        self._check_fork()
+        self._lock.acquire()
+        try:
+            idle, self._idle = self._idle, []
+        finally:
+            self._lock.release()
+        for conn, last_used in idle:
+            conn.close()
+
+    def _send(self, conn, method, url, body, headers, info = None):
+        if info is not None:
+            start = clock()
+            info.attempts += 1
+            info.connect = 0.0
+            if conn.sock is None:
+                conn.connect()
+                info.connect = clock() - start
+        try:
+            if is_replayable(body):
+                conn.request(method, url, body, headers or {})
+            else:
+                send_chunked(conn, method, url, body, headers or {})
+        except STALE_ERRORS:
+            raise RequestNotSent(sys.exc_info())
+        response = conn.getresponse()
+        if info is not None:
+            info.ttfb = clock() - start
+        return response
+    
+    def _may_replay(self, method, body, headers, error, sent):
+        """
+        Whether a request that failed on a reused connection can be sent on a
+        new one.  Once it was written the server may have acted on it, so
+        only idempotent requests are sent again, and a timeout is never
+        taken for a dropped connection.
+        """
+        if not is_replayable(body) or isinstance(error, socket.timeout):
+            return False
+        return not sent or is_idempotent(method, headers)
+    
+    def urlopen(self, method, url, body = None, headers = None, info = None):
+        """
+        Send a request and read the whole response so the connection can be
+        returned to the pool.  `body` may be a string or an iterable of
+        strings, which is streamed with chunked transfer encoding.  The
+        connect and time to first byte timings are recorded in `info`, a
+        RequestInfo, when one is given.
+        """
+        conn, reused = self._get_conn()
+        try:
+            response = self._send(conn, method, url, body, headers, info)
+        except (RequestNotSent,) + STALE_ERRORS, e:
+            conn.close()
+            sent = not isinstance(e, RequestNotSent)
+            exc_info = sent and sys.exc_info() or e.exc_info
+            if not reused or not self._may_replay(method, body, headers, exc_info[1], sent):
+                raise exc_info[0], exc_info[1], exc_info[2]
+            log.debug("Reconnecting to %s after stale connection: %r" %(self.host, exc_info[1]))
+            conn = self._new_conn()
+            try:
+                response = self._send(conn, method, url, body, headers, info)
+            except RequestNotSent, e:
+                conn.close()
+                raise e.exc_info[0], e.exc_info[1], e.exc_info[2]
+            except:
+                conn.close()
+                raise
+        except:
+            conn.close()
+            raise
+
+        body = None
+        try:
+            body = response.read()
+        except:
+            conn.close()
+            conn = None
+
+        if conn is not None:
+            if response.will_close:
+                conn.close()
+            else:
+                self._put_conn(conn)
+        headers = dict((k.lower(), v) for k, v in response.getheaders())
+        return Response(response.status, response.reason, headers, body)
+
+
+class HTTPTransport(object):
+    """
+    Owns one ConnectionPool per request host and is shared by every
+    resource object created from the same Chargify entry point.
+    Failed requests are retried according to `retry`, a RetryPolicy, and
+    every attempt first takes a token for its host from `rate_limiter`.
+    `http_cache` is the ValidatorCache resources use for conditional GETs
+    and `catalog_cache` the CatalogCache for product lookups.
+    `hooks` holds the RequestHooks added with add_hooks(), it stays None
+    until then so uninstrumented requests skip all bookkeeping.
+    """
+    pool_class = ConnectionPool
+    hooks = None
+
+    def __init__(self, pool_size = 4, idle_timeout = 60, timeout = None, retry = None, rate_limiter = None, http_cache = None, catalog_cache = None, scheme = 'https'):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.scheme = scheme
+        self.retry = retry
+        self.rate_limiter = rate_limiter
+        self.http_cache = http_cache
+        self.catalog_cache = catalog_cache
+        self._lock = threading.Lock()
+        self._pools = {}
+
+    def get_pool(self, host):
+        pool = self._pools.get(host)
+        if pool is None:
+            self._lock.acquire()
+            try:
+                pool = self._pools.get(host)
+                if pool is None:
+                    pool = self.pool_class(host, self.pool_size, self.idle_timeout, self.timeout, self.scheme)
+                    self._pools[host] = pool
+            finally:
+                self._lock.release()
+        return pool
+
+    def add_hooks(self, pre_request = None, post_response = None):
+        """
+        Call `pre_request` before and `post_response` after every request
+        with its RequestInfo
+        """
+        if self.hooks is None:
+            self.hooks = RequestHooks()
+        self.hooks.add(pre_request, post_response)
+
+    def remove_hooks(self, pre_request = None, post_response = None):
+        if self.hooks is not None:
+            self.hooks.remove(pre_request, post_response)
+            if not len(self.hooks):
+                self.hooks = None
+
+    def clear_hooks(self):
+        self.hooks = None
+
+    def request(self, host, method, url, body = None, headers = None, info = None):
+        pool = self.get_pool(host)
+        rate_limiter = self.rate_limiter
+        def send():
+            if rate_limiter is not None:
+                rate_limiter.acquire(host)
+            return pool.urlopen(method, url, body, headers, info)
+        if self.retry is None or not is_replayable(body):
+            return send()
+        return self.retry.call(method, headers, send)
+
+    def close(self):
+        for pool in self._pools.values():
+            pool.clear()
+
+
+_default_transport = None
+_default_lock = threading.Lock()
+
+def get_default_transport():
+    """
+    The transport used by resource objects created without one
+    """
+    global _default_transport
+    if _default_transport is None:
+        _default_lock.acquire()
+        try:
+            if _default_transport is None:
+                _default_transport = HTTPTransport()
+        finally:
+            _default_lock.release()
+    return _default_transport
@@ -0,0 +1,455 @@
+""" Incremental sync of chargify customers and subscriptions into the models.
+
+Every run lists only the records changed since the previous one, oldest
+change first, and stores them a page at a time.  Where it got to is kept in
+a SyncCheckpoint per resource, saved in the same transaction as the page,
+so a run that dies part way is picked up where it stopped by the next one.
+
+    from chargify.sync import SyncEngine
+    SyncEngine().run()
+
+A full reload can instead be split into partitions of the listings, synced
+by a pool of processes on one or more hosts (see ParallelSync):
+
+    ParallelSync(run = 'nightly-2012-06-01', partitions = 8).run()
+"""
+from chargify_settings import CHARGIFY
+from django import db
+from django.db.models import F
+from django.utils import timezone
+from models import Customer, Product, Subscription, SyncCheckpoint, SyncLease, atomic, db_datetime, unit_of_work
+from pychargify.dates import UTC
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import time
+import traceback
+log = logging.getLogger("chargify.sync")
+
+DEFAULT_PAGE_SIZE = 200
+
+# Where the first run of a resource starts
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo = UTC)
+
+def aware(value):
+    """ A datetime read back from a DateTimeField, timezone aware """
+    if value is not None and timezone.is_naive(value):
+        value = timezone.make_aware(value, timezone.get_default_timezone())
+    return value
+
+def store_customers(objs):
+    """ Create or update the Customers of a page of api objects, returns the upsert counts """
+    return Customer.objects.upsert(objs, len(objs))
+
+def store_subscriptions(objs):
+    """ Create or update the Subscriptions of a page of api objects, returns the upsert counts """
+    return Subscription.objects.upsert(objs, len(objs))
+
+def store_products(objs):
+    """ Create or update the Products of a page of api objects, returns the upsert counts """
+    return Product.objects.upsert(objs, len(objs))
+
+class SyncEngine(object):
+    """ Walks the changed records of each resource in RESOURCES and stores
+    them.  `gateway` is the Chargify client, `page_size` the number of
+    records fetched and committed at a time. """
+    # Resource name, the gateway factory of its api objects and the function storing a page of them
+    RESOURCES = (
+        ('customers', 'Customer', store_customers),
+        ('subscriptions', 'Subscription', store_subscriptions),
+    )
+
+    def __init__(self, gateway = None, page_size = DEFAULT_PAGE_SIZE):
+        self.gateway = gateway or CHARGIFY
+        self.page_size = page_size
+        # Called with the resource name and its stats after every page
+        self.progress = None
+
+    def checkpoint(self, resource):
+        checkpoint, created = SyncCheckpoint.objects.get_or_create(resource = resource)
+        return checkpoint
+
+    def run(self, resources = None, since = None, resume = True):
+        """ Sync every resource (or those named in `resources`), returns a
+        dict of resource name to the stats of its run """
+        stats = {}
+        for name, factory, store in self.RESOURCES:
+            if resources is None or name in resources:
+                stats[name] = self.sync(name, since, resume)
+        return stats
+
+    def _start(self, checkpoint, since, resume):
+        """ The (high water mark, page) to start from, a new run is recorded
+        on the checkpoint """
+        if since is None and checkpoint.running and resume:
+            log.info('Resuming %s sync at %s page %i' %(checkpoint.resource, checkpoint.high_water, checkpoint.page))
+            return aware(checkpoint.high_water) or EPOCH, checkpoint.page
+        if since is None:
+            if checkpoint.running:
+                since = aware(checkpoint.run_from)
+            else:
+                since = aware(checkpoint.high_water)
+        since = since or EPOCH
+        checkpoint.run_from = db_datetime(since)
+        checkpoint.high_water = checkpoint.run_from
+        checkpoint.page = 1
+        checkpoint.started_at = timezone.now()
+        checkpoint.finished_at = None
+        checkpoint.synced = 0
+        checkpoint.save()
+        return since, 1
+
+    def sync(self, resource, since = None, resume = True):
+        """ Store the records of `resource` changed since its checkpoint, or
+        since the `since` datetime.  An interrupted run is continued unless
+        `resume` is off, then it starts over from where that run began. """
+        for name, factory, store in self.RESOURCES:
+            if name == resource:
+                break
+        else:
+            raise ValueError('Unknown resource: %s' %(resource))
+        started = time.time()
+        checkpoint = self.checkpoint(resource)
+        cursor, page = self._start(checkpoint, since, resume)
+        api = getattr(self.gateway, factory)()
+        stats = {'pages': 0, 'fetched': 0, 'created': 0, 'updated': 0, 'unchanged': 0}
+        # Customers and products stay resolved from one page to the next
+        with unit_of_work():
+            while True:
+                objs = api.getPage(page, self.page_size, since = cursor)
+                with atomic():
+                    if objs:
+                        for key, value in store(objs).items():
+                            stats[key] += value
+                    # Move the high water mark up to the last change stored, or to
+                    # the next page while a whole page shares one timestamp
+                    last = objs and objs[-1].updated_at or None
+                    if last is not None and last > cursor:
+                        cursor, page = last, 1
+                    else:
+                        page += 1
+                    checkpoint.high_water = db_datetime(cursor)
+                    checkpoint.page = page
+                    checkpoint.synced += len(objs)
+                    checkpoint.save()
+                stats['pages'] += 1
+                stats['fetched'] += len(objs)
+                log.debug('Synced %i %s up to %s' %(len(objs), resource, cursor))
+                if self.progress is not None:
+                    self.progress(resource, stats)
+                # Only an empty page ends the walk, the server may return
+                # fewer records than asked for
+                if not objs:
+                    break
+        checkpoint.page = 1
+        checkpoint.finished_at = timezone.now()
+        checkpoint.save()
+        stats['high_water'] = cursor
+        stats['seconds'] = time.time() - started
+        log.info('Synced %(fetched)i %(resource)s: %(created)i created, %(updated)i updated, %(unchanged)i unchanged' % dict(stats, resource = resource))
+        return stats
+
+class LeaseLost(Exception):
+    """ Another worker took over the partition after our lease expired """
+    pass
+
+# The coordinator the pool processes inherit, multiprocessing forks them
+_coordinator = None
+
+def _work(resource):
+    # Progress is reported by the parent process
+    _coordinator.progress = None
+    return _coordinator.work(resource)
+
+def merge_stats(stats):
+    """ Sum a list of partition stats dicts """
+    total = {}
+    for partition in stats:
+        for key, value in partition.items():
+            if isinstance(value, (int, long, float)):
+                total[key] = total.get(key, 0) + value
+    return total
+
+class ParallelSync(object):
+    """ Reloads every record of each resource with a pool of `processes`
+    worker processes.  Each listing is split into `partitions` windows of
+    creation time, of equal length from the first record created to the
+    start of the run, the last one open ended.  A record's creation time
+    never changes, so unlike pages of a listing that changes during the run
+    every record falls in exactly one window.  Each window is walked oldest
+    first, with the creation time it got to as the cursor like SyncEngine
+    does, so records created or deleted meanwhile shift no page boundaries.
+
+    The partitions are SyncLease rows of the `run`, which workers claim
+    for `lease_seconds` at a time.  Coordinators on several hosts given the
+    same `run` share its partitions, each is synced once, and a partition
+    whose worker died is taken over when its lease expires.  Products are
+    synced first in a single partition, then customers and then
+    subscriptions, each only once every partition of the previous resource
+    is done.
+
+    With `processes` 0 the partitions are synced in this process.
+    Otherwise the workers are forked, each with its own database connection
+    and API connection pool. """
+    # Resource name, the gateway factory of its api objects, the function
+    # storing a page of them and its number of partitions, None for as many
+    # windows as the run has.  Products cannot be listed by date, they are
+    # few and paged through by a single worker.
+    RESOURCES = (
+        ('products', 'Product', store_products, 1),
+        ('customers', 'Customer', store_customers, None),
+        ('subscriptions', 'Subscription', store_subscriptions, None),
+    )
+
+    def __init__(self, run = None, partitions = 4, processes = None, resources = None, gateway = None,
+                 page_size = DEFAULT_PAGE_SIZE, lease_seconds = 300, max_attempts = 3, owner = None):
+        self.run_name = run or timezone.now().strftime('reload-%Y%m%d%H%M%S')
+        self.partitions = partitions
+        if processes is None:
+            processes = min(partitions, multiprocessing.cpu_count())
+        self.processes = processes
+        self.resources = resources
+        self.gateway = gateway or CHARGIFY
+        self.page_size = page_size
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._owner = owner
+        # Seconds between checks for the partitions of other hosts
+        self.poll = 1
+        # Called with the resource name and the stats of all its partitions
+        # after every page, every `poll` seconds while workers are forked
+        self.progress = None
+
+    def _get_owner(self):
+        return self._owner or '%s:%i' %(socket.gethostname(), os.getpid())
+    owner = property(_get_owner)
+
+    def _resource(self, name):
+        for resource in self.RESOURCES:
+            if resource[0] == name:
+                return resource
+        raise ValueError('Unknown resource: %s' %(name))
+
+    def _progress(self, resource):
+        if self.progress is not None:
+            self.progress(resource, merge_stats([json.loads(lease.stats or '{}') for lease in self.leases(resource)]))
+
+    def leases(self, resource = None):
+        leases = SyncLease.objects.filter(run = self.run_name)
+        if resource is not None:
+            leases = leases.filter(resource = resource)
+        return leases
+
+    def windows(self, resource):
+        """ The (start, end) creation times of the partitions of `resource`,
+        None for an open end """
+        name, factory, store, partitions = self._resource(resource)
+        if partitions is not None:
+            return [(None, None)] * partitions
+        now = datetime.datetime.now(UTC)
+        first = getattr(self.gateway, factory)().getPage(1, 1, since = EPOCH, date_field = 'created_at')
+        start = first and min(first[0].created_at, now) or now
+        step = (now - start) / self.partitions
+        # Listings filter creation times to the second
+        bounds = [(start + step * i).replace(microsecond = 0) for i in range(1, self.partitions)]
+        return zip([None] + bounds, bounds + [None])
+
+    def plan(self, resource):
+        """ Create the partitions of `resource` unless another host did """
+        if self.leases(resource).exists():
+            return
+        windows = self.windows(resource)
+        try:
+            # All or none, so the windows of two hosts never get mixed
+            with atomic():
+                for partition, (start, end) in enumerate(windows):
+                    SyncLease.objects.create(run = self.run_name, resource = resource, partition = partition,
+                                             partitions = len(windows), window_start = db_datetime(start),
+                                             window_end = db_datetime(end), page = 1)
+        except db.IntegrityError:
+            # Created by another host in the meantime
+            pass
+
+    def claim(self, resource):
+        """ Take the lease of an unfinished partition that nobody holds, or
+        whose lease expired.  Returns the SyncLease or None. """
+        now = timezone.now()
+        candidates = self.leases(resource).filter(finished_at__isnull = True, attempts__lt = self.max_attempts)
+        for lease in candidates.order_by('partition'):
+            if lease.leased_until is not None and lease.leased_until > now:
+                continue
+            # Only one worker can update the row from the state it read
+            claimed = SyncLease.objects.filter(pk = lease.pk, owner = lease.owner, leased_until = lease.leased_until,
+                                               finished_at__isnull = True).update(
+                owner = self.owner, leased_until = now + datetime.timedelta(seconds = self.lease_seconds),
+                attempts = F('attempts') + 1, started_at = lease.started_at or now)
+            if claimed:
+                return SyncLease.objects.get(pk = lease.pk)
+        return None
+
+    def _renew(self, lease, **fields):
+        fields.setdefault('leased_until', timezone.now() + datetime.timedelta(seconds = self.lease_seconds))
+        if not SyncLease.objects.filter(pk = lease.pk, owner = lease.owner).update(**fields):
+            raise LeaseLost(unicode(lease))
+
+    def sync_partition(self, lease):
+        """ Sync the records of a claimed partition, from where it got to """
+        name, factory, store, partitions = self._resource(lease.resource)
+        api = getattr(self.gateway, factory)()
+        stats = {'pages': 0, 'fetched': 0, 'created': 0, 'updated': 0, 'unchanged': 0, 'seconds': 0.0, 'errors': 0}
+        stats.update(json.loads(lease.stats or '{}'))
+        start, end = aware(lease.window_start), aware(lease.window_end)
+        cursor = aware(lease.cursor) or start or EPOCH
+        page = lease.page
+        # The records created at the cursor time that were already stored
+        seen = set()
+        last_ids = None
+        started = time.time()
+        try:
+            with unit_of_work():
+                while True:
+                    if partitions is None:
+                        objs = api.getPage(page, self.page_size, since = cursor, until = end, date_field = 'created_at')
+                        # Records created at the end of the window are the next one's
+                        mine = [obj for obj in objs if obj.id not in seen and (start is None or obj.created_at >= start)
+                                and (end is None or obj.created_at < end)]
+                    else:
+                        objs = mine = api.getPage(page, self.page_size)
+                    ids = [obj.id for obj in objs]
+                    if objs and ids == last_ids:
+                        # The endpoint ignored the page parameter, as Pager stops
+                        log.warning('%s got page %i repeated, the server ignores the page parameter' %(lease, page))
+                        break
+                    last_ids = ids
+                    with atomic():
+                        if mine:
+                            for key, value in store(mine).items():
+                                stats[key] += value
+                        stats['pages'] += 1
+                        stats['fetched'] += len(mine)
+                        # Move the cursor up to the last record created, or to the
+                        # next page while a whole page shares one creation time.
+                        # Only an empty page ends the walk, the server may return
+                        # fewer records than asked for.
+                        if not objs:
+                            break
+                        if partitions is None and objs[-1].created_at > cursor:
+                            cursor, page, seen = objs[-1].created_at, 1, set()
+                        else:
+                            page += 1
+                        if partitions is None:
+                            seen.update([obj.id for obj in objs if obj.created_at == cursor])
+                        self._renew(lease, cursor = db_datetime(cursor), page = page, stats = json.dumps(stats))
+                    log.debug('Synced %i %s of %s' %(len(mine), lease.resource, lease))
+                    self._progress(lease.resource)
+            stats['seconds'] += time.time() - started
+            # The error of a failed attempt is past once the partition is done
+            self._renew(lease, page = page, stats = json.dumps(stats), finished_at = timezone.now(), leased_until = None,
+                        error = '')
+        except LeaseLost:
+            log.warning('Lost the lease of %s' %(lease))
+            return None
+        except Exception:
+            log.exception('Failed to sync %s' %(lease))
+            stats['errors'] += 1
+            # Released for another attempt, keeping the page it got to
+            SyncLease.objects.filter(pk = lease.pk, owner = lease.owner).update(
+                owner = None, leased_until = None, stats = json.dumps(stats), error = traceback.format_exc())
+        return stats
+
+    def work(self, resource):
+        """ Sync partitions of `resource` until none is left to claim,
+        returns the stats of each """
+        results = []
+        while True:
+            lease = self.claim(resource)
+            if lease is None:
+                return results
+            stats = self.sync_partition(lease)
+            if stats is not None:
+                results.append(stats)
+
+    def _pending(self, resource):
+        return self.leases(resource).filter(finished_at__isnull = True, attempts__lt = self.max_attempts).exists()
+
+    def sync(self, resource):
+        """ Sync every partition of `resource`, waiting for those of other hosts """
+        global _coordinator
+        self.plan(resource)
+        if self.processes:
+            # The forked workers must not share this process's connections
+            for connection in db.connections.all():
+                connection.close()
+            _coordinator = self
+            pool = multiprocessing.Pool(self.processes)
+            try:
+                result = pool.map_async(_work, [resource] * self.processes)
+                while not result.ready():
+                    result.wait(self.poll)
+                    self._progress(resource)
+                result.get()
+            finally:
+                pool.close()
+                pool.join()
+                _coordinator = None
+        # Take over partitions left behind once their lease runs out
+        while True:
+            self.work(resource)
+            self._progress(resource)
+            if not self._pending(resource):
+                break
+            time.sleep(self.poll)
+
+    def run(self):
+        """ Sync every resource (or those in `resources`) and return the report """
+        for name, factory, store, partitions in self.RESOURCES:
+            if self.resources is None or name in self.resources:
+                log.info('Syncing %s in %i partitions' %(name, partitions or self.partitions))
+                self.sync(name)
+        return self.report()
+
+    def report(self):
+        """ The stats of every partition of the run, from all hosts, merged
+        per resource and per worker.  `per_second` is the records fetched
+        per second of the resource's wall time. """
+        report = {'run': self.run_name, 'resources': {}, 'workers': {}, 'errors': []}
+        for lease in self.leases().order_by('resource', 'partition'):
+            stats = json.loads(lease.stats or '{}')
+            resource = report['resources'].setdefault(lease.resource, {'partitions': [], 'unfinished': 0})
+            resource['partitions'].append(dict(stats, partition = lease.partition, owner = lease.owner,
+                                               attempts = lease.attempts, started_at = lease.started_at,
+                                               finished_at = lease.finished_at))
+            if lease.finished_at is None:
+                resource['unfinished'] += 1
+            if lease.error:
+                report['errors'].append({'resource': lease.resource, 'partition': lease.partition,
+                                         'attempts': lease.attempts, 'error': lease.error})
+            if lease.owner:
+                worker = report['workers'].setdefault(lease.owner, [])
+                worker.append(stats)
+        for name, resource in report['resources'].items():
+            partitions = resource['partitions']
+            totals = merge_stats(partitions)
+            for key in ('partition', 'attempts'):
+                totals.pop(key, None)
+            resource.update(totals)
+            started = [partition['started_at'] for partition in partitions if partition['started_at']]
+            finished = [partition['finished_at'] for partition in partitions if partition['finished_at']]
+            if started and finished and not resource['unfinished']:
+                wall = max((max(finished) - min(started)).total_seconds(), 1e-6)
+                resource['wall_seconds'] = wall
+                resource['per_second'] = resource.get('fetched', 0) / wall
+            # Keep the report JSON serializable
+            for partition in partitions:
+                for key in ('started_at', 'finished_at'):
+                    if partition[key] is not None:
+                        partition[key] = partition[key].isoformat()
+        for owner, stats in report['workers'].items():
+            worker = merge_stats(stats)
+            if worker.get('seconds'):
+                worker['per_second'] = worker.get('fetched', 0) / worker['seconds']
+            report['workers'][owner] = worker
+        return report